@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Phone Agent 基准测试
+
+把 bench/stubs 下的假 adb / 设备端命令 / termux-* 放到 PATH 上，进程内启动
+Phone Agent，按给定并发度压测各接口，输出机器可读的 JSON（吞吐、p50/p95/p99）。
+不需要真机，延迟和输出大小都可配置，两次运行结果可直接对比。
+
+用法：
+    python bench/bench.py                          # 全部场景，并发 1 和 4
+    python bench/bench.py -s tap,batch -c 1,8 -n 200
+    python bench/bench.py --latency-ms 20 --output results.json
+    python bench/bench.py --compare baseline.json  # 与上次结果对比
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+
+DEVICE_COMMANDS = ["input", "screencap", "uiautomator", "am", "dumpsys"]
+TERMUX_COMMANDS = [
+    "termux-battery-status",
+    "termux-wifi-connectioninfo",
+    "termux-location",
+    "termux-sms-list",
+]
+FILE_SIZES = {"64k": 64 * 1024, "1m": 1024 * 1024, "8m": 8 * 1024 * 1024}
+
+
+# ==================== 环境 ====================
+
+
+def prepare_env(root, args):
+    """在临时目录里布置 PATH、假 sdcard 和 config.json，返回 sdcard 路径"""
+    bin_dir = os.path.join(root, "bin")
+    devbin = os.path.join(root, "devbin")
+    sdcard = os.path.join(root, "sdcard")
+    for d in (bin_dir, devbin, sdcard):
+        os.makedirs(d, exist_ok=True)
+
+    os.symlink(os.path.join(STUBS_DIR, "adb"), os.path.join(bin_dir, "adb"))
+    for name in TERMUX_COMMANDS:
+        os.symlink(os.path.join(STUBS_DIR, "termux.py"), os.path.join(bin_dir, name))
+    for name in DEVICE_COMMANDS:
+        os.symlink(os.path.join(STUBS_DIR, "device.py"), os.path.join(devbin, name))
+
+    os.environ.update(
+        {
+            "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+            "BENCH_DEVBIN": devbin,
+            "BENCH_SDCARD": sdcard,
+            "BENCH_LATENCY_MS": str(args.latency_ms),
+            "BENCH_ADB_LATENCY_MS": str(args.adb_latency_ms),
+            "BENCH_TERMUX_LATENCY_MS": str(args.termux_latency_ms),
+            "BENCH_OUTPUT_BYTES": str(args.output_bytes),
+            "BENCH_SCREEN_SIZE": args.screen_size,
+            "BENCH_DUMP_NODES": str(args.dump_nodes),
+        }
+    )
+
+    with open(os.path.join(REPO_DIR, "config.json")) as f:
+        config = json.load(f)
+    config["adb"]["pool"] = not args.no_pool
+    if args.no_cache:
+        config.setdefault("termux", {})["cache_ttl"] = {}
+        config.setdefault("ui", {})["cache_ttl"] = 0
+    with open(os.path.join(root, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    for label, size in FILE_SIZES.items():
+        with open(os.path.join(sdcard, f"bench_{label}.bin"), "wb") as f:
+            f.write(os.urandom(size))
+    return sdcard
+
+
+def start_server():
+    """进程内启动 Phone Agent（多线程 werkzeug），返回 (server, port)"""
+    import logging
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    sys.path.insert(0, REPO_DIR)
+    import phone_agent
+
+    server = make_server("127.0.0.1", 0, phone_agent.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return phone_agent, server, server.server_port
+
+
+# ==================== 场景 ====================
+
+
+class Client:
+    """每个工作线程一个 HTTP 连接"""
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self.local.conn = None
+            raise
+        if resp.getheader("Connection", "").lower() == "close" or resp.version == 10:
+            conn.close()
+            self.local.conn = None
+        if resp.status >= 400:
+            raise RuntimeError(f"HTTP {resp.status}: {data[:200]!r}")
+        return data
+
+    def post(self, path, body):
+        data = json.loads(self.request("POST", path, body))
+        if isinstance(data, dict) and data.get("success") is False:
+            raise RuntimeError(data.get("error") or "failed")
+        return data
+
+
+def build_scenarios(client, sdcard):
+    """场景名 -> 单次操作函数"""
+    batch_actions = [
+        {"type": "tap", "x": 500, "y": 800},
+        {"type": "text", "text": "hello"},
+        {"type": "key", "key": "ENTER"},
+        {"type": "swipe", "x1": 500, "y1": 1500, "x2": 500, "y2": 500, "duration": 100},
+        {"type": "tap", "x": 200, "y": 300},
+    ]
+
+    def tap():
+        client.post("/api/adb/tap", {"x": 500, "y": 800})
+
+    def batch():
+        client.post("/api/adb/batch", {"actions": batch_actions})
+
+    def dump():
+        client.request("GET", "/api/adb/dump")
+
+    def ui_find():
+        client.post("/api/ui/find", {"selector": {"text": "Item 150"}})
+
+    def ui_find_refresh():
+        client.post("/api/ui/find", {"selector": {"text": "Item 150"}, "refresh": True})
+
+    def screenshot():
+        client.request("GET", "/api/adb/screenshot?format=png")
+
+    def termux():
+        client.post("/api/termux", {"command": "termux-battery-status"})
+
+    def termux_uncached():
+        client.post("/api/termux", {"command": "termux-battery-status", "cache": False})
+
+    scenarios = {
+        "tap": tap,
+        "batch": batch,
+        "dump": dump,
+        "ui_find": ui_find,
+        "ui_find_refresh": ui_find_refresh,
+        "screenshot": screenshot,
+        "termux": termux,
+        "termux_uncached": termux_uncached,
+    }
+
+    counter = [0]
+    counter_lock = threading.Lock()
+
+    def next_id():
+        with counter_lock:
+            counter[0] += 1
+            return counter[0]
+
+    for label, size in FILE_SIZES.items():
+        path = os.path.join(sdcard, f"bench_{label}.bin")
+        payload = os.urandom(size)
+        payload_b64 = base64.b64encode(payload).decode("ascii")
+
+        def file_read(path=path):
+            client.post("/api/file/read", {"path": path, "maxBytes": 64 * 1024 * 1024})
+
+        def file_download(path=path):
+            client.request("GET", f"/api/file/download?path={path}")
+
+        def file_write(payload_b64=payload_b64):
+            target = os.path.join(sdcard, "out", f"write_{next_id()}.bin")
+            client.post("/api/file/write", {"path": target, "base64": payload_b64})
+
+        def file_upload(payload=payload, size=size):
+            target = os.path.join(sdcard, "out", f"upload_{next_id()}.bin")
+            upload = client.post("/api/file/upload", {"path": target, "size": size})
+            upload_id = upload["upload_id"]
+            chunk = 1024 * 1024
+            for offset in range(0, size, chunk):
+                client.request(
+                    "PUT",
+                    f"/api/file/upload/{upload_id}?offset={offset}",
+                    body=payload[offset:offset + chunk],
+                    headers={"Content-Type": "application/octet-stream"},
+                )
+            client.post(f"/api/file/upload/{upload_id}/finalize", {})
+
+        scenarios[f"file_read_{label}"] = file_read
+        scenarios[f"file_download_{label}"] = file_download
+        scenarios[f"file_write_{label}"] = file_write
+        scenarios[f"file_upload_{label}"] = file_upload
+    return scenarios
+
+
+# ==================== 统计 ====================
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run_scenario(name, fn, concurrency, requests_total, warmup):
+    for _ in range(warmup):
+        try:
+            fn()
+        except Exception:
+            pass
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests_total)))
+    wall = time.perf_counter() - wall_started
+
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": requests_total,
+        "ok": len(latencies),
+        "errors": len(errors),
+        "error_sample": errors[:3],
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else None,
+        "latency_ms": {
+            "mean": ms(statistics.fmean(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    """按 (场景, 并发) 对比吞吐和 p95，打印到 stderr"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    base = {(r["scenario"], r["concurrency"]): r for r in baseline.get("results", [])}
+    print(f"\n对比 {baseline_path}（rev {baseline.get('meta', {}).get('revision')}）", file=sys.stderr)
+    for r in results:
+        b = base.get((r["scenario"], r["concurrency"]))
+        if not b or not b.get("throughput_rps") or not r.get("throughput_rps"):
+            continue
+        rps = r["throughput_rps"] / b["throughput_rps"]
+        p95 = (r["latency_ms"]["p95"] or 0) / (b["latency_ms"]["p95"] or 1)
+        print(
+            f"  {r['scenario']:<22} c={r['concurrency']:<3} "
+            f"rps x{rps:5.2f}   p95 x{p95:5.2f}",
+            file=sys.stderr,
+        )
+
+
+# ==================== 入口 ====================
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="Phone Agent benchmark (stub adb / termux)")
+    p.add_argument("-s", "--scenarios", help="逗号分隔的场景名，默认全部")
+    p.add_argument("-c", "--concurrency", default="1,4", help="逗号分隔的并发度")
+    p.add_argument("-n", "--requests", type=int, default=50, help="每个场景每个并发度的请求数")
+    p.add_argument("--warmup", type=int, default=3)
+    p.add_argument("--latency-ms", type=float, default=5, help="设备端命令延迟")
+    p.add_argument("--adb-latency-ms", type=float, default=10, help="每次启动 adb 客户端的延迟")
+    p.add_argument("--termux-latency-ms", type=float, default=50, help="termux-* 命令延迟")
+    p.add_argument("--output-bytes", type=int, default=2048, help="termux-* 输出大小")
+    p.add_argument("--screen-size", default="1080x2400")
+    p.add_argument("--dump-nodes", type=int, default=200)
+    p.add_argument("--no-pool", action="store_true", help="关闭 adb shell 会话池")
+    p.add_argument("--no-cache", action="store_true", help="关闭 termux / UI 缓存")
+    p.add_argument("--list", action="store_true", help="列出场景后退出")
+    p.add_argument("-o", "--output", help="结果 JSON 写入文件（默认 stdout）")
+    p.add_argument("--compare", help="与之前的结果 JSON 对比")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    root = tempfile.mkdtemp(prefix="phone-agent-bench-")
+    cwd = os.getcwd()
+    server = None
+    try:
+        sdcard = prepare_env(root, args)
+        os.chdir(root)  # config.json 按相对路径读取
+        phone_agent, server, port = start_server()
+        phone_agent.ALLOWED_PATH_PREFIXES.append(sdcard + "/")
+
+        scenarios = build_scenarios(Client(port), sdcard)
+        if args.list:
+            print("\n".join(scenarios))
+            return 0
+        names = args.scenarios.split(",") if args.scenarios else list(scenarios)
+        unknown = [n for n in names if n not in scenarios]
+        if unknown:
+            print(f"未知场景: {', '.join(unknown)}", file=sys.stderr)
+            return 2
+
+        results = []
+        for name in names:
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                r = run_scenario(name, scenarios[name], concurrency, args.requests, args.warmup)
+                results.append(r)
+                lat = r["latency_ms"]
+                print(
+                    f"{name:<22} c={concurrency:<3} {r['throughput_rps'] or 0:>9.1f} req/s  "
+                    f"p50 {lat['p50'] or 0:>8.1f}ms  p95 {lat['p95'] or 0:>8.1f}ms  "
+                    f"p99 {lat['p99'] or 0:>8.1f}ms  err {r['errors']}",
+                    file=sys.stderr,
+                )
+
+        report = {
+            "meta": {
+                "revision": git_revision(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "settings": {
+                    k: v for k, v in vars(args).items() if k not in ("output", "compare", "list")
+                },
+            },
+            "results": results,
+        }
+        text = json.dumps(report, indent=2, ensure_ascii=False)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        if args.compare:
+            compare(results, args.compare)
+        return 0
+    finally:
+        if server is not None:
+            server.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
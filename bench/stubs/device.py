@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+基准测试用的假设备端命令，按调用名（argv[0]）分派：
+input / screencap / uiautomator / am / dumpsys
+
+环境变量：
+    BENCH_LATENCY_MS   每条设备端命令的执行延迟
+    BENCH_SCREEN_SIZE  屏幕尺寸 WxH，默认 1080x2400
+    BENCH_DUMP_NODES   UI 层级节点数，默认 200
+"""
+
+import os
+import struct
+import sys
+import time
+import zlib
+
+
+def screen_size():
+    w, h = os.environ.get("BENCH_SCREEN_SIZE", "1080x2400").split("x")
+    return int(w), int(h)
+
+
+def raw_frame(width, height):
+    # 按行重复的渐变，不同行内容不同，避免被当作全同帧
+    rows = []
+    for y in range(height):
+        v = y % 256
+        rows.append(bytes((v, (v * 3) % 256, 128, 255)) * width)
+    return b"".join(rows)
+
+
+def png_encode(width, height, rgba):
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    stride = width * 4
+    raw = b"".join(b"\x00" + rgba[y * stride:(y + 1) * stride] for y in range(height))
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", ihdr)
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def cmd_screencap(args):
+    width, height = screen_size()
+    rgba = raw_frame(width, height)
+    paths = [a for a in args if not a.startswith("-")]
+    if "-p" in args:
+        data = png_encode(width, height, rgba)
+    else:
+        data = struct.pack("<IIII", width, height, 1, 0) + rgba
+    if paths:
+        with open(paths[0], "wb") as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+
+
+def cmd_uiautomator(args):
+    count = int(os.environ.get("BENCH_DUMP_NODES", "200"))
+    nodes = []
+    for i in range(count):
+        top = (i * 40) % 2400
+        nodes.append(
+            f'<node index="{i}" text="Item {i}" resource-id="com.bench:id/item_{i}" '
+            f'class="android.widget.TextView" package="com.bench" content-desc="" '
+            f'checkable="false" checked="false" clickable="true" enabled="true" '
+            f'focusable="true" focused="false" scrollable="false" long-clickable="false" '
+            f'password="false" selected="false" bounds="[0,{top}][1080,{top + 40}]" />'
+        )
+    xml = (
+        "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>"
+        '<hierarchy rotation="0"><node index="0" text="" resource-id="" '
+        'class="android.widget.FrameLayout" package="com.bench" content-desc="" '
+        'clickable="false" enabled="true" bounds="[0,0][1080,2400]">'
+        + "".join(nodes)
+        + "</node></hierarchy>"
+    )
+    path = args[1] if len(args) > 1 else os.path.join(
+        os.environ.get("BENCH_SDCARD", "/sdcard"), "window_dump.xml"
+    )
+    with open(path, "w") as f:
+        f.write(xml)
+    print(f"UI hierchary dumped to: {path}")
+
+
+def cmd_dumpsys(args):
+    print("  mResumedActivity: ActivityRecord{1 u0 com.bench/.MainActivity t1}")
+
+
+def main():
+    time.sleep(float(os.environ.get("BENCH_LATENCY_MS", "0")) / 1000)
+    name = os.path.basename(sys.argv[0])
+    handler = {
+        "screencap": cmd_screencap,
+        "uiautomator": cmd_uiautomator,
+        "dumpsys": cmd_dumpsys,
+    }.get(name)
+    if handler is not None:
+        handler(sys.argv[1:])
+    # input / am 等只需模拟耗时
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+基准测试用的假 termux-* 命令：延迟 BENCH_TERMUX_LATENCY_MS 后输出
+约 BENCH_OUTPUT_BYTES 字节的 JSON 数组
+"""
+
+import json
+import os
+import sys
+import time
+
+
+def main():
+    time.sleep(float(os.environ.get("BENCH_TERMUX_LATENCY_MS", "0")) / 1000)
+    size = int(os.environ.get("BENCH_OUTPUT_BYTES", "512"))
+    item = {"command": os.path.basename(sys.argv[0]), "value": "x" * 48}
+    count = max(1, size // (len(json.dumps(item)) + 2))
+    json.dump([item] * count, sys.stdout)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,34 @@ import os
 import sys
 import json
 import time
+import queue
+import shlex
+import uuid
+import atexit
+import types
+import tempfile
+import re
 import subprocess
 import threading
+import signal
+import socket
+import sqlite3
+import codecs
+import selectors
 import base64
+import bisect
+import math
+import collections
+import gzip
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import struct
+import io
+import xml.etree.ElementTree as ET
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, has_request_context, request, jsonify, send_file
+from werkzeug.wsgi import ClosingIterator
 import requests
 
 app = Flask(__name__)
@@ -23,266 +46,5263 @@ GITHUB_REPO = "openclaw-glasses/phone-agent"
 CURRENT_VERSION = "v2.0.2"
 
 
+DEFAULT_CONFIG = {
+    "server": {"host": "0.0.0.0", "port": 50001},
+    "adb": {
+        "enabled": True,
+        "wireless_ip": None,
+        "pool": True,
+        "pool_size": 2,
+        "session_timeout": 10,
+    },
+    "autojs": {"enabled": False, "url": "http://127.0.0.1:8088"},
+    "update_interval": None,
+}
+CONFIG_CHECK_INTERVAL = 1.0  # 最多每秒 stat 一次配置文件
+
+
+def _freeze(value):
+    """递归转成只读结构：dict -> MappingProxyType，list -> tuple"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_thaw(v) for v in value]
+    return value
+
+
+class ConfigStore:
+    """
+    配置快照
+
+    读取方直接拿当前不可变快照，不加锁、不读文件；文件 mtime/size/inode
+    变化（最多每 CONFIG_CHECK_INTERVAL 秒检查一次）或显式 reload 时才重新解析。
+    写入走临时文件 + os.replace 原子替换。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stat_key = None
+        self._checked_at = 0.0
+        self.loaded_at = None
+
+    def _stat_key_now(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < CONFIG_CHECK_INTERVAL:
+            return snapshot
+        return self.reload(force=False)
+
+    def reload(self, force=True, strict=False):
+        """
+        重新解析配置文件
+
+        文件读不了或 JSON 不完整（如编辑器正在写入）时保留上一份有效快照并记录错误，
+        下次检查时重试；strict=True 或还没有任何快照时直接抛出。
+        """
+        with self._lock:
+            key = self._stat_key_now()
+            if force or self._snapshot is None or key != self._stat_key:
+                config = DEFAULT_CONFIG
+                try:
+                    if key is not None:
+                        with open(self.path, "r") as f:
+                            config = json.load(f)
+                except (OSError, ValueError) as e:
+                    if strict or self._snapshot is None:
+                        raise
+                    app.logger.error("配置文件解析失败，继续使用上一份配置: %s", e)
+                    self._checked_at = time.monotonic()
+                    return self._snapshot
+                self._snapshot = _freeze(config)
+                self._stat_key = key
+                self.loaded_at = time.time()
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+    def save(self, config):
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                mode = os.stat(self.path).st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            fd, tmp = tempfile.mkstemp(prefix=".config.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(_thaw(config), f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # mkstemp 建的文件是 0600，替换前恢复原文件权限
+                os.chmod(tmp, mode)
+                os.replace(tmp, self.path)
+            except Exception:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        return self.reload()
+
+
+config_store = ConfigStore(CONFIG_FILE)
+
+
 def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
+    """返回当前配置快照（只读，修改请复制后 save_config）"""
+    return config_store.get()
+
+
+def save_config(config):
+    config_store.save(config)
+
+
+# ==================== 指标 ====================
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """进程内的 Prometheus 风格指标：计数器、仪表和直方图，一把锁保护"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {}  # (name, labels) -> [各桶计数..., sum, count]
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, labels=None, delta=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name, labels, seconds):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + (list(extra.items()) if extra else [])
+        if not items:
+            return ""
+        escaped = (
+            f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+            for k, v in items
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self, extra_gauges=()):
+        """生成 Prometheus 文本格式；extra_gauges 为抓取时现算的 (name, labels, value)"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items())
+        gauges += [(self._key(n, l), v) for n, l, v in extra_gauges]
+
+        typed = set()
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in series:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for i, bound in enumerate(METRIC_BUCKETS):
+                lines.append(f"{name}_bucket{self._labels(labels, {'le': bound})} {hist[i]}")
+            lines.append(f"{name}_bucket{self._labels(labels, {'le': '+Inf'})} {hist[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+_TERMUX_COMMAND = re.compile(r"termux-[a-z0-9-]+")
+
+
+def _command_family(cmd, adb=False):
+    """把命令归到有限的几个族，作为指标标签（避免标签基数失控）"""
+    words = cmd.split()
+    if words and words[0] == "adb":
+        adb = True
+        words = words[1:]
+        if words[:1] == ["-s"]:
+            words = words[2:]
+        if words[:1] in (["shell"], ["exec-out"]):
+            words = words[1:]
+    if adb:
+        first = words[0] if words else ""
+        if first == "input":
+            return "adb_input"
+        if first in ("screencap", "uiautomator", "am", "dumpsys"):
+            return f"adb_{first}"
+        return "adb_shell"
+    if words and _TERMUX_COMMAND.fullmatch(words[0]):
+        return words[0]
+    return "exec"
+
+
+def _observe_subprocess(family, spawn=None, total=None, error=None):
+    labels = {"family": family}
+    if spawn is not None:
+        metrics.observe("phone_agent_subprocess_spawn_seconds", labels, spawn)
+    if total is not None:
+        metrics.observe("phone_agent_subprocess_duration_seconds", labels, total)
+    if error == "Timeout":
+        metrics.inc("phone_agent_subprocess_timeouts_total", labels)
+    elif error:
+        metrics.inc("phone_agent_subprocess_errors_total", labels)
+
+
+# ==================== 命令执行 ====================
+
+# helper 进程源码：不加载 Flask 等依赖，常驻后按 argv 直接启动命令（不经过 /bin/sh），
+# 每行一个 JSON 请求，结果按行写回；并发数由信号量限制，超出的请求在 helper 内排队。
+_SPAWNER_SOURCE = r'''
+import json, os, selectors, signal, subprocess, sys, threading, time
+
+limit = threading.Semaphore(int(sys.argv[1]))
+out_lock = threading.Lock()
+state_lock = threading.Lock()
+procs = {}
+cancelled = set()  # 还没启动就被取消的请求
+killed = set()  # 运行中被取消的请求
+
+
+def send(msg):
+    line = (json.dumps(msg) + "\n").encode()
+    with out_lock:
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+
+
+def kill(rid):
+    with state_lock:
+        proc = procs.get(rid)
+        if proc is None:
+            cancelled.add(rid)
+            return
+        killed.add(rid)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def collect(proc, timeout):
+    # 管道和 pidfd 一起 select：communicate(timeout=...) / wait(timeout) 是 sleep 轮询，小命令反而更慢
+    deadline = None if timeout is None else time.monotonic() + timeout
+    chunks = {proc.stdout.fileno(): [], proc.stderr.fileno(): []}
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None  # 老内核：读完输出后轮询等待
+    try:
+        with selectors.DefaultSelector() as sel:
+            for fd in chunks:
+                sel.register(fd, selectors.EVENT_READ)
+            if pidfd is not None:
+                sel.register(pidfd, selectors.EVENT_READ)
+            while sel.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+                for key, _ in sel.select(remaining):
+                    if key.fd == pidfd:
+                        sel.unregister(pidfd)
+                        continue
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        chunks[key.fd].append(data)
+                    else:
+                        sel.unregister(key.fd)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+    remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+    proc.wait(remaining)
+    return b"".join(chunks[proc.stdout.fileno()]), b"".join(chunks[proc.stderr.fileno()])
+
+
+def run(req):
+    rid = req["id"]
+    with limit:
+        started = time.perf_counter()
+        with state_lock:
+            if rid in cancelled:
+                cancelled.discard(rid)
+                send({"id": rid, "error": "Cancelled"})
+                return
+            options = dict(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, cwd=req.get("cwd"), start_new_session=True)
+            try:
+                try:
+                    proc = subprocess.Popen(req["argv"], **options)
+                except FileNotFoundError:
+                    # 不是可执行文件（可能是 shell 函数 / 别名 / 未列出的内建命令）：交给 sh，
+                    # 真不存在时由 sh 给出 127 和错误输出，与 shell=True 一致
+                    if not req.get("shell"):
+                        raise
+                    proc = subprocess.Popen(req["shell"], shell=True, **options)
+            except FileNotFoundError:
+                send({"id": rid, "stdout": "", "stderr": f"sh: {req['argv'][0]}: not found\n",
+                      "returncode": 127, "spawn": time.perf_counter() - started})
+                return
+            except Exception as e:
+                send({"id": rid, "error": str(e)})
+                return
+            procs[rid] = proc
+        spawn = time.perf_counter() - started
+        try:
+            stdout, stderr = collect(proc, req.get("timeout"))
+            msg = {
+                "id": rid,
+                "stdout": stdout.decode("utf-8", "replace"),
+                "stderr": stderr.decode("utf-8", "replace"),
+                "returncode": proc.returncode,
+                "spawn": spawn,
+            }
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            msg = {"id": rid, "error": "Timeout", "spawn": spawn}
+        except Exception as e:
+            # 读输出出错（如 fd 耗尽）：结束进程组，仍然给调用方一个答复
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            msg = {"id": rid, "error": f"{type(e).__name__}: {e}", "spawn": spawn}
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+            with state_lock:
+                procs.pop(rid, None)
+                if rid in killed:
+                    killed.discard(rid)
+                    msg = {"id": rid, "error": "Cancelled", "spawn": spawn}
+        send(msg)
+
+
+for line in sys.stdin.buffer:
+    req = json.loads(line)
+    if "kill" in req:
+        kill(req["kill"])
+    else:
+        threading.Thread(target=run, args=(req,), daemon=True).start()
+'''
+
+# 需要 shell 才能正确执行的写法：管道、重定向、变量、通配符、命令串联、注释等
+_SHELL_SYNTAX = re.compile(r"[|&;<>()$`*?\[\]{}~#\\\n]")
+# POSIX 特殊内建、依赖 shell 状态的常规内建、mksh / bash 扩展内建，以及保留字：
+# 直接 exec 会找不到程序或行为不同，交给 sh
+_SHELL_BUILTINS = {
+    ".", ":", "break", "continue", "eval", "exec", "exit", "export", "readonly", "return",
+    "set", "shift", "times", "trap", "unset",
+    "alias", "bg", "cd", "command", "fc", "fg", "getopts", "hash", "jobs", "read", "type",
+    "ulimit", "umask", "unalias", "wait",
+    "bind", "builtin", "declare", "disown", "let", "local", "print", "realpath", "rename",
+    "source", "suspend", "typeset", "whence",
+    "case", "do", "done", "elif", "else", "esac", "fi", "for", "function", "if", "in",
+    "select", "then", "time", "until", "while", "[[", "]]",
+}
+SPAWNER_GRACE = 10  # 等待 helper 返回结果的额外秒数
+
+
+def _command_argv(cmd):
+    """
+    把简单命令字符串拆成 argv；含 shell 语法、内建命令、开头的 ! 或 VAR=x 前缀时返回 None，
+    仍交给 /bin/sh 执行（语义与 shell=True 一致）。
+    """
+    if _SHELL_SYNTAX.search(cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not argv or argv[0] in _SHELL_BUILTINS or "=" in argv[0] or argv[0].startswith("!"):
+        return None
+    return argv
+
+
+class Spawner:
+    """
+    常驻的轻量 helper 进程，代替从 Flask 进程 fork + /bin/sh 启动命令
+
+    Flask 进程内存大，每条命令都要 fork 一次再 exec sh、再 exec 目标程序；
+    helper 是只加载标准库的小解释器，按 argv 直接启动目标程序。
+    helper 意外退出时挂起的请求返回错误，下次调用自动重启。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proc = None
+        self.pending = {}  # id -> {"done": Event, "result": dict}
+        self.started_at = None
+        self.restarts = 0
+
+    def enabled(self):
+        return load_config().get("spawner", {}).get("enabled", True)
+
+    def _ensure_locked(self):
+        if self.proc is not None and self.proc.poll() is None:
+            return self.proc
+        if self.proc is not None:
+            self.restarts += 1
+        limit = int(load_config().get("spawner", {}).get("max_concurrency", 8))
+        self.proc = subprocess.Popen(
+            [sys.executable, "-S", "-c", _SPAWNER_SOURCE, str(max(1, limit))],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.started_at = time.time()
+        threading.Thread(target=self._reader, args=(self.proc,), daemon=True).start()
+        return self.proc
+
+    def _reader(self, proc):
+        for line in proc.stdout:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            with self.lock:
+                slot = self.pending.pop(msg.get("id"), None)
+            if slot is not None:
+                slot["result"] = msg
+                slot["done"].set()
+        # helper 退出：属于它的挂起请求全部失败
+        with self.lock:
+            lost = [(rid, s) for rid, s in self.pending.items() if s["proc"] is proc]
+            for rid, _ in lost:
+                del self.pending[rid]
+        for _, slot in lost:
+            slot["result"] = {"error": "Spawner exited"}
+            slot["done"].set()
+
+    def _send_locked(self, msg):
+        proc = self._ensure_locked()
+        proc.stdin.write((json.dumps(msg) + "\n").encode())
+        proc.stdin.flush()
+        return proc
+
+    def run(self, argv, timeout=None, rid=None, cwd=None, shell=None):
+        """
+        执行 argv，返回 helper 的结果 dict（stdout / stderr / returncode / spawn 或 error）
+
+        shell 为原始命令字符串：argv[0] 不是可执行文件时 helper 改用 sh 执行它
+        """
+        rid = rid or uuid.uuid4().hex
+        slot = {"done": threading.Event(), "result": None, "proc": None}
+        msg = {"id": rid, "argv": list(argv), "timeout": timeout, "cwd": cwd, "shell": shell}
+        with self.lock:
+            self.pending[rid] = slot
+            try:
+                slot["proc"] = self._send_locked(msg)
+            except (OSError, ValueError):
+                # 管道已断（helper 刚退出），重启后重试一次
+                self.proc = None
+                try:
+                    slot["proc"] = self._send_locked(msg)
+                except (OSError, ValueError) as e:
+                    self.pending.pop(rid, None)
+                    return {"error": f"Spawner unavailable: {e}"}
+        wait = None if timeout is None else timeout + SPAWNER_GRACE
+        if not slot["done"].wait(wait):
+            self.kill(rid)
+            with self.lock:
+                self.pending.pop(rid, None)
+            return {"error": "Timeout"}
+        return slot["result"]
+
+    def kill(self, rid):
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                return
+            try:
+                self._send_locked({"kill": rid})
+            except (OSError, ValueError):
+                pass
+
+    def status(self):
+        with self.lock:
+            running = self.proc is not None and self.proc.poll() is None
+            return {
+                "running": running,
+                "pid": self.proc.pid if running else None,
+                "pending": len(self.pending),
+                "restarts": self.restarts,
+                "started_at": self.started_at,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.proc is not None and self.proc.poll() is None:
+                try:
+                    self.proc.stdin.close()
+                except OSError:
+                    pass
+
+
+spawner = Spawner()
+atexit.register(spawner.close)
+
+
+def _spawner_result(family, result, started):
+    """把 helper 的结果转换成 run_cmd 的返回格式并记录指标"""
+    total = time.perf_counter() - started
+    error = result.get("error")
+    _observe_subprocess(family, result.get("spawn"), total, error)
+    if error:
+        return {"success": False, "error": error}
+    return {"success": True, "stdout": result["stdout"], "stderr": result["stderr"]}
+
+
+def run_cmd(cmd, timeout=10):
+    job = getattr(_job_local, "job", None)
+    if job is not None:
+        # 后台任务中执行：需要能被取消，走可中断的实现
+        return job.run_cmd(cmd, timeout)
+    family = _command_family(cmd)
+    started = time.perf_counter()
+    argv = _command_argv(cmd) if spawner.enabled() else None
+    if argv is not None:
+        return _spawner_result(family, spawner.run(argv, timeout, shell=cmd), started)
+    try:
+        proc = subprocess.Popen(
+            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        spawned = time.perf_counter()
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            _observe_subprocess(family, spawned - started, time.perf_counter() - started, "Timeout")
+            return {"success": False, "error": "Timeout"}
+        _observe_subprocess(family, spawned - started, time.perf_counter() - started)
+        return {"success": True, "stdout": stdout, "stderr": stderr}
+    except Exception as e:
+        _observe_subprocess(family, error=str(e))
+        return {"success": False, "error": str(e)}
+
+
+# ==================== ADB 常驻 shell 会话池 ====================
+
+
+class AdbShellSession:
+    """
+    常驻的 `adb shell sh` 会话
+
+    命令通过 stdin 写入，每条命令后输出带随机 token 的哨兵行，
+    据此从 stdout / stderr 中切分出该命令的输出和退出码。
+    """
+
+    def __init__(self, serial=None):
+        self.serial = serial
+        self.proc = None
+        self.created_at = None
+        self.commands = 0
+        self._stdout_q = None
+        self._stderr_q = None
+
+    def _argv(self):
+        argv = ["adb"]
+        if self.serial:
+            argv += ["-s", self.serial]
+        return argv + ["shell", "sh"]
+
+    def start(self):
+        started = time.perf_counter()
+        self.proc = subprocess.Popen(
+            self._argv(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        _observe_subprocess("adb_session", spawn=time.perf_counter() - started)
+        self.created_at = time.time()
+        self._stdout_q = queue.Queue()
+        self._stderr_q = queue.Queue()
+        for stream, q in ((self.proc.stdout, self._stdout_q), (self.proc.stderr, self._stderr_q)):
+            threading.Thread(target=self._pump, args=(stream, q), daemon=True).start()
+
+    @staticmethod
+    def _pump(stream, q):
+        for line in iter(stream.readline, b""):
+            q.put(line)
+        q.put(None)
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=2)
+        except Exception:
+            pass
+        self.proc = None
+
+    def _read_until(self, q, marker, deadline, on_line=None):
+        """读取到哨兵行为止，返回 (输出, 哨兵行剩余部分, 是否 EOF)"""
+        chunks = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self._argv(), 0)
+            try:
+                line = q.get(timeout=remaining)
+            except queue.Empty:
+                raise subprocess.TimeoutExpired(self._argv(), 0)
+            if line is None:
+                return b"".join(chunks), None, True
+            idx = line.find(marker)
+            if idx >= 0:
+                # 命令输出末尾没有换行时，哨兵会接在最后一行后面
+                chunks.append(line[:idx])
+                return b"".join(chunks), line[idx + len(marker):], False
+            if on_line is not None:
+                on_line(line)
+            chunks.append(line)
+
+    def run(self, cmd, timeout=10, on_line=None):
+        """执行一条 shell 命令，返回与 run_cmd 相同结构的 dict"""
+        if not self.alive():
+            self.start()
+        marker = f"__PA_{uuid.uuid4().hex}__".encode()
+        # 用 sh -c 隔离：命令中的 exit / 语法错误 / 读 stdin 都不会破坏会话
+        script = (
+            f"sh -c {shlex.quote(cmd)} </dev/null\n"
+            f"echo \"{marker.decode()}$?\"\n"
+            f"echo \"{marker.decode()}\" >&2\n"
+        )
+        self.commands += 1
+        deadline = time.monotonic() + timeout
+        self.proc.stdin.write(script.encode())
+        self.proc.stdin.flush()
+
+        stdout, rest, eof = self._read_until(self._stdout_q, marker, deadline, on_line)
+        if eof:
+            # 会话意外退出（设备断开 / reboot 等），尽量收集 stderr
+            stderr, _, _ = self._read_until(self._stderr_q, marker, time.monotonic() + 1)
+            self.close()
+            return {
+                "success": True,
+                "stdout": stdout.decode("utf-8", "replace"),
+                "stderr": stderr.decode("utf-8", "replace"),
+            }
+        stderr, _, _ = self._read_until(self._stderr_q, marker, deadline)
+        result = {
+            "success": True,
+            "stdout": stdout.decode("utf-8", "replace"),
+            "stderr": stderr.decode("utf-8", "replace"),
+        }
+        try:
+            result["returncode"] = int(rest.strip())
+        except ValueError:
+            pass
+        return result
+
+
+class AdbShellPool:
+    """按设备维护的常驻 shell 会话池，会话死亡后自动重建"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}  # serial -> [AdbShellSession]
+        self._count = {}  # serial -> 已创建会话数
+        self._cond = threading.Condition(self._lock)
+
+    def _acquire(self, serial, size, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                idle = self._idle.setdefault(serial, [])
+                while idle:
+                    session = idle.pop()
+                    if session.alive():
+                        return session
+                    session.close()
+                    self._count[serial] -= 1
+                if self._count.get(serial, 0) < size:
+                    self._count[serial] = self._count.get(serial, 0) + 1
+                    return AdbShellSession(serial)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired("adb shell", timeout)
+                self._cond.wait(remaining)
+
+    def _release(self, serial, session):
+        with self._cond:
+            if session.alive():
+                self._idle[serial].append(session)
+            else:
+                session.close()
+                self._count[serial] -= 1
+            self._cond.notify()
+
+    def run(self, serial, cmd, timeout=10, size=2, on_line=None):
+        family = _command_family(cmd, adb=True)
+        started = time.perf_counter()
+        try:
+            session = self._acquire(serial, size, timeout)
+        except subprocess.TimeoutExpired:
+            _observe_subprocess(family, error="Timeout")
+            return {"success": False, "error": "Timeout"}
+        result = None
+        try:
+            result = session.run(cmd, timeout, on_line=on_line)
+            return result
+        except subprocess.TimeoutExpired:
+            session.close()
+            result = {"success": False, "error": "Timeout"}
+            return result
+        except Exception as e:
+            session.close()
+            result = {"success": False, "error": str(e)}
+            return result
+        finally:
+            self._release(serial, session)
+            _observe_subprocess(
+                family, total=time.perf_counter() - started, error=(result or {}).get("error")
+            )
+
+    def status(self):
+        with self._lock:
+            return {
+                serial or "default": {
+                    "sessions": self._count.get(serial, 0),
+                    "idle": len(idle),
+                }
+                for serial, idle in self._idle.items()
+            }
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for session in idle:
+                    session.close()
+            self._idle.clear()
+            self._count.clear()
+
+
+adb_pool = AdbShellPool()
+atexit.register(adb_pool.close_all)
+
+
+# ==================== 多设备队列 ====================
+
+
+DEVICE_QUEUE_IDLE = 60  # 队列空闲多久后回收工作线程（秒）
+DEVICE_QUEUE_GRACE = 5  # 命令自身超时之外，等待结果的额外余量（秒）
+DEVICE_LIST_TTL = 5  # 已连接设备列表的缓存时间（秒）
+
+
+class DeviceQueue:
+    """
+    单台设备的有序命令队列
+
+    只有会改变设备状态的命令（输入事件、启动 Activity、批量脚本）经过这里：
+    一个工作线程串行执行，先按请求的准入优先级、同优先级按提交顺序，保证发往同一台手机的输入事件不乱序，
+    也不会排在 /api/adb 这类低优先级命令后面；
+    dump、getevent、文件读取等只读命令直接走会话池，不在这里排队。
+    不同设备各有自己的队列，互不阻塞；空闲的队列由 DeviceFleet 回收。
+    """
+
+    def __init__(self, serial, fleet):
+        self.serial = serial
+        self.fleet = fleet
+        self.q = queue.PriorityQueue()  # (优先级, 序号, (fn, box, done))
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.commands = 0
+        self.errors = 0
+        self.last_latency_ms = None
+        self.last_seen = None
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            try:
+                _, _, (fn, box, done) = self.q.get(timeout=DEVICE_QUEUE_IDLE)
+            except queue.Empty:
+                if self.fleet._reap(self):
+                    return
+                continue
+            with self.lock:
+                cancelled = box.get("cancelled", False)
+                box["started"] = True
+            if cancelled:
+                with self.lock:
+                    self.pending -= 1
+                continue
+            started = time.monotonic()
+            try:
+                box["result"] = fn()
+            except Exception as e:
+                box["error"] = e
+            elapsed = (time.monotonic() - started) * 1000
+            with self.lock:
+                self.pending -= 1
+                self.commands += 1
+                self.last_latency_ms = round(elapsed, 1)
+                result = box.get("result")
+                if isinstance(result, dict) and result.get("success"):
+                    self.last_seen = time.time()
+                else:
+                    self.errors += 1
+            done.set()
+
+    def submit(self, fn, priority=0):
+        """入队（调用方已在 DeviceFleet 锁内登记过 pending），返回 (box, done)"""
+        box, done = {}, threading.Event()
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        self.q.put((priority, seq, (fn, box, done)))
+        return box, done
+
+    def wait(self, box, done, timeout):
+        """
+        等待结果：排队和执行总共最多 timeout 秒
+
+        超时仍未开始执行的命令被取消；已开始的命令由其自身超时兜底，这里直接返回错误。
+        """
+        if not done.wait(timeout):
+            with self.lock:
+                started = box.get("started", False)
+                box["cancelled"] = True
+            error = "Timeout" if started else "Timeout waiting in device queue"
+            return {"success": False, "error": error}
+        if "error" in box:
+            raise box["error"]
+        return box["result"]
+
+    def status(self):
+        with self.lock:
+            return {
+                "queue_depth": self.pending,
+                "commands": self.commands,
+                "errors": self.errors,
+                "last_latency_ms": self.last_latency_ms,
+                "last_seen": self.last_seen,
+            }
+
+
+class DeviceFleet:
+    """按设备序列号管理命令队列；只为已连接的设备建队列，空闲队列自动回收"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.known = set()
+        self.known_at = 0.0
+
+    def known_device(self, serial):
+        """serial 是否为当前已连接的设备（未指定设备或配置中的无线地址总是放行）"""
+        if not serial or serial == load_config()["adb"].get("wireless_ip"):
+            return True
+        now = time.monotonic()
+        with self.lock:
+            if serial in self.known and now - self.known_at < DEVICE_LIST_TTL:
+                return True
+            # 未知序列号最多每秒刷新一次设备列表，防止无效请求反复调用 adb devices
+            if serial not in self.known and now - self.known_at < 1.0:
+                return False
+        serials = {d["serial"] for d in discover_devices() if d["state"] == "device"}
+        with self.lock:
+            self.known, self.known_at = serials, time.monotonic()
+        return serial in serials
+
+    def run(self, serial, fn, timeout=None):
+        """在 serial 的队列里按顺序执行 fn；timeout 为命令自身的超时"""
+        if not self.known_device(serial):
+            return {"success": False, "error": f"Device not found: {serial}"}
+        if timeout is None:
+            timeout = load_config()["adb"].get("session_timeout", 10)
+        with self.lock:
+            q = self.queues.get(serial)
+            if q is None:
+                q = self.queues[serial] = DeviceQueue(serial, self)
+            with q.lock:
+                q.pending += 1
+        box, done = q.submit(fn, _queue_priority())
+        queue_timeout = load_config()["adb"].get("queue_timeout", 30)
+        return q.wait(box, done, queue_timeout + timeout + DEVICE_QUEUE_GRACE)
+
+    def _reap(self, q):
+        """工作线程空闲超时后调用：没有待执行命令时把队列摘掉，返回是否已回收"""
+        with self.lock:
+            with q.lock:
+                if q.pending:
+                    return False
+            if self.queues.get(q.serial) is q:
+                del self.queues[q.serial]
+            return True
+
+    def status(self):
+        with self.lock:
+            queues = dict(self.queues)
+        return {serial or "default": q.status() for serial, q in queues.items()}
+
+
+fleet = DeviceFleet()
+
+
+def discover_devices():
+    """解析 `adb devices -l`，返回 [{serial, state, model, ...}]"""
+    result = run_cmd("adb devices -l", timeout=5)
+    devices = []
+    for line in result.get("stdout", "").splitlines()[1:]:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        device = {"serial": parts[0], "state": parts[1]}
+        for part in parts[2:]:
+            if ":" in part:
+                key, value = part.split(":", 1)
+                device[key] = value
+        devices.append(device)
+    return devices
+
+
+def _resolve_device(device=None):
+    """未指定设备时使用配置中的 wireless_ip（为空则交给 adb 选默认设备）"""
+    return device or load_config()["adb"]["wireless_ip"]
+
+
+def _request_device():
+    """从查询参数或 JSON 请求体中取 device（设备序列号）"""
+    device = request.args.get("device")
+    if device is None and request.is_json:
+        device = (request.get_json(silent=True) or {}).get("device")
+    return device or None
+
+
+def _adb_prefix(serial):
+    if serial:
+        return f"adb -s {shlex.quote(serial)} "
+    return "adb "
+
+
+def adb_shell(cmd, timeout=None, on_line=None, device=None, ordered=False):
+    """
+    在设备上执行一段 shell 脚本（cmd 按设备端 sh 语法解析）
+
+    on_line: 可选回调，按行收到 stdout（bytes），用于批量执行时实时切分各步结果
+    device: 设备序列号，默认取配置
+    ordered: 会改变设备状态的命令（输入事件等）置 True，经设备队列按提交顺序执行；
+             只读命令直接在会话池中并发执行，不排在输入事件前面
+    """
+    adb_conf = load_config()["adb"]
+    serial = _resolve_device(device)
+    if timeout is None:
+        timeout = adb_conf.get("session_timeout", 10)
+    if adb_conf.get("pool", True):
+        def fn():
+            return adb_pool.run(
+                serial,
+                cmd,
+                timeout=timeout,
+                size=adb_conf.get("pool_size", 2),
+                on_line=on_line,
+            )
+    else:
+        def fn():
+            return run_cmd(f"{_adb_prefix(serial)}shell {shlex.quote(cmd)}", timeout)
+
+    if ordered:
+        result = fleet.run(serial, fn, timeout)
+    elif not fleet.known_device(serial):
+        result = {"success": False, "error": f"Device not found: {serial}"}
+    else:
+        result = fn()
+    if adb_conf.get("pool", True):
+        return result
+    if on_line is not None:
+        for line in result.get("stdout", "").splitlines(keepends=True):
+            on_line(line.encode())
+    return result
+
+
+def adb_exec_out(args, timeout=None, device=None):
+    """
+    执行 `adb exec-out <args>`，原样返回二进制 stdout（不经 shell 会话池、不落盘）
+
+    只读采集不进设备队列，避免截图/推流拖慢输入事件。
+    返回 {"success", "data", "stderr"}，失败时 {"success": False, "error"}
+    """
+    adb_conf = load_config()["adb"]
+    serial = _resolve_device(device)
+    if not fleet.known_device(serial):
+        return {"success": False, "error": f"Device not found: {serial}"}
+    argv = ["adb"]
+    if serial:
+        argv += ["-s", serial]
+    argv += ["exec-out"] + list(args)
+    family = _command_family(" ".join(args), adb=True)
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(
+            argv,
+            capture_output=True,
+            timeout=timeout or adb_conf.get("session_timeout", 10),
+        )
+    except subprocess.TimeoutExpired:
+        _observe_subprocess(family, total=time.perf_counter() - started, error="Timeout")
+        return {"success": False, "error": "Timeout"}
+    except Exception as e:
+        _observe_subprocess(family, error=str(e))
+        return {"success": False, "error": str(e)}
+    _observe_subprocess(family, total=time.perf_counter() - started)
+    if result.returncode != 0:
+        return {"success": False, "error": result.stderr.decode("utf-8", "replace")}
     return {
-        "server": {"host": "0.0.0.0", "port": 50001},
-        "adb": {"enabled": True, "wireless_ip": None},
-        "autojs": {"enabled": False, "url": "http://127.0.0.1:8088"},
-        "update_interval": None,
+        "success": True,
+        "data": result.stdout,
+        "stderr": result.stderr.decode("utf-8", "replace"),
     }
 
 
-def save_config(config):
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=2)
+# 会改变界面的命令：执行后 UI 层级缓存失效；getprop / dumpsys 等只读命令不影响缓存
+_UI_MUTATING = re.compile(r"shell\s+(input|am\s+start|monkey)\b")
+
+
+def adb_cmd(cmd, device=None):
+    mutating = bool(_UI_MUTATING.match(cmd))
+    if mutating:
+        _invalidate_ui_cache(device)
+    config = load_config()
+    adb_conf = config["adb"]
+    # shell 子命令走常驻会话池，省去每次启动 adb 客户端和新建设备 shell 的开销
+    if adb_conf.get("pool", True) and cmd.startswith("shell "):
+        return adb_shell(cmd[len("shell "):], device=device, ordered=mutating)
+    serial = _resolve_device(device)
+    if mutating:
+        return fleet.run(serial, lambda: run_cmd(f"{_adb_prefix(serial)}{cmd}"))
+    if not fleet.known_device(serial):
+        return {"success": False, "error": f"Device not found: {serial}"}
+    return run_cmd(f"{_adb_prefix(serial)}{cmd}")
+
+
+# ==================== 请求指标 ====================
+
+
+@app.before_request
+def _metrics_before_request():
+    g.metrics_started = time.perf_counter()
+    metrics.gauge_add("phone_agent_http_requests_in_flight")
+
+
+@app.after_request
+def _metrics_after_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # 流式响应此处只统计到首字节
+    metrics.observe(
+        "phone_agent_http_request_duration_seconds",
+        {"route": route, "method": request.method},
+        time.perf_counter() - started,
+    )
+    metrics.inc(
+        "phone_agent_http_requests_total",
+        {"route": route, "method": request.method, "status": response.status_code},
+    )
+    if route.startswith("/api/file/"):
+        if request.content_length:
+            metrics.inc(
+                "phone_agent_file_bytes_total",
+                {"route": route, "direction": "in"},
+                request.content_length,
+            )
+        if response.content_length:
+            metrics.inc(
+                "phone_agent_file_bytes_total",
+                {"route": route, "direction": "out"},
+                response.content_length,
+            )
+    return response
+
+
+@app.teardown_request
+def _metrics_teardown_request(exc):
+    metrics.gauge_add("phone_agent_http_requests_in_flight", delta=-1)
+    if exc is not None:
+        metrics.inc("phone_agent_http_exceptions_total")
+
+
+@app.route("/api/metrics")
+def api_metrics():
+    """Prometheus 文本格式指标"""
+    extra = []
+    for name, value in job_manager.stats().items():
+        if name != "workers":
+            extra.append(("phone_agent_jobs", {"state": name}, value))
+    for serial, info in fleet.status().items():
+        extra.append(("phone_agent_device_queue_depth", {"device": serial}, info["queue_depth"]))
+    for serial, info in adb_pool.status().items():
+        extra.append(("phone_agent_adb_sessions", {"device": serial}, info["sessions"]))
+    spawn = spawner.status()
+    extra.append(("phone_agent_spawner_pending", {}, spawn["pending"]))
+    extra.append(("phone_agent_spawner_restarts", {}, spawn["restarts"]))
+    for name, info in admission.status()["classes"].items():
+        extra.append(("phone_agent_admission_active", {"class": name}, info["active"]))
+        extra.append(("phone_agent_admission_queued", {"class": name}, info["queued"]))
+    return Response(
+        metrics.render(extra), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# ==================== 准入控制 ====================
+
+# 各类请求的默认限额；priority 越小越先调度，timeout_ms 为排队等待上限
+ADMISSION_CLASSES = {
+    "input": {"priority": 0, "concurrency": 4, "queue": 64, "timeout_ms": 2000},
+    "ui": {"priority": 1, "concurrency": 2, "queue": 16, "timeout_ms": 15000},
+    "file": {"priority": 2, "concurrency": 3, "queue": 32, "timeout_ms": 30000},
+    "shell": {"priority": 2, "concurrency": 4, "queue": 32, "timeout_ms": 30000},
+    # 屏幕流整个观看期间占一个名额；多个观看者共用采集管线，满了直接 429，不排队
+    "stream": {"priority": 1, "concurrency": 4, "queue": 0, "timeout_ms": 5000},
+}
+
+ADMISSION_ROUTES = {
+    "/api/adb/tap": "input",
+    "/api/adb/swipe": "input",
+    "/api/adb/input": "input",
+    "/api/adb/key": "input",
+    "/api/adb/start": "input",
+    "/api/adb/gesture": "input",
+    "/api/adb/batch": "input",
+    "/api/macros/<name>/play": "input",
+    "/api/adb/screenshot": "ui",
+    "/api/adb/dump": "ui",
+    "/api/adb/stream": "stream",
+    "/api/exec": "shell",
+    "/api/termux": "shell",
+    "/api/adb": "shell",
+}
+ADMISSION_PREFIXES = (
+    ("/api/ui/", "ui"),
+    ("/api/screen/", "ui"),
+    ("/api/file/", "file"),
+)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    按请求类别限制并发，超出时排队
+
+    所有类别共享 max_concurrency 个执行名额，其中 reserved 个只留给 priority 为 0 的类别
+    （输入事件），大文件传输、dump 再多也占不满。名额空出时按 priority、再按到达顺序放行。
+    队列满立即 429；排队超过截止时间，或按平均耗时估算等不到截止时间的，返回 503。
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiters = []  # [(priority, seq, waiter)]，保持有序
+        self.seq = 0
+        self.active = collections.Counter()
+        self.total_active = 0
+        self.stats = collections.defaultdict(
+            lambda: {"admitted": 0, "rejected": 0, "expired": 0, "wait": 0.0, "service": 0.0}
+        )
+
+    @staticmethod
+    def _conf():
+        conf = load_config().get("admission", {})
+        classes = {}
+        for name, defaults in ADMISSION_CLASSES.items():
+            classes[name] = {**defaults, **conf.get("classes", {}).get(name, {})}
+        return conf, classes
+
+    def _can_run(self, name, limits, conf):
+        max_total = conf.get("max_concurrency", 8)
+        if limits["priority"] > 0:
+            max_total -= conf.get("reserved", 2)
+        return self.active[name] < limits["concurrency"] and self.total_active < max_total
+
+    def _dispatch(self, conf, classes):
+        """按优先级把空出的名额分给排队者（调用方持锁）"""
+        granted = False
+        for entry in list(self.waiters):
+            waiter = entry[2]
+            if self._can_run(waiter["name"], classes[waiter["name"]], conf):
+                self.waiters.remove(entry)
+                self.active[waiter["name"]] += 1
+                self.total_active += 1
+                waiter["granted"] = True
+                granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def _retry_after(self, name, limits):
+        """按该类排队人数和平均处理耗时估算需要等多久（秒）"""
+        queued = sum(1 for entry in self.waiters if entry[2]["name"] == name)
+        estimate = (queued + 1) * self.stats[name]["service"] / max(1, limits["concurrency"])
+        return max(1, min(60, math.ceil(estimate)))
+
+    def _reject(self, name, limits, status, reason, counter):
+        self.stats[name][counter] += 1
+        metrics.inc("phone_agent_admission_rejected_total", {"class": name, "reason": counter})
+        return AdmissionRejected(status, reason, self._retry_after(name, limits))
+
+    def acquire(self, name, deadline_ms=None):
+        """取得一个执行名额，返回 ticket；被拒绝时抛 AdmissionRejected"""
+        conf, classes = self._conf()
+        limits = classes[name]
+        timeout = limits["timeout_ms"] / 1000
+        if deadline_ms is not None:
+            timeout = min(timeout, max(0.0, deadline_ms / 1000))
+        started = time.monotonic()
+        deadline = started + timeout
+        waiter = {"name": name, "granted": False}
+        with self.cond:
+            self.seq += 1
+            bisect.insort(self.waiters, (limits["priority"], self.seq, waiter))
+            self._dispatch(conf, classes)
+            if not waiter["granted"]:
+                queued = sum(1 for entry in self.waiters if entry[2]["name"] == name)
+                reason = None
+                if queued > limits["queue"]:
+                    reason = (429, "Queue full", "rejected")
+                elif queued * self.stats[name]["service"] / limits["concurrency"] > timeout:
+                    reason = (503, "Deadline unreachable", "rejected")
+                while reason is None and not waiter["granted"]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        reason = (503, "Deadline exceeded while queued", "expired")
+                        break
+                    self.cond.wait(remaining)
+                if reason is not None and not waiter["granted"]:
+                    self.waiters = [e for e in self.waiters if e[2] is not waiter]
+                    raise self._reject(name, limits, *reason)
+            stats = self.stats[name]
+            waited = time.monotonic() - started
+            stats["admitted"] += 1
+            stats["wait"] += (waited - stats["wait"]) * 0.2
+        metrics.observe("phone_agent_admission_wait_seconds", {"class": name}, waited)
+        return {"name": name, "priority": limits["priority"], "started": time.monotonic()}
+
+    def release(self, ticket):
+        conf, classes = self._conf()
+        with self.cond:
+            name = ticket["name"]
+            self.active[name] -= 1
+            self.total_active -= 1
+            stats = self.stats[name]
+            stats["service"] += (time.monotonic() - ticket["started"] - stats["service"]) * 0.2
+            self._dispatch(conf, classes)
+
+    def status(self):
+        conf, classes = self._conf()
+        with self.cond:
+            queued = collections.Counter(entry[2]["name"] for entry in self.waiters)
+            return {
+                "enabled": conf.get("enabled", True),
+                "max_concurrency": conf.get("max_concurrency", 8),
+                "reserved": conf.get("reserved", 2),
+                "active": self.total_active,
+                "classes": {
+                    name: {
+                        **limits,
+                        "active": self.active[name],
+                        "queued": queued[name],
+                        "admitted": self.stats[name]["admitted"],
+                        "rejected": self.stats[name]["rejected"],
+                        "expired": self.stats[name]["expired"],
+                        "avg_wait_ms": round(self.stats[name]["wait"] * 1000, 1),
+                        "avg_service_ms": round(self.stats[name]["service"] * 1000, 1),
+                    }
+                    for name, limits in classes.items()
+                },
+            }
+
+
+admission = Admission()
+
+
+def _admission_class():
+    if request.url_rule is None:
+        return None
+    rule = request.url_rule.rule
+    if rule in ADMISSION_ROUTES:
+        return ADMISSION_ROUTES[rule]
+    for prefix, name in ADMISSION_PREFIXES:
+        if rule.startswith(prefix):
+            return name
+    return None
+
+
+@app.before_request
+def _admission_before_request():
+    """按路由类别排队；客户端可用 X-Deadline-Ms 头给出本次请求愿意等待的毫秒数"""
+    if not load_config().get("admission", {}).get("enabled", True):
+        return None
+    name = _admission_class()
+    if name is None:
+        return None
+    deadline_ms = request.headers.get("X-Deadline-Ms")
+    try:
+        deadline_ms = float(deadline_ms) if deadline_ms else None
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid X-Deadline-Ms"}), 400
+    try:
+        g.admission_ticket = admission.acquire(name, deadline_ms)
+    except AdmissionRejected as e:
+        response = jsonify(
+            {"success": False, "error": e.reason, "class": name, "retry_after": e.retry_after}
+        )
+        response.status_code = e.status
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+    return None
+
+
+@app.after_request
+def _admission_after_request(response):
+    """
+    流式响应（下载、导出、流式 exec / termux、清单流、屏幕流）发送完毕后才释放名额
+
+    名额挂在响应体的迭代器上：send_file 的 direct_passthrough 响应会被 werkzeug 原样交给服务器，
+    不经过 call_on_close，只有包一层 ClosingIterator 才能保证连接关闭时释放。
+    """
+    if response.is_streamed or response.direct_passthrough:
+        ticket = g.pop("admission_ticket", None)
+        if ticket is not None:
+            response.response = ClosingIterator(
+                response.response, lambda: admission.release(ticket)
+            )
+            response.direct_passthrough = False
+    return response
+
+
+@app.teardown_request
+def _admission_teardown_request(exc):
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        admission.release(ticket)
+
+
+def _queue_priority():
+    """
+    命令在设备队列里的优先级：取本次请求的准入类别（准入关闭时按路由推断），
+    WebSocket 控制通道、后台任务等没有类别的调用按输入事件处理
+    """
+    if not has_request_context():
+        return 0
+    ticket = g.get("admission_ticket")
+    if ticket is not None:
+        return ticket["priority"]
+    name = _admission_class()
+    if name is None:
+        return 0
+    return Admission._conf()[1][name]["priority"]
+
+
+@app.route("/api/admission")
+def api_admission():
+    """各类别的并发、排队和拒绝统计"""
+    return jsonify({"success": True, **admission.status()})
+
+
+# ==================== 响应压缩与二进制编码 ====================
+
+COMPRESSIBLE_MIMETYPES = (
+    "application/json",
+    "application/xml",
+    "application/msgpack",
+    "application/cbor",
+    "text/",
+)
+BINARY_MIMETYPES = {
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/cbor": "cbor",
+}
+
+
+def _binary_codec(name):
+    """返回 (dumps, loads)；msgpack / cbor2 为可选依赖，未安装时返回 None"""
+    try:
+        if name == "msgpack":
+            import msgpack
+
+            return (
+                lambda obj: msgpack.packb(obj, use_bin_type=True),
+                lambda raw: msgpack.unpackb(raw, raw=False),
+            )
+        if name == "cbor":
+            import cbor2
+
+            return cbor2.dumps, cbor2.loads
+    except ImportError:
+        pass
+    return None
+
+
+def _response_encoding():
+    """按 Accept 协商响应编码：json（默认）/ msgpack / cbor"""
+    best = request.accept_mimetypes.best_match(["application/json", *BINARY_MIMETYPES])
+    name = BINARY_MIMETYPES.get(best)
+    if name and _binary_codec(name):
+        return name
+    return "json"
+
+
+def _respond(payload, code=200):
+    """
+    按协商结果编码响应体
+
+    二进制编码下 payload 中的 bytes 原样输出（不做 base64）；
+    JSON 下调用方应只放可 JSON 序列化的值。
+    """
+    encoding = _response_encoding()
+    if encoding == "json":
+        return jsonify(payload), code
+    dumps, _ = _binary_codec(encoding)
+    started = time.perf_counter()
+    body = dumps(payload)
+    metrics.observe("phone_agent_encode_seconds", {"kind": encoding}, time.perf_counter() - started)
+    mimetype = "application/msgpack" if encoding == "msgpack" else "application/cbor"
+    return Response(body, status=code, mimetype=mimetype)
+
+
+def _request_payload():
+    """读取请求体：Content-Type 为 msgpack / cbor 时按二进制解码，否则按 JSON"""
+    name = BINARY_MIMETYPES.get(request.mimetype)
+    if name:
+        codec = _binary_codec(name)
+        if codec is None:
+            raise ValueError(f"{name} not installed on server")
+        data = codec[1](request.get_data())
+        return data if isinstance(data, dict) else {}
+    return request.json or {}
+
+
+def _compress(body, accept):
+    """按 Accept-Encoding 选择 zstd（需 zstandard）或 gzip，返回 (编码名, 数据) 或 None"""
+    conf = load_config().get("compression", {})
+    if accept.quality("zstd") > 0:
+        try:
+            import zstandard
+
+            level = int(conf.get("zstd_level", 3))
+            return "zstd", zstandard.ZstdCompressor(level=level).compress(body)
+        except ImportError:
+            pass
+    if accept.quality("gzip") > 0:
+        return "gzip", gzip.compress(body, compresslevel=int(conf.get("gzip_level", 5)), mtime=0)
+    return None
+
+
+@app.after_request
+def _compress_response(response):
+    """
+    超过 compression.min_size 的文本 / JSON / 二进制编码响应按 Accept-Encoding 压缩
+
+    流式响应和 send_file（direct_passthrough）不压缩，已压缩的图片等类型也跳过。
+    """
+    conf = load_config().get("compression", {})
+    if not conf.get("enabled", True):
+        return response
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or not response.mimetype.startswith(COMPRESSIBLE_MIMETYPES)
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < int(conf.get("min_size", 1024)):
+        return response
+
+    started = time.perf_counter()
+    compressed = _compress(body, request.accept_encodings)
+    if compressed is None:
+        return response
+    encoding, data = compressed
+    metrics.observe("phone_agent_encode_seconds", {"kind": encoding}, time.perf_counter() - started)
+    if len(data) >= len(body):
+        return response
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+# ==================== 首页 ====================
+
+
+@app.route("/")
+def index():
+    return jsonify(
+        {
+            "name": "Phone Agent",
+            "version": CURRENT_VERSION,
+            "status": "running",
+            "endpoints": [
+                "/api/status",
+                "/api/termux",
+                "/api/exec",
+                "/api/adb/*",
+                "/api/update/*",
+            ],
+        }
+    )
+
+
+# ==================== 状态 ====================
+
+
+@app.route("/api/status")
+def api_status():
+    return jsonify(
+        {
+            "status": "online",
+            "timestamp": datetime.now().isoformat(),
+            "version": CURRENT_VERSION,
+        }
+    )
+
+
+@app.route("/api/config/reload", methods=["POST"])
+def api_config_reload():
+    """立即重新加载 config.json（平时修改文件后最多 1 秒内自动生效）"""
+    try:
+        config = config_store.reload(strict=True)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify(
+        {"success": True, "loaded_at": config_store.loaded_at, "config": _thaw(config)}
+    )
+
+
+# ==================== 通用 termux-api 接口 ====================
+
+
+def _build_termux_command(data):
+    command = data.get("command", "")
+    args = data.get("args", [])
+
+    # 预处理 args：合并 `--xxx` 和下一个参数
+    processed_args = []
+    i = 0
+    while i < len(args):
+        arg = str(args[i])
+        if arg.startswith("--") and i + 1 < len(args):
+            next_arg = str(args[i + 1])
+            if not next_arg.startswith("--") and not next_arg.startswith("-"):
+                # 合并为 --xxx="value" 格式
+                processed_args.append(f'{arg}="{next_arg}"')
+                i += 2
+                continue
+        processed_args.append(arg)
+        i += 1
+
+    # 构建命令
+    full_command = command
+    for arg in processed_args:
+        full_command += f" {arg}"
+    return full_command
+
+
+class SingleFlightCache:
+    """
+    带 TTL 的结果缓存 + 请求合并
+
+    同一 key 的并发请求只执行一次，其余等待并共享结果；
+    成功结果在 TTL 内直接命中缓存。
+    """
+
+    def __init__(self, max_entries=256):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (monotonic 时间, 结果, 过期时间)，按写入顺序
+        self.inflight = {}  # key -> {"done": Event, "result": ...}
+        self.max_entries = max_entries
+
+    def get_or_run(self, key, ttl, fn, bypass=False):
+        """返回 (结果, {"hit", "shared", "age_ms"})"""
+        with self.lock:
+            now = time.monotonic()
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] >= ttl:
+                del self.entries[key]
+                entry = None
+            if entry is not None and not bypass:
+                age_ms = round((now - entry[0]) * 1000, 1)
+                return entry[1], {"hit": True, "shared": False, "age_ms": age_ms}
+            flight = self.inflight.get(key)
+            leader = flight is None or bypass
+            if leader:
+                flight = {"done": threading.Event(), "result": None}
+                if not bypass:
+                    self.inflight[key] = flight
+
+        if not leader:
+            flight["done"].wait()
+            return flight["result"], {"hit": False, "shared": True, "age_ms": 0.0}
+
+        try:
+            result = fn()
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        with self.lock:
+            if result.get("success") and ttl > 0:
+                now = time.monotonic()
+                self.entries.pop(key, None)
+                self.entries[key] = (now, result, now + ttl)
+                self._sweep(now)
+            if self.inflight.get(key) is flight:
+                del self.inflight[key]
+        flight["result"] = result
+        flight["done"].set()
+        return result, {"hit": False, "shared": False, "age_ms": 0.0}
+
+    def _sweep(self, now):
+        """写入时清掉已过期的条目，并按写入顺序淘汰超出上限的条目（调用方持锁）"""
+        for key in [k for k, entry in self.entries.items() if entry[2] <= now]:
+            del self.entries[key]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+termux_cache = SingleFlightCache()
+
+
+def _termux_run(full_command, timeout):
+    result = run_cmd(full_command, timeout)
+
+    # 尝试解析 JSON
+    parsed = None
+    if result.get("success") and result.get("stdout"):
+        try:
+            parsed = json.loads(result["stdout"])
+        except:
+            pass
+
+    return {
+        "success": result.get("success", False),
+        "stdout": result.get("stdout", ""),
+        "stderr": result.get("stderr", ""),
+        "parsed": parsed,
+        "command": full_command,
+    }
+
+
+def _termux_execute(data):
+    """
+    执行 termux-api 命令，返回响应 dict（同步接口和后台任务共用）
+
+    termux.cache_ttl 中配置了 TTL 的命令按规范化后的完整命令缓存，并发的相同请求合并执行；
+    请求中 "cache": false 可强制绕过缓存；"omit_stdout": true 时 JSON 解析成功则不再返回 stdout。
+    """
+    full_command = _build_termux_command(data)
+    timeout = data.get("timeout", 30)
+    ttls = load_config().get("termux", {}).get("cache_ttl", {})
+    ttl = float(ttls.get(data.get("command", ""), 0))
+    if ttl <= 0:
+        result = _termux_run(full_command, timeout)
+    else:
+        key = " ".join(full_command.split())
+        result, info = termux_cache.get_or_run(
+            key,
+            ttl,
+            lambda: _termux_run(full_command, timeout),
+            bypass=data.get("cache", True) is False,
+        )
+        result = {**result, "cache": info}
+    if data.get("omit_stdout") and result.get("parsed") is not None:
+        result.pop("stdout", None)
+    return result
+
+
+@app.route("/api/termux", methods=["POST"])
+def api_termux():
+    """通用 termux-api 接口（"async": true 时提交为后台任务，立即返回 job_id）"""
+    data = request.json or {}
+    if not data.get("command"):
+        return jsonify({"error": "No command specified"})
+    if data.get("async"):
+        return _submit_job_response("termux", data)
+    if data.get("stream"):
+        return _stream_response(_build_termux_command(data), data)
+    return _respond(_termux_execute(data))
+
+
+# ==================== 通用 Shell 执行# ==================== 通用 Shell 执行 ====================
+
+
+def _build_exec_command(data):
+    command = data.get("command", "")
+    args = data.get("args", [])
+    shell_mode = data.get("shell", False)
+    workdir = data.get("workdir", "/data/data/com.termux/files/home")
+
+    # 构建完整命令
+    full_command = command
+    for arg in args:
+        # 转义特殊字符
+        arg = str(arg).replace('"', '\\"').replace("$", "\\$").replace("`", "\\`")
+        full_command += f' "{arg}"'
+
+    # 如果是 shell 模式，添加工作目录
+    if shell_mode:
+        full_command = f'cd "{workdir}" && {full_command}'
+    return full_command
+
+
+def _exec_execute(data):
+    """执行 shell 命令，返回响应 dict（同步接口和后台任务共用）"""
+    full_command = _build_exec_command(data)
+    result = run_cmd(full_command, data.get("timeout", 30))
+    return {
+        "success": result.get("success", False),
+        "stdout": result.get("stdout", ""),
+        "stderr": result.get("stderr", ""),
+        "command": full_command,
+    }
+
+
+@app.route("/api/exec", methods=["POST"])
+def api_exec():
+    """
+    通用 Shell 命令执行（谨慎使用）
+
+    请求格式：
+    {
+        "command": "export",
+        "args": ["MY_VAR=hello"],
+        "shell": true,  // 是否作为 shell 脚本执行
+        "async": false,  // 是否提交为后台任务
+        "stream": false  // "sse" | "ndjson"：边执行边返回输出
+    }
+    """
+    data = request.json or {}
+    if not data.get("command"):
+        return jsonify({"error": "No command specified"})
+    if data.get("async"):
+        return _submit_job_response("exec", data)
+    if data.get("stream"):
+        return _stream_response(_build_exec_command(data), data)
+    return _respond(_exec_execute(data))
+
+
+# ==================== 输出流式返回 ====================
+
+STREAM_READ_SIZE = 64 * 1024
+STREAM_HEARTBEAT = 15  # 无输出时发送心跳的间隔（秒），用于探测客户端断开
+
+
+def _stream_command(full_command, timeout, fmt):
+    """
+    边执行边产出输出的生成器
+
+    只有客户端取走上一块数据后才会继续读管道：客户端慢时管道写满，
+    子进程随之阻塞，代理端不会无限缓存输出。最后产出一条带退出码的结尾事件。
+    """
+
+    def event(name, payload):
+        if fmt == "sse":
+            return f"event: {name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+        return (json.dumps({"event": name, **payload}, ensure_ascii=False) + "\n").encode()
+
+    start = time.monotonic()
+    deadline = start + timeout if timeout else None
+    try:
+        proc = subprocess.Popen(
+            full_command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    except Exception as e:
+        yield event("exit", {"success": False, "error": str(e)})
+        return
+
+    selector = selectors.DefaultSelector()
+    decoders = {}
+    for name, pipe in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+        selector.register(pipe, selectors.EVENT_READ, name)
+        decoders[name] = codecs.getincrementaldecoder("utf-8")("replace")
+
+    error = None
+    last_sent = time.monotonic()
+    try:
+        while selector.get_map():
+            wait = STREAM_HEARTBEAT - (time.monotonic() - last_sent)
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                if deadline is not None and time.monotonic() >= deadline:
+                    error = "Timeout"
+                    break
+                last_sent = time.monotonic()
+                yield b": keepalive\n\n" if fmt == "sse" else b"\n"
+                continue
+            for key, _ in selector.select(wait):
+                chunk = os.read(key.fileobj.fileno(), STREAM_READ_SIZE)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    text = decoders[key.data].decode(b"", final=True)
+                else:
+                    text = decoders[key.data].decode(chunk)
+                if text:
+                    last_sent = time.monotonic()
+                    yield event(key.data, {"data": text})
+        if error is None:
+            # 管道关了进程也可能还在跑（如后台子进程），等待同样受 deadline 约束
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                returncode = proc.wait(remaining)
+            except subprocess.TimeoutExpired:
+                error = "Timeout"
+        if error:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            returncode = proc.wait()
+        payload = {
+            "success": error is None,
+            "exit_code": returncode,
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+        }
+        if error:
+            payload["error"] = error
+        yield event("exit", payload)
+    finally:
+        # 客户端中途断开（GeneratorExit）时同样清理子进程
+        selector.close()
+        if proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+def _stream_response(full_command, data):
+    fmt = data.get("stream")
+    if fmt is True:
+        fmt = "sse"
+    if fmt not in ("sse", "ndjson"):
+        return jsonify({"success": False, "error": f"Unknown stream format: {fmt}"}), 400
+    timeout = data.get("timeout", 30)
+    response = Response(
+        _stream_command(full_command, timeout, fmt),
+        mimetype="text/event-stream" if fmt == "sse" else "application/x-ndjson",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    # 多行脚本不能原样放进响应头：控制字符折成空格，过长截断
+    header = re.sub(r"[\x00-\x1f\x7f]+", " ", full_command)[:256]
+    response.headers["X-Command"] = header.encode("ascii", "replace").decode()
+    return response
+
+
+# ==================== 后台任务 ====================
+
+JOB_EXECUTORS = {
+    "termux": _termux_execute,
+    "exec": _exec_execute,
+}
+
+_job_local = threading.local()
+
+
+class Job:
+    """一个后台任务：排队 -> 运行 -> 完成 / 失败 / 取消"""
+
+    def __init__(self, kind, data):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.data = data
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.proc = None
+        self.spawn_id = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def run_cmd(self, cmd, timeout):
+        """与 run_cmd 相同，但进程放在独立进程组里，取消时整组杀掉"""
+        family = _command_family(cmd)
+        started = time.perf_counter()
+        argv = _command_argv(cmd) if spawner.enabled() else None
+        if argv is not None:
+            with self.lock:
+                if self.cancelled:
+                    return {"success": False, "error": "Cancelled"}
+                self.spawn_id = uuid.uuid4().hex
+            result = _spawner_result(family, spawner.run(argv, timeout, rid=self.spawn_id, shell=cmd), started)
+            if self.cancelled:
+                return {"success": False, "error": "Cancelled"}
+            return result
+        try:
+            with self.lock:
+                if self.cancelled:
+                    return {"success": False, "error": "Cancelled"}
+                self.proc = subprocess.Popen(
+                    cmd,
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    start_new_session=True,
+                )
+            try:
+                stdout, stderr = self.proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.kill()
+                self.proc.communicate()
+                _observe_subprocess(family, total=time.perf_counter() - started, error="Timeout")
+                return {"success": False, "error": "Timeout"}
+            _observe_subprocess(family, total=time.perf_counter() - started)
+            if self.cancelled:
+                return {"success": False, "error": "Cancelled"}
+            return {"success": True, "stdout": stdout, "stderr": stderr}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def kill(self):
+        if self.spawn_id is not None:
+            spawner.kill(self.spawn_id)
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def to_dict(self, with_result=True):
+        info = {
+            "job_id": self.id,
+            "type": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.error:
+            info["error"] = self.error
+        if with_result and self.result is not None:
+            info["result"] = self.result
+        return info
+
+
+class JobManager:
+    """有界工作线程池执行慢命令，不占用处理快请求的 Flask 线程"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.executor = None
+        self.workers = 0
+
+    def _conf(self):
+        return load_config().get("jobs", {})
+
+    def _executor(self):
+        if self.executor is None:
+            self.workers = int(self._conf().get("workers", 2))
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="job"
+            )
+        return self.executor
+
+    def _expire(self):
+        ttl = float(self._conf().get("result_ttl", 600))
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > ttl:
+                del self.jobs[job_id]
+
+    def queued(self):
+        return sum(1 for j in self.jobs.values() if j.status == "queued")
+
+    def submit(self, kind, data):
+        """提交任务；队列已满时返回 None"""
+        job = Job(kind, data)
+        with self.lock:
+            self._expire()
+            if self.queued() >= int(self._conf().get("max_queue", 100)):
+                return None
+            self.jobs[job.id] = job
+            job.future = self._executor().submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        with job.lock:
+            if job.cancelled:
+                # cancel() 在 future 已被工作线程取走后才到，future.cancel() 失败，状态由这里收尾
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                return
+            job.status = "running"
+            job.started_at = time.time()
+        _job_local.job = job
+        try:
+            job.result = JOB_EXECUTORS[job.kind](job.data)
+            job.status = "cancelled" if job.cancelled else "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            _job_local.job = None
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with job.lock:
+            if job.status in ("done", "failed", "cancelled"):
+                return job
+            job.cancelled = True
+            if job.status == "queued" and job.future.cancel():
+                job.status = "cancelled"
+                job.finished_at = time.time()
+        job.kill()
+        return job
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            counts = collections.Counter(j.status for j in self.jobs.values())
+            return {
+                "workers": self.workers or int(self._conf().get("workers", 2)),
+                "queue_depth": counts.get("queued", 0),
+                "running": counts.get("running", 0),
+                "done": counts.get("done", 0),
+                "failed": counts.get("failed", 0),
+                "cancelled": counts.get("cancelled", 0),
+            }
+
+
+job_manager = JobManager()
+
+
+def _submit_job_response(kind, data):
+    if kind not in JOB_EXECUTORS:
+        return jsonify({"success": False, "error": f"Unknown job type: {kind}"}), 400
+    job = job_manager.submit(kind, data)
+    if job is None:
+        return jsonify({"success": False, "error": "Job queue full"}), 429
+    return jsonify({"success": True, **job.to_dict(with_result=False)}), 202
+
+
+@app.route("/api/jobs", methods=["POST"])
+def api_jobs_submit():
+    """
+    提交后台任务，立即返回 job_id
+
+    请求格式：{"type": "termux" | "exec", "request": {...与对应接口相同...}}
+    """
+    data = request.json or {}
+    body = data.get("request") or {}
+    if not body.get("command"):
+        return jsonify({"success": False, "error": "No command specified"}), 400
+    return _submit_job_response(data.get("type", ""), body)
+
+
+@app.route("/api/jobs", methods=["GET"])
+def api_jobs_list():
+    """任务列表与队列统计"""
+    with job_manager.lock:
+        jobs = [j.to_dict(with_result=False) for j in job_manager.jobs.values()]
+    return jsonify({"success": True, "stats": job_manager.stats(), "jobs": jobs})
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def api_jobs_get(job_id):
+    """查询任务状态，完成后带 result"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, **job.to_dict()})
+
+
+@app.route("/api/jobs/<job_id>", methods=["DELETE"])
+def api_jobs_cancel(job_id):
+    """取消任务：排队中直接移除，运行中杀掉进程组"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, **job.to_dict(with_result=False)})
+
+
+# ==================== ADB 控制 ====================
+
+
+@app.route("/api/adb", methods=["POST"])
+def api_adb():
+    """通用 ADB 接口"""
+    data = request.json or {}
+    subcommand = data.get("subcommand", "")
+    args = data.get("args", [])
+
+    full_cmd = f"shell {subcommand}"
+    for arg in args:
+        full_cmd += f" {arg}"
+
+    result = adb_cmd(full_cmd, _request_device())
+    return jsonify(
+        {
+            "success": result.get("success", False),
+            "stdout": result.get("stdout", ""),
+            "stderr": result.get("stderr", ""),
+            "command": f"adb {full_cmd}",
+        }
+    )
+
+
+@app.route("/api/adb/pool")
+def api_adb_pool():
+    """ADB 会话池状态"""
+    return jsonify({"success": True, "pool": adb_pool.status()})
+
+
+ADB_KEYCODES = {"ENTER": "66", "BACK": "4", "HOME": "3", "MENU": "82", "POWER": "26"}
+
+
+@app.route("/api/devices")
+def api_devices():
+    """发现已连接的设备（adb devices -l）"""
+    return jsonify({"success": True, "devices": discover_devices()})
+
+
+@app.route("/api/fleet")
+def api_fleet():
+    """各设备状态：连接状态、命令队列深度、最近一次命令耗时"""
+    queues = fleet.status()
+    devices = {d["serial"]: d for d in discover_devices()}
+    for serial, info in devices.items():
+        info.update(queues.pop(serial, {}))
+    # 已有队列但当前未连接的设备也列出来
+    for serial, info in queues.items():
+        devices[serial] = {"serial": serial, "state": "unknown", **info}
+    return jsonify(
+        {
+            "success": True,
+            "devices": list(devices.values()),
+            "pool": adb_pool.status(),
+        }
+    )
+
+
+@app.route("/api/adb/tap", methods=["POST"])
+def api_adb_tap():
+    """ADB 点击"""
+    data = request.json
+    x, y = data.get("x", 0), data.get("y", 0)
+    return jsonify(adb_cmd(f"shell input tap {x} {y}", _request_device()))
+
+
+@app.route("/api/adb/swipe", methods=["POST"])
+def api_adb_swipe():
+    """ADB 滑动"""
+    data = request.json
+    x1, y1 = data.get("x1", 0), data.get("y1", 0)
+    x2, y2 = data.get("x2", 0), data.get("y2", 0)
+    duration = data.get("duration", 300)
+    return jsonify(
+        adb_cmd(f"shell input swipe {x1} {y1} {x2} {y2} {duration}", _request_device())
+    )
+
+
+@app.route("/api/adb/input", methods=["POST"])
+def api_adb_input():
+    """ADB 输入"""
+    data = request.json
+    text = data.get("text", "").replace(" ", "%s").replace('"', '\\"')
+    return jsonify(adb_cmd(f'shell input text "{text}"', _request_device()))
+
+
+@app.route("/api/adb/key", methods=["POST"])
+def api_adb_key():
+    """ADB 按键"""
+    data = request.json
+    key = data.get("key", "ENTER")
+    return jsonify(
+        adb_cmd(f"shell input keyevent {ADB_KEYCODES.get(key, key)}", _request_device())
+    )
+
+
+def _capture_raw(device=None):
+    """
+    用 `screencap`（不带 -p）抓取原始帧，省掉设备端 PNG 编码
+
+    返回 (width, height, rgba_bytes)；失败抛 RuntimeError
+    """
+    result = adb_exec_out(["screencap"], device=device)
+    if not result.get("success"):
+        raise RuntimeError(result.get("error", "screencap failed"))
+    data = result["data"]
+    width, height, header = _parse_screencap(data)
+    return width, height, memoryview(data)[header:]
+
+
+def _parse_screencap(data):
+    """解析一帧完整的 screencap 原始输出，返回 (width, height, 头部长度)"""
+    if len(data) < 12:
+        raise RuntimeError("screencap returned no data")
+    width, height, _fmt = struct.unpack_from("<III", data)
+    # 新版本 Android 头部多一个 colorspace 字段（16 字节），旧版本 12 字节
+    header = len(data) - width * height * 4
+    if header not in (12, 16):
+        raise RuntimeError("Unexpected screencap output size")
+    return width, height, header
+
+
+def _crop_raw(width, height, rgba, crop):
+    """不依赖 Pillow 的 RGBA 裁剪，按行切片"""
+    x, y, w, h = crop
+    x, y = max(0, x), max(0, y)
+    w, h = min(w, width - x), min(h, height - y)
+    if w <= 0 or h <= 0:
+        raise ValueError("Crop rectangle outside screen")
+    stride = width * 4
+    rows = [
+        rgba[(y + r) * stride + x * 4:(y + r) * stride + (x + w) * 4]
+        for r in range(h)
+    ]
+    return w, h, b"".join(rows)
+
+
+def _parse_crop(value):
+    if not value:
+        return None
+    parts = [int(float(v)) for v in str(value).split(",")]
+    if len(parts) != 4:
+        raise ValueError("crop must be x,y,w,h")
+    return parts
+
+
+def _encode_frame(width, height, rgba, fmt, scale=1.0, crop=None, quality=80):
+    """
+    把原始 RGBA 帧编码为目标格式，返回 (bytes, mimetype, width, height)
+
+    raw 只做裁剪；png / jpeg / webp 及缩放需要 Pillow（可选依赖）。
+    """
+    if crop:
+        width, height, rgba = _crop_raw(width, height, rgba, crop)
+    if fmt == "raw" and scale == 1.0:
+        return bytes(rgba), "application/octet-stream", width, height
+
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("Pillow not installed: pip install pillow")
+
+    image = Image.frombuffer("RGBA", (width, height), bytes(rgba), "raw", "RGBA", 0, 1)
+    if scale != 1.0:
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        image = image.resize(size, Image.BILINEAR)
+        width, height = size
+    if fmt == "raw":
+        return image.tobytes(), "application/octet-stream", width, height
+
+    buf = io.BytesIO()
+    if fmt == "png":
+        # 速度优先：低压缩级别
+        image.save(buf, format="PNG", compress_level=1)
+    elif fmt == "jpeg":
+        image.convert("RGB").save(buf, format="JPEG", quality=quality)
+    elif fmt == "webp":
+        image.save(buf, format="WEBP", quality=quality, method=0)
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+    return buf.getvalue(), f"image/{fmt}", width, height
+
+
+@app.route("/api/adb/screenshot")
+def api_adb_screenshot():
+    """
+    ADB 截图
+
+    不带 format 参数时保持旧行为：写入 /sdcard 并返回路径。
+    带 format 时直接在响应中返回图像，不落盘：
+        GET /api/adb/screenshot?format=png|raw|jpeg|webp&scale=0.5&crop=x,y,w,h&quality=70
+    raw 为 RGBA 字节，尺寸见 X-Width / X-Height 响应头。
+    """
+    fmt = request.args.get("format")
+    device = _request_device()
+    if not fmt:
+        output = f"/sdcard/screen_{int(time.time())}.png"
+        result = adb_cmd(f"shell screencap -p {output}", device)
+        return jsonify({"success": result.get("success", False), "path": output})
+
+    fmt = fmt.lower().replace("jpg", "jpeg")
+    try:
+        scale = float(request.args.get("scale", 1.0))
+        crop = _parse_crop(request.args.get("crop"))
+        quality = int(request.args.get("quality", 80))
+        if not 0 < scale <= 1:
+            raise ValueError("scale must be in (0, 1]")
+        if fmt not in ("png", "raw", "jpeg", "webp"):
+            raise ValueError(f"Unknown format: {fmt}")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    t0 = time.monotonic()
+    try:
+        if fmt == "png" and scale == 1.0 and not crop:
+            # 原图 PNG 直接透传设备端编码结果
+            result = adb_exec_out(["screencap", "-p"], device=device)
+            if not result.get("success"):
+                raise RuntimeError(result.get("error", "screencap failed"))
+            t1 = time.monotonic()
+            body, mimetype, width, height = result["data"], "image/png", None, None
+        else:
+            width, height, rgba = _capture_raw(device)
+            t1 = time.monotonic()
+            body, mimetype, width, height = _encode_frame(
+                width, height, rgba, fmt, scale, crop, quality
+            )
+            metrics.observe(
+                "phone_agent_encode_seconds", {"kind": fmt}, time.monotonic() - t1
+            )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    t2 = time.monotonic()
+
+    response = Response(body, mimetype=mimetype)
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Capture-Ms"] = f"{(t1 - t0) * 1000:.1f}"
+    response.headers["X-Encode-Ms"] = f"{(t2 - t1) * 1000:.1f}"
+    if width is not None:
+        response.headers["X-Width"] = str(width)
+        response.headers["X-Height"] = str(height)
+    return response
+
+
+@app.route("/api/adb/dump")
+def api_adb_dump():
+    """
+    ADB UI 层级
+
+    带 session 参数时进入增量模式，只返回与该会话上一次结果的结构化差异：
+        GET /api/adb/dump?session=agent-1[&since=<version>][&reset=1]
+    """
+    if request.args.get("session"):
+        return _ui_diff_response(
+            request.args["session"],
+            device=_request_device(),
+            since=request.args.get("since"),
+            reset=request.args.get("reset") in ("1", "true"),
+        )
+    result = _dump_ui_xml(_request_device())
+    return _respond(
+        {"success": result.get("success", False), "xml": result.get("stdout", "")}
+    )
+
+
+@app.route("/api/adb/start", methods=["POST"])
+def api_adb_start():
+    """ADB 启动 App"""
+    data = request.json
+    package = data.get("package", "")
+    activity = data.get("activity", "")
+    result = adb_cmd(f"shell am start -n {package}/{activity}", _request_device())
+    return jsonify(result)
+
+
+# ==================== 屏幕实时流 ====================
+
+STREAM_SIG_GRID = 64  # 帧差检测的采样网格边长
+STREAM_SIG_TOLERANCE = 12  # 采样点像素差超过该值才算变化
+STREAM_KEEPALIVE = 5  # 画面无变化时重发上一帧的间隔（秒）
+
+
+def _frame_signature(width, height, rgba):
+    """按网格采样 G 通道得到缩略签名，用于近似比较两帧"""
+    stride = width * 4
+    sx = max(1, width // STREAM_SIG_GRID)
+    sy = max(1, height // STREAM_SIG_GRID)
+    rows = []
+    for y in range(0, height, sy):
+        row = rgba[y * stride:(y + 1) * stride]
+        rows.append(bytes(row[1::4 * sx]))
+    return b"".join(rows)
+
+
+def _signature_diff(a, b):
+    """两个签名中发生变化的采样点比例"""
+    if a is None or b is None or len(a) != len(b):
+        return 1.0
+    if a == b:
+        return 0.0
+    changed = sum(1 for x, y in zip(a, b) if abs(x - y) > STREAM_SIG_TOLERANCE)
+    return changed / len(a)
+
+
+# 设备端常驻采集循环：每 __INTERVAL__ 毫秒执行一次 screencap，原始帧首尾相接写到 stdout。
+# 计时用 /proc/uptime（read 是内建命令，不 fork），只保存相对开始的毫秒数；落后时不补帧
+_STREAM_LOOP = r"""read u x < /proc/uptime; s0=${u%.*}; next=0
+while :; do
+  read u x < /proc/uptime; now=$(( (${u%.*} - s0) * 1000 + (1${u#*.} - 100) * 10 ))
+  d=$(( next - now ))
+  if [ "$d" -gt 0 ]; then f=$(( d % 1000 + 1000 )); sleep $(( d / 1000 )).${f#1}; else next=$now; fi
+  screencap || exit 1
+  next=$(( next + __INTERVAL__ ))
+done"""
+
+
+class ScreenStream:
+    """
+    一台设备的共享采集管线
+
+    一个常驻的 `adb exec-out` 在设备端循环 screencap，按订阅者中最高的 fps 连续输出原始帧，
+    省掉每帧启动 adb 客户端和设备端进程的开销；帧长由启动时探测的一帧确定。
+    同一帧按编码参数只编码一次，所有订阅者共用。没有订阅者时进程和线程自动退出。
+    """
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.cond = threading.Condition()
+        self.subscribers = {}  # id -> 请求的 fps
+        self.frame = None
+        self.error = None
+        self.captured = 0
+        self.thread = None
+
+    def subscribe(self, fps):
+        sub_id = uuid.uuid4().hex
+        with self.cond:
+            self.subscribers[sub_id] = fps
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+        return sub_id
+
+    def unsubscribe(self, sub_id):
+        with self.cond:
+            self.subscribers.pop(sub_id, None)
+
+    def _start(self, fps):
+        """探测一帧得到帧长，然后启动设备端采集循环"""
+        width, height, rgba = _capture_raw(self.serial)
+        pixels = width * height * 4
+        header = len(rgba.obj) - pixels
+        argv = ["adb"]
+        if self.serial:
+            argv += ["-s", self.serial]
+        script = _STREAM_LOOP.replace("__INTERVAL__", str(max(1, round(1000 / fps))))
+        proc = subprocess.Popen(
+            argv + ["exec-out", script],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        return proc, header + pixels
+
+    @staticmethod
+    def _stop(proc):
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+        if proc is not None:
+            proc.wait()
+            proc.stdout.close()
+
+    def _loop(self):
+        seq = 0
+        proc, fps, frame_size = None, None, 0
+        try:
+            while True:
+                with self.cond:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                    want = max(self.subscribers.values())
+                if proc is None or want != fps:
+                    self._stop(proc)
+                    proc, fps = None, want
+                    try:
+                        proc, frame_size = self._start(fps)
+                    except (RuntimeError, OSError) as e:
+                        with self.cond:
+                            self.error = str(e)
+                        time.sleep(1.0)
+                        continue
+
+                data = proc.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    self._stop(proc)
+                    proc = None
+                    with self.cond:
+                        self.error = "Capture pipeline exited"
+                    time.sleep(1.0)
+                    continue
+                try:
+                    width, height, header = _parse_screencap(data)
+                except RuntimeError:
+                    # 分辨率变了（帧长不再匹配）：重新探测
+                    self._stop(proc)
+                    proc = None
+                    continue
+                rgba = memoryview(data)[header:]
+                frame = {
+                    "width": width,
+                    "height": height,
+                    "rgba": rgba,
+                    "sig": _frame_signature(width, height, rgba),
+                    "ts": time.time(),
+                    "encoded": {},
+                    "lock": threading.Lock(),
+                }
+                with self.cond:
+                    seq += 1
+                    frame["seq"] = seq
+                    self.frame = frame
+                    self.error = None
+                    self.captured += 1
+                    self.cond.notify_all()
+        finally:
+            self._stop(proc)
+
+    def wait_frame(self, after_seq, timeout):
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.frame is not None and self.frame["seq"] > after_seq,
+                timeout,
+            )
+            return self.frame
+
+    def status(self):
+        with self.cond:
+            return {
+                "subscribers": len(self.subscribers),
+                "max_fps": max(self.subscribers.values(), default=0),
+                "captured": self.captured,
+                "last_frame": self.frame["ts"] if self.frame else None,
+                "error": self.error,
+            }
+
+
+_screen_streams = {}
+_screen_streams_lock = threading.Lock()
+
+
+def _get_screen_stream(serial):
+    with _screen_streams_lock:
+        stream = _screen_streams.get(serial)
+        if stream is None:
+            stream = _screen_streams[serial] = ScreenStream(serial)
+        return stream
+
+
+def _encode_cached(frame, fmt, scale, max_width, crop, quality):
+    """同一帧相同编码参数只编码一次，供多个订阅者共享"""
+    if max_width:
+        scale = min(scale, max_width / frame["width"])
+    key = (fmt, scale, tuple(crop) if crop else None, quality)
+    with frame["lock"]:
+        if key not in frame["encoded"]:
+            frame["encoded"][key] = _encode_frame(
+                frame["width"], frame["height"], frame["rgba"], fmt, scale, crop, quality
+            )[0]
+        return frame["encoded"][key]
+
+
+@app.route("/api/adb/stream")
+def api_adb_stream():
+    """
+    实时屏幕流
+
+    GET /api/adb/stream?fps=5&format=jpeg&scale=0.5&max_width=720&mode=mjpeg&threshold=0.002
+
+    mode=mjpeg：multipart/x-mixed-replace，可直接在浏览器 <img> 中播放
+    mode=chunks：每帧为 4 字节大端长度 + 图像数据
+    与上一帧变化比例低于 threshold 的帧不推送。同一设备的多个观看者共用一条采集管线。
+    """
+    stream_conf = load_config().get("stream", {})
+    try:
+        fps = min(
+            float(request.args.get("fps", stream_conf.get("default_fps", 2))),
+            float(stream_conf.get("max_fps", 10)),
+        )
+        fmt = request.args.get("format", "jpeg").lower().replace("jpg", "jpeg")
+        scale = float(request.args.get("scale", 1.0))
+        max_width = int(request.args.get("max_width", 0)) or None
+        crop = _parse_crop(request.args.get("crop"))
+        quality = int(request.args.get("quality", 70))
+        threshold = float(
+            request.args.get("threshold", stream_conf.get("diff_threshold", 0.002))
+        )
+        mode = request.args.get("mode", "mjpeg")
+        if fps <= 0 or not 0 < scale <= 1:
+            raise ValueError("fps must be > 0 and scale in (0, 1]")
+        if fmt not in ("png", "raw", "jpeg", "webp"):
+            raise ValueError(f"Unknown format: {fmt}")
+        if mode not in ("mjpeg", "chunks"):
+            raise ValueError(f"Unknown mode: {mode}")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    serial = _resolve_device(_request_device())
+    if not fleet.known_device(serial):
+        return jsonify({"success": False, "error": f"Device not found: {serial}"}), 404
+    stream = _get_screen_stream(serial)
+    mimetype = "application/octet-stream" if fmt == "raw" else f"image/{fmt}"
+    boundary = "frame"
+
+    def generate():
+        sub_id = stream.subscribe(fps)
+        interval = 1.0 / fps
+        last_seq, last_sig, next_at = 0, None, 0.0
+        part, sent_at = None, time.monotonic()
+        try:
+            while True:
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                frame = stream.wait_frame(last_seq, timeout=STREAM_KEEPALIVE)
+                changed = frame is not None and frame["seq"] > last_seq
+                if changed:
+                    last_seq = frame["seq"]
+                    changed = (
+                        last_sig is None
+                        or _signature_diff(last_sig, frame["sig"]) >= threshold
+                    )
+                if not changed:
+                    # 画面长时间不变时重发上一帧，顺便探测客户端是否已断开
+                    if part is not None and time.monotonic() - sent_at >= STREAM_KEEPALIVE:
+                        sent_at = time.monotonic()
+                        yield part
+                    continue
+                last_sig = frame["sig"]
+                next_at = time.monotonic() + interval
+                body = _encode_cached(frame, fmt, scale, max_width, crop, quality)
+                if mode == "chunks":
+                    part = struct.pack(">I", len(body)) + body
+                else:
+                    part = (
+                        f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"X-Frame-Seq: {frame['seq']}\r\n\r\n"
+                    ).encode() + body + b"\r\n"
+                sent_at = time.monotonic()
+                yield part
+        finally:
+            stream.unsubscribe(sub_id)
+
+    if mode == "chunks":
+        response = Response(generate(), mimetype="application/octet-stream")
+        response.headers["X-Frame-Format"] = fmt
+    else:
+        response = Response(
+            generate(), mimetype=f"multipart/x-mixed-replace; boundary={boundary}"
+        )
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@app.route("/api/adb/stream/status")
+def api_adb_stream_status():
+    """各设备采集管线状态"""
+    with _screen_streams_lock:
+        streams = dict(_screen_streams)
+    return jsonify(
+        {
+            "success": True,
+            "streams": {
+                (serial or "default"): stream.status()
+                for serial, stream in streams.items()
+            },
+        }
+    )
+
+
+# ==================== 截图分析 ====================
+
+TEMPLATE_NAME_RE = re.compile(r"[\w.-]{1,64}")
+REFERENCE_SCALE = 4  # 参考帧按 4x4 块均值缩小后保存，变化检测在缩小图上做
+
+_templates = {}  # name -> 预解码的模板
+_templates_loaded = False
+_templates_lock = threading.Lock()
+_references = {}  # (serial, name) -> 参考帧
+_analysis_frames = {}  # serial -> 最近一次用于分析的帧
+_analysis_lock = threading.Lock()
+_dct_matrix = None
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("NumPy not installed: pip install numpy")
+    return numpy
+
+
+class AnalysisFrame:
+    """一帧截图的 NumPy 视图；灰度图按需计算并缓存，同一帧上的多个检查共用"""
+
+    def __init__(self, np, width, height, rgba, ts):
+        self.np = np
+        self.width = width
+        self.height = height
+        self.ts = ts
+        # 零拷贝：直接在 screencap 输出上建视图，丢弃 alpha 通道
+        self.rgb = np.frombuffer(rgba, dtype=np.uint8).reshape(height, width, 4)[:, :, :3]
+        self._gray = None
+        self._scaled = {}  # 缩小倍数 -> 灰度缩小图
+        self.lock = threading.Lock()
+
+    def gray(self, scale=1):
+        """灰度图；scale > 1 时返回按 scale x scale 块均值缩小的版本"""
+        with self.lock:
+            if self._gray is None:
+                self._gray = _to_gray(self.np, self.rgb)
+            if scale <= 1:
+                return self._gray
+            if scale not in self._scaled:
+                self._scaled[scale] = _block_mean(self.np, self._gray, scale)
+            return self._scaled[scale]
+
+
+def _to_gray(np, rgb):
+    weights = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return rgb.astype(np.float32) @ weights
+
+
+def _block_mean(np, image, s):
+    """s x s 块均值缩小（面积平均，不需要 Pillow）"""
+    if s <= 1:
+        return image
+    h, w = image.shape[0] // s * s, image.shape[1] // s * s
+    blocks = image[:h, :w].reshape(h // s, s, w // s, s)
+    return blocks.sum(axis=3, dtype=np.float64).sum(axis=1) / (s * s)
+
+
+def _fft_size(n):
+    """不小于 n 的 2/3/5 光滑数，FFT 在这些长度上最快"""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def _analysis_frame(device, max_age_ms=0):
+    """
+    取一帧用于分析
+
+    max_age_ms > 0 时优先复用足够新的帧（上一次分析用过的帧或实时流管线的当前帧），
+    省掉一次 screencap；否则重新抓取。返回 (AnalysisFrame, reused)
+    """
+    np = _numpy()
+    serial = _resolve_device(device)
+    now = time.time()
+    if max_age_ms > 0:
+        with _analysis_lock:
+            frame = _analysis_frames.get(serial)
+        if frame is not None and (now - frame.ts) * 1000 <= max_age_ms:
+            return frame, True
+        with _screen_streams_lock:
+            stream = _screen_streams.get(serial)
+        if stream is not None:
+            with stream.cond:
+                raw = stream.frame
+            if raw is not None and (now - raw["ts"]) * 1000 <= max_age_ms:
+                frame = AnalysisFrame(np, raw["width"], raw["height"], raw["rgba"], raw["ts"])
+                with _analysis_lock:
+                    _analysis_frames[serial] = frame
+                return frame, True
+    width, height, rgba = _capture_raw(device)
+    frame = AnalysisFrame(np, width, height, rgba, time.time())
+    with _analysis_lock:
+        _analysis_frames[serial] = frame
+    return frame, False
+
+
+def _region(frame, value):
+    """解析 region（[x, y, w, h] 或 "x,y,w,h"），裁到屏幕范围内；缺省为全屏"""
+    if value is None:
+        return 0, 0, frame.width, frame.height
+    if isinstance(value, str):
+        value = _parse_crop(value)
+    if len(value) != 4:
+        raise ValueError("region must be [x, y, w, h]")
+    x, y, w, h = (int(v) for v in value)
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(frame.width, x + w), min(frame.height, y + h)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("region outside screen")
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def _parse_color(value):
+    """"#RRGGBB" / "RRGGBB" / [r, g, b] -> (r, g, b)"""
+    if isinstance(value, (list, tuple)) and len(value) >= 3:
+        return tuple(int(v) for v in value[:3])
+    text = str(value).lstrip("#")
+    if not re.fullmatch(r"[0-9a-fA-F]{6}", text):
+        raise ValueError(f"Invalid color: {value}")
+    return tuple(int(text[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def _hex_color(rgb):
+    return "#" + "".join(f"{int(round(c)):02x}" for c in rgb)
+
+
+# ---------- 模板 ----------
+
+def _template_dir():
+    return load_config().get("analysis", {}).get("template_dir", "templates")
+
+
+def _prepare_template(np, name, rgb):
+    """模板注册时一次性算好灰度图、零均值版本和粗匹配用的缩小图"""
+    gray = _to_gray(np, rgb).astype(np.float64)
+    h, w = gray.shape
+    if gray.std() < 1.0:
+        raise ValueError("Template has no contrast")
+    # 粗匹配缩小倍数：保证缩小后的模板短边仍有 8 像素以上
+    scale = max(1, min(4, min(h, w) // 8))
+    return {
+        "name": name,
+        "width": w,
+        "height": h,
+        "gray": gray,
+        "scale": scale,
+        "coarse": _block_mean(np, gray, scale),
+        "fft": collections.OrderedDict(),  # (图像尺寸, 缩放) -> 模板频谱
+        "created": time.time(),
+    }
+
+
+def _load_templates(np):
+    """首次访问时从 template_dir 载入已保存的模板（.npy，RGB uint8）"""
+    global _templates_loaded
+    with _templates_lock:
+        if _templates_loaded:
+            return
+        _templates_loaded = True
+        directory = _template_dir()
+        if not os.path.isdir(directory):
+            return
+        for entry in sorted(os.listdir(directory)):
+            name, ext = os.path.splitext(entry)
+            if ext != ".npy" or not TEMPLATE_NAME_RE.fullmatch(name):
+                continue
+            try:
+                rgb = np.load(os.path.join(directory, entry), allow_pickle=False)
+                _templates[name] = _prepare_template(np, name, rgb)
+            except (OSError, ValueError) as e:
+                app.logger.warning("模板 %s 载入失败: %s", entry, e)
+
+
+def _get_template(np, name):
+    _load_templates(np)
+    with _templates_lock:
+        template = _templates.get(name)
+    if template is None:
+        raise KeyError(f"Template not found: {name}")
+    return template
+
+
+def _decode_image(np, data):
+    """base64 编码的 PNG / JPEG -> RGB 数组（需要 Pillow）"""
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("Pillow not installed: pip install pillow")
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(data)))
+        return np.asarray(image.convert("RGB"), dtype=np.uint8)
+    except Exception as e:
+        raise ValueError(f"Cannot decode image: {e}")
+
+
+def save_template(name, rgb):
+    np = _numpy()
+    if not TEMPLATE_NAME_RE.fullmatch(name or ""):
+        raise ValueError("Invalid template name")
+    rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+    template = _prepare_template(np, name, rgb)
+    directory = _template_dir()
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, f"{name}.npy"), rgb, allow_pickle=False)
+    _load_templates(np)
+    with _templates_lock:
+        _templates[name] = template
+    return template
+
+
+# ---------- 检查 ----------
+
+def _ncc_map(np, image, template, fft_cache=None, cache_key=None):
+    """
+    归一化互相关（零均值），返回每个可放置位置的相关系数 [-1, 1]
+
+    分子用 FFT 卷积一次算完所有位置，分母的局部能量用积分图求窗口和。
+    fft_cache 是模板上共享的频谱缓存，多个请求并发匹配同一模板，读写都在 _templates_lock 下进行。
+    """
+    H, W = image.shape
+    h, w = template.shape
+    if h > H or w > W:
+        return None
+    shape = (_fft_size(H + h - 1), _fft_size(W + w - 1))
+    t0 = template - template.mean()
+    t_norm = np.sqrt((t0 * t0).sum())
+    spectrum = None
+    if fft_cache is not None:
+        with _templates_lock:
+            spectrum = fft_cache.get((shape, cache_key))
+            if spectrum is not None:
+                fft_cache.move_to_end((shape, cache_key))
+    if spectrum is None:
+        spectrum = np.fft.rfft2(t0[::-1, ::-1], shape)
+        if fft_cache is not None:
+            with _templates_lock:
+                fft_cache[(shape, cache_key)] = spectrum
+                while len(fft_cache) > 8:
+                    fft_cache.popitem(last=False)
+    num = np.fft.irfft2(np.fft.rfft2(image, shape) * spectrum, shape)[h - 1:H, w - 1:W]
+
+    def window_sum(values):
+        ii = np.zeros((H + 1, W + 1))
+        ii[1:, 1:] = values.cumsum(0).cumsum(1)
+        return ii[h:, w:] - ii[:-h, w:] - ii[h:, :-w] + ii[:-h, :-w]
+
+    image = image.astype(np.float64)
+    s1 = window_sum(image)
+    s2 = window_sum(image * image)
+    var = np.maximum(s2 - s1 * s1 / (h * w), 0)
+    denom = np.sqrt(var) * t_norm
+    out = np.zeros_like(num)
+    np.divide(num, denom, out=out, where=denom > 1e-3 * t_norm)
+    return out
+
+
+def _check_template(np, frame, check):
+    """模板匹配：先在缩小图上找候选位置，再在原图候选附近精确定位"""
+    template = _get_template(np, check.get("template"))
+    x0, y0, rw, rh = _region(frame, check.get("region"))
+    threshold = float(check.get("threshold", 0.85))
+    max_results = max(1, min(int(check.get("max_results", 1)), 20))
+    h, w, s = template["height"], template["width"], template["scale"]
+    if rh < h or rw < w:
+        raise ValueError("Template larger than search region")
+
+    gray = frame.gray()[y0:y0 + rh, x0:x0 + rw]
+    coarse_gray = frame.gray(s)[y0 // s:(y0 + rh) // s, x0 // s:(x0 + rw) // s]
+    coarse = _ncc_map(np, coarse_gray, template["coarse"], template["fft"], s)
+    if coarse is None:
+        raise ValueError("Template larger than search region")
+
+    matches = []
+    best = -1.0
+    # 缩小图上的相关系数偏低，候选门限放宽一些
+    coarse_threshold = threshold - 0.2
+    while len(matches) < max_results:
+        idx = int(coarse.argmax())
+        cy, cx = divmod(idx, coarse.shape[1])
+        if coarse[cy, cx] < coarse_threshold:
+            break
+        fy0, fx0 = max(0, cy * s - 2 * s), max(0, cx * s - 2 * s)
+        fy1, fx1 = min(rh, cy * s + h + 2 * s), min(rw, cx * s + w + 2 * s)
+        fine = _ncc_map(np, gray[fy0:fy1, fx0:fx1], template["gray"])
+        # 非极大值抑制：清掉该候选附近，继续找下一个
+        ry, rx = max(1, h // s // 2), max(1, w // s // 2)
+        coarse[max(0, cy - ry):cy + ry + 1, max(0, cx - rx):cx + rx + 1] = -1
+        if fine is None:
+            continue  # 候选贴着区域边缘，原图窗口放不下整个模板
+        fy, fx = divmod(int(fine.argmax()), fine.shape[1])
+        confidence = float(fine[fy, fx])
+        best = max(best, confidence)
+        if confidence >= threshold:
+            x, y = x0 + fx0 + fx, y0 + fy0 + fy
+            matches.append(
+                {
+                    "x": x,
+                    "y": y,
+                    "w": w,
+                    "h": h,
+                    "center": [x + w // 2, y + h // 2],
+                    "confidence": round(confidence, 4),
+                }
+            )
+    result = {"found": bool(matches), "confidence": round(max(best, 0.0), 4)}
+    if max_results == 1:
+        result.update(matches[0] if matches else {})
+    else:
+        result["matches"] = matches
+    return result
+
+
+def _phash(np, gray):
+    """pHash：缩到 32x32，取 DCT 低频 8x8 与中位数比较，得到 64 位指纹"""
+    global _dct_matrix
+    if _dct_matrix is None:
+        n = np.arange(32)
+        matrix = np.sqrt(2 / 32) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+        matrix[0] /= np.sqrt(2)
+        _dct_matrix = matrix
+    h, w = gray.shape
+    if h >= 32 and w >= 32:
+        ys = np.linspace(0, h, 33).astype(int)[:-1]
+        xs = np.linspace(0, w, 33).astype(int)[:-1]
+        small = np.add.reduceat(np.add.reduceat(gray, ys, axis=0), xs, axis=1)
+        small /= np.outer(np.diff(np.append(ys, h)), np.diff(np.append(xs, w)))
+    else:
+        ys = ((np.arange(32) + 0.5) * h / 32).astype(int)
+        xs = ((np.arange(32) + 0.5) * w / 32).astype(int)
+        small = gray[np.ix_(ys, xs)]
+    low = (_dct_matrix @ small @ _dct_matrix.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def _check_phash(np, frame, check):
+    x, y, w, h = _region(frame, check.get("region"))
+    value = _phash(np, frame.gray()[y:y + h, x:x + w].astype(np.float64))
+    result = {"hash": f"{value:016x}"}
+    if check.get("compare"):
+        try:
+            other = int(str(check["compare"]), 16)
+        except ValueError:
+            raise ValueError("compare must be a hex hash")
+        distance = bin(value ^ other).count("1")
+        result["distance"] = distance
+        result["match"] = distance <= int(check.get("max_distance", 8))
+    return result
+
+
+def _check_pixel(np, frame, check):
+    x, y = int(check.get("x", -1)), int(check.get("y", -1))
+    if not (0 <= x < frame.width and 0 <= y < frame.height):
+        raise ValueError("pixel outside screen")
+    rgb = frame.rgb[y, x].astype(int)
+    result = {"color": _hex_color(rgb)}
+    if check.get("expect") is not None:
+        expect = np.array(_parse_color(check["expect"]))
+        diff = int(np.abs(rgb - expect).max())
+        result["diff"] = diff
+        result["match"] = diff <= int(check.get("tolerance", 16))
+    return result
+
+
+def _check_color(np, frame, check):
+    """区域颜色：平均色；给了 expect 时统计与期望色相差在 tolerance 内的像素比例"""
+    x, y, w, h = _region(frame, check.get("region"))
+    pixels = frame.rgb[y:y + h, x:x + w].reshape(-1, 3)
+    result = {"mean": _hex_color(pixels.mean(axis=0))}
+    if check.get("expect") is not None:
+        expect = np.array(_parse_color(check["expect"]), dtype=np.int16)
+        diff = np.abs(pixels.astype(np.int16) - expect).max(axis=1)
+        ratio = float((diff <= int(check.get("tolerance", 16))).mean())
+        result["ratio"] = round(ratio, 4)
+        result["match"] = ratio >= float(check.get("min_ratio", 0.5))
+    return result
+
+
+def _check_changed(np, frame, check, serial):
+    """与保存的参考帧比较，灰度差超过 pixel_threshold 的像素占比超过 threshold 视为变化"""
+    name = check.get("reference")
+    with _analysis_lock:
+        reference = _references.get((serial, name))
+    if reference is None:
+        raise KeyError(f"Reference not found: {name}")
+    current = frame.gray(REFERENCE_SCALE)
+    if current.shape != reference["small"].shape:
+        return {"changed": True, "ratio": 1.0, "reason": "screen size changed"}
+    x, y, w, h = _region(frame, check.get("region"))
+    s = REFERENCE_SCALE
+    sy0, sx0 = y // s, x // s
+    sy1, sx1 = max(sy0 + 1, (y + h) // s), max(sx0 + 1, (x + w) // s)
+    diff = np.abs(current[sy0:sy1, sx0:sx1] - reference["small"][sy0:sy1, sx0:sx1])
+    mask = diff > float(check.get("pixel_threshold", 24))
+    ratio = float(mask.mean()) if mask.size else 0.0
+    result = {
+        "changed": ratio > float(check.get("threshold", 0.005)),
+        "ratio": round(ratio, 4),
+    }
+    if mask.any():
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        result["bbox"] = [
+            int((sx0 + cols[0]) * s),
+            int((sy0 + rows[0]) * s),
+            int((cols[-1] - cols[0] + 1) * s),
+            int((rows[-1] - rows[0] + 1) * s),
+        ]
+    return result
+
+
+_CHECKS = {
+    "template": _check_template,
+    "phash": _check_phash,
+    "pixel": _check_pixel,
+    "color": _check_color,
+}
+
+
+def run_checks(checks, device=None, max_age_ms=0):
+    """在同一帧上执行一组检查，返回 (结果列表, 帧信息)"""
+    np = _numpy()
+    t0 = time.monotonic()
+    frame, reused = _analysis_frame(device, max_age_ms)
+    t1 = time.monotonic()
+    serial = _resolve_device(device)
+    results = []
+    for check in checks:
+        kind = check.get("type")
+        try:
+            if kind == "changed":
+                result = _check_changed(np, frame, check, serial)
+            elif kind in _CHECKS:
+                result = _CHECKS[kind](np, frame, check)
+            else:
+                raise ValueError(f"Unknown check type: {kind}")
+            result = {"type": kind, "ok": True, **result}
+        except (KeyError, ValueError, TypeError) as e:
+            message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+            result = {"type": kind, "ok": False, "error": str(message)}
+        if check.get("id") is not None:
+            result["id"] = check["id"]
+        results.append(result)
+    t2 = time.monotonic()
+    metrics.observe("phone_agent_analysis_seconds", {}, t2 - t1)
+    return results, {
+        "width": frame.width,
+        "height": frame.height,
+        "reused_frame": reused,
+        "capture_ms": round((t1 - t0) * 1000, 1),
+        "analysis_ms": round((t2 - t1) * 1000, 1),
+    }
+
+
+@app.route("/api/screen/check", methods=["POST"])
+def api_screen_check():
+    """
+    在设备截图上执行检查，只返回结果（不回传图像）
+
+    {"checks": [{"type": "template", "template": "ok_button", "threshold": 0.85},
+                {"type": "pixel", "x": 540, "y": 200, "expect": "#ff0000", "tolerance": 16},
+                {"type": "color", "region": [0, 0, 1080, 100], "expect": "#ffffff"},
+                {"type": "phash", "region": [0, 300, 1080, 600], "compare": "c3d4..."},
+                {"type": "changed", "reference": "home", "threshold": 0.01}],
+     "max_age_ms": 0}
+    """
+    data = request.json or {}
+    checks = data.get("checks")
+    if isinstance(data.get("check"), dict):
+        checks = [data["check"]]
+    if not isinstance(checks, list) or not checks:
+        return jsonify({"success": False, "error": "checks is required"}), 400
+    try:
+        results, info = run_checks(
+            checks, _request_device(), int(data.get("max_age_ms", 0))
+        )
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True, "results": results, **info})
+
+
+@app.route("/api/screen/templates", methods=["GET", "POST"])
+def api_screen_templates():
+    """
+    GET 列出模板；POST 注册模板：
+        {"name": "ok_button", "region": [x, y, w, h]}   从当前屏幕截取
+        {"name": "ok_button", "image": "<base64 PNG>"}  上传图片（需要 Pillow）
+    """
+    if request.method == "GET":
+        try:
+            _load_templates(_numpy())
+        except RuntimeError as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+        with _templates_lock:
+            items = [
+                {"name": t["name"], "width": t["width"], "height": t["height"]}
+                for t in _templates.values()
+            ]
+        return jsonify({"success": True, "templates": sorted(items, key=lambda t: t["name"])})
+
+    data = request.json or {}
+    try:
+        np = _numpy()
+        if data.get("image"):
+            rgb = _decode_image(np, data["image"])
+        else:
+            if data.get("region") is None:
+                raise ValueError("region or image is required")
+            frame, _ = _analysis_frame(_request_device())
+            x, y, w, h = _region(frame, data["region"])
+            rgb = frame.rgb[y:y + h, x:x + w]
+        template = save_template(data.get("name"), rgb)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except (RuntimeError, OSError) as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify(
+        {
+            "success": True,
+            "name": template["name"],
+            "width": template["width"],
+            "height": template["height"],
+        }
+    )
+
+
+@app.route("/api/screen/templates/<name>", methods=["DELETE"])
+def api_screen_template_delete(name):
+    """删除模板"""
+    if not TEMPLATE_NAME_RE.fullmatch(name):
+        return jsonify({"success": False, "error": "Invalid template name"}), 400
+    try:
+        _load_templates(_numpy())
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    with _templates_lock:
+        removed = _templates.pop(name, None)
+    path = os.path.join(_template_dir(), f"{name}.npy")
+    if os.path.exists(path):
+        os.remove(path)
+    if removed is None:
+        return jsonify({"success": False, "error": f"Template not found: {name}"}), 404
+    return jsonify({"success": True})
+
+
+@app.route("/api/screen/reference", methods=["POST"])
+def api_screen_reference():
+    """
+    把当前屏幕保存为参考帧（仅内存），供 changed 检查比较
+
+    {"name": "home", "max_age_ms": 0}
+    """
+    data = request.json or {}
+    name = data.get("name") or "default"
+    if not TEMPLATE_NAME_RE.fullmatch(name):
+        return jsonify({"success": False, "error": "Invalid reference name"}), 400
+    device = _request_device()
+    try:
+        frame, _ = _analysis_frame(device, int(data.get("max_age_ms", 0)))
+        small = frame.gray(REFERENCE_SCALE).copy()
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    with _analysis_lock:
+        _references[(_resolve_device(device), name)] = {"small": small, "ts": frame.ts}
+    return jsonify(
+        {"success": True, "name": name, "width": frame.width, "height": frame.height}
+    )
+
+
+# ==================== ADB 批量动作 ====================
+
+
+def _num(value):
+    """把坐标 / 时长参数规范为数字，防止拼进设备端脚本时被注入"""
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"Invalid number: {value}")
+    return int(value) if value.is_integer() else value
+
+
+def _batch_duration(actions):
+    """动作列表本身要花的秒数（delay、sleep、swipe 时长和最晚的 at），用于放宽超时"""
+    total = max((_num(a.get("at", 0)) for a in actions), default=0)
+    for action in actions:
+        total += _num(action.get("delay", 0))
+        if action.get("type") in ("sleep", "wait"):
+            total += _num(action.get("ms", 0))
+        elif action.get("type") == "swipe":
+            total += _num(action.get("duration", 300))
+    return total / 1000
+
+
+def _compile_batch_action(action):
+    """把单个动作编译成设备端 shell 命令"""
+    kind = action.get("type")
+    if kind == "tap":
+        return f"input tap {_num(action.get('x', 0))} {_num(action.get('y', 0))}"
+    if kind == "swipe":
+        coords = " ".join(
+            str(_num(action.get(k, 0))) for k in ("x1", "y1", "x2", "y2")
+        )
+        return f"input swipe {coords} {_num(action.get('duration', 300))}"
+    if kind in ("input", "text"):
+        text = str(action.get("text", "")).replace(" ", "%s")
+        return f"input text {shlex.quote(text)}"
+    if kind == "key":
+        key = str(action.get("key", "ENTER"))
+        return f"input keyevent {shlex.quote(ADB_KEYCODES.get(key, key))}"
+    if kind == "start":
+        component = f"{action.get('package', '')}/{action.get('activity', '')}"
+        return f"am start -n {shlex.quote(component)}"
+    if kind == "shell":
+        command = action.get("command", "")
+        if not command:
+            raise ValueError("shell action requires command")
+        return command
+    if kind in ("sleep", "wait"):
+        return f"sleep {_num(action.get('ms', 0)) / 1000}"
+    raise ValueError(f"Unknown action type: {kind}")
+
+
+# 设备端计时：/proc/uptime 精度 10ms，read 是内建命令，取时间不 fork。
+# mksh 算术为 32 位，不能直接用绝对的厘秒数（开机约 248 天后溢出）：整数秒相对脚本开始的
+# __pa_s0 计，小数部分写成 1xx - 100，避免 08 / 09 这种前导零被当成八进制；
+# __pa_ms 再减去开始时的小数部分 __pa_t0，从脚本开始时刻算起
+_BATCH_CLOCK = r"""read __pa_up __pa_x < /proc/uptime; __pa_s0=${__pa_up%.*}; __pa_t0=0
+__pa_now() { read __pa_up __pa_x < /proc/uptime; __pa_ms=$(( (${__pa_up%.*} - __pa_s0) * 1000 + (1${__pa_up#*.} - 100) * 10 - __pa_t0 )); }
+__pa_now; __pa_t0=$__pa_ms
+__pa_at() {
+  __pa_now; __pa_d=$(( $1 - __pa_ms ))
+  if [ "$__pa_d" -gt 0 ]; then __pa_f=$(( __pa_d % 1000 + 1000 )); sleep $(( __pa_d / 1000 )).${__pa_f#1}; fi
+}"""
+
+
+def _compile_batch(actions, token, stop_on_error):
+    """
+    把动作列表编译成一段设备端脚本
+
+    每步前后输出 `<token> B <i>` / `<token> E <i> <rc>` 标记行，主机侧按收到
+    标记的时间计算每步耗时；未要求 capture 的步骤输出直接丢弃。
+    动作带 at（相对脚本开始的毫秒数）时按设备时钟定时执行，B 标记行附带实际开始的毫秒数。
+    """
+    lines = []
+    timed = any("at" in action for action in actions)
+    if timed:
+        lines.append(_BATCH_CLOCK)
+    for i, action in enumerate(actions):
+        cmd = _compile_batch_action(action)
+        redirect = "2>&1" if action.get("capture") else ">/dev/null 2>&1"
+        if timed:
+            if "at" in action:
+                lines.append(f"__pa_at {int(_num(action['at']))}")
+            lines.append(f'__pa_now; echo "{token} B {i} $__pa_ms"')
+        else:
+            lines.append(f"echo '{token} B {i}'")
+        lines.append(f"{{ {cmd}\n}} {redirect}")
+        lines.append("__pa_rc=$?")
+        lines.append(f"echo; echo \"{token} E {i} $__pa_rc\"")
+        if stop_on_error:
+            lines.append('[ "$__pa_rc" -eq 0 ] || exit "$__pa_rc"')
+        delay = _num(action.get("delay", 0))
+        if delay > 0:
+            lines.append(f"sleep {delay / 1000}")
+    return "\n".join(lines) + "\n"
+
+
+@app.route("/api/adb/batch", methods=["POST"])
+def api_adb_batch():
+    """
+    批量执行 ADB 动作：整段脚本一次下发到设备，一个往返完成
+
+    请求格式：
+    {
+        "actions": [
+            {"type": "tap", "x": 500, "y": 800, "delay": 200},
+            {"type": "text", "text": "hello world"},
+            {"type": "key", "key": "ENTER", "capture": true},
+            {"type": "swipe", "x1": 500, "y1": 1500, "x2": 500, "y2": 500},
+            {"type": "shell", "command": "dumpsys battery", "capture": true}
+        ],
+        "stop_on_error": false,
+        "timeout": 30
+    }
+
+    delay 为该步结束后的等待毫秒数；capture=true 时返回该步 stdout+stderr。
+    at 为该步相对脚本开始的毫秒数，由设备端计时等到该时刻再执行（步骤带 device_ms 实际开始时刻）。
+    """
+    data = request.json or {}
+    actions = data.get("actions") or []
+    stop_on_error = bool(data.get("stop_on_error", False))
+    if not isinstance(actions, list) or not actions:
+        return jsonify({"success": False, "error": "No actions specified"}), 400
+    for i, action in enumerate(actions):
+        if not isinstance(action, dict):
+            return jsonify({"success": False, "error": f"Action {i} must be an object"}), 400
+
+    token = f"__PA_STEP_{uuid.uuid4().hex}__"
+    try:
+        script = _compile_batch(actions, token, stop_on_error)
+    except (ValueError, TypeError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    steps = [
+        {"index": i, "type": a.get("type"), "status": None, "skipped": True}
+        for i, a in enumerate(actions)
+    ]
+    marker = token.encode()
+    state = {"output": [], "begin": 0.0}
+    start = time.monotonic()
+
+    def on_line(line):
+        now = time.monotonic()
+        idx = line.find(marker)
+        if idx < 0:
+            state["output"].append(line)
+            return
+        if idx > 0:
+            state["output"].append(line[:idx])
+        fields = line[idx + len(marker):].split()
+        i = int(fields[1])
+        if fields[0] == b"B":
+            state["output"] = []
+            state["begin"] = now
+            state["device_ms"] = int(fields[2]) if len(fields) > 2 else None
+            return
+        step = steps[i]
+        step.pop("skipped", None)
+        step["status"] = int(fields[2])
+        step["ok"] = step["status"] == 0
+        step["started_ms"] = round((state["begin"] - start) * 1000, 1)
+        if state["device_ms"] is not None:
+            step["device_ms"] = state["device_ms"]
+        step["elapsed_ms"] = round((now - state["begin"]) * 1000, 1)
+        if actions[i].get("capture"):
+            # 去掉标记前补的换行
+            output = b"".join(state["output"])
+            if output.endswith(b"\n"):
+                output = output[:-1]
+            step["output"] = output.decode("utf-8", "replace")
+
+    timeout = load_config()["adb"].get("session_timeout", 10) + _batch_duration(actions)
+    if data.get("timeout") is not None:
+        try:
+            timeout = float(data["timeout"])
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "timeout must be a number"}), 400
+    device = _request_device()
+    _invalidate_ui_cache(device)
+    result = adb_shell(script, timeout=timeout, on_line=on_line, device=device, ordered=True)
+
+    completed = sum(1 for s in steps if s["status"] is not None)
+    return jsonify(
+        {
+            "success": result.get("success", False)
+            and all(s.get("ok") for s in steps),
+            "error": result.get("error"),
+            "steps": steps,
+            "completed": completed,
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+        }
+    )
+
+
+# ==================== 实时控制通道（WebSocket） ====================
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_MAX_MESSAGE = 1024 * 1024
+CONTROL_EVENT_TYPES = {"tap", "swipe", "key", "text", "input", "sleep"}
+CONTROL_MAX_BATCH = 64  # 一次下发到设备的最多事件数
+CONTROL_QUEUE_SIZE = 1000
+
+
+class WebSocket:
+    """最小的服务端 WebSocket（RFC 6455）：文本 / 二进制消息、分片、ping/pong、close"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def _recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("WebSocket closed")
+            buf += chunk
+        return bytes(buf)
+
+    def _send_frame(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack(">BB", 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, n)
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionError("WebSocket closed")
+            self.sock.sendall(header + payload)
+
+    def send(self, text):
+        self._send_frame(0x1, text.encode())
+
+    def recv(self):
+        """返回下一条完整消息（str / bytes）；对端关闭时返回 None"""
+        message = bytearray()
+        kind = None
+        while True:
+            b1, b2 = self._recv_exact(2)
+            opcode = b1 & 0x0F
+            n = b2 & 0x7F
+            if n == 126:
+                n = struct.unpack(">H", self._recv_exact(2))[0]
+            elif n == 127:
+                n = struct.unpack(">Q", self._recv_exact(8))[0]
+            if n + len(message) > WS_MAX_MESSAGE:
+                raise ConnectionError("WebSocket message too large")
+            mask = self._recv_exact(4) if b2 & 0x80 else None
+            payload = self._recv_exact(n)
+            if mask and n:
+                key = (mask * (n // 4 + 1))[:n]
+                payload = (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(n, "big")
+
+            if opcode == 0x8:
+                self.close()
+                return None
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            if opcode in (0x1, 0x2):
+                kind = opcode
+            message += payload
+            if b1 & 0x80:
+                data = bytes(message)
+                return data.decode("utf-8", "replace") if kind == 0x1 else data
+
+    def close(self):
+        with self.send_lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(struct.pack(">BBH", 0x88, 2, 1000))
+            except OSError:
+                pass
+            self.closed = True
+        try:
+            # 让 werkzeug 随后读到 EOF 并关闭连接，而不是等下一个请求
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _WebSocketDone(Response):
+    """连接已被 WebSocket 接管：让 werkzeug 按连接断开处理，不再写 HTTP 响应"""
+
+    def __call__(self, environ, start_response):
+        raise ConnectionError("WebSocket closed")
+
+
+def _parse_control_message(message):
+    """
+    解析一条控制消息，返回事件列表
+
+    JSON：单个事件对象或事件数组，字段同批量动作；
+    紧凑文本：每行一个事件，如 `tap 500 800`、`swipe 500 1500 500 500 200`、`key BACK`、`text hello`、`sleep 100`
+    """
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    text = message.strip()
+    if not text:
+        return []
+    if text[0] in "{[":
+        data = json.loads(text)
+        events = data if isinstance(data, list) else [data]
+        if not all(isinstance(e, dict) for e in events):
+            raise ValueError("Events must be objects")
+        return events
+
+    events = []
+    for line in text.splitlines():
+        kind, _, rest = line.strip().partition(" ")
+        args = rest.split()
+        if not kind:
+            continue
+        if kind == "tap":
+            events.append({"type": "tap", "x": args[0], "y": args[1]})
+        elif kind == "swipe":
+            event = dict(zip(("x1", "y1", "x2", "y2", "duration"), args))
+            events.append({"type": "swipe", **event})
+        elif kind == "key":
+            events.append({"type": "key", "key": rest.strip()})
+        elif kind == "text":
+            events.append({"type": "text", "text": rest})
+        elif kind == "sleep":
+            events.append({"type": "sleep", "ms": args[0]})
+        else:
+            raise ValueError(f"Unknown event: {kind}")
+    return events
+
+
+class ControlSession:
+    """
+    一个控制连接
+
+    读线程只负责解析和入队，发送线程把队列里积压的事件合并成一段脚本经会话池下发，
+    每步完成（收到结束标记）时立即回 ack，不等整批结束。事件按到达顺序执行。
+    """
+
+    def __init__(self, ws, device):
+        self.ws = ws
+        self.device = device
+        self.events = queue.Queue(CONTROL_QUEUE_SIZE)
+        self.seq = 0
+        self.connected_at = time.time()
+        self.stats = {"received": 0, "acked": 0, "failed": 0, "batches": 0}
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _ack(self, event, ok, **extra):
+        msg = {"ack": event["seq"], "ok": ok, **extra}
+        if event.get("id") is not None:
+            msg["id"] = event["id"]
+        self.stats["acked" if ok else "failed"] += 1
+        try:
+            self.ws.send(json.dumps(msg))
+        except (OSError, ConnectionError):
+            pass
+
+    def submit(self, action):
+        self.seq += 1
+        self.stats["received"] += 1
+        event = {"seq": self.seq, "id": action.get("id"), "action": action, "at": time.monotonic()}
+        try:
+            if action.get("type") not in CONTROL_EVENT_TYPES:
+                raise ValueError(f"Unsupported event type: {action.get('type')}")
+            _compile_batch_action(action)
+        except (ValueError, TypeError, IndexError) as e:
+            self._ack(event, False, error=str(e))
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self._ack(event, False, error="Queue full")
+
+    def close(self):
+        # 丢弃尚未下发的事件
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+        self.events.put(None)
+
+    def _worker(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            batch = [event]
+            stop = False
+            while len(batch) < CONTROL_MAX_BATCH:
+                try:
+                    nxt = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self._run(batch)
+            if stop:
+                return
+
+    def _run(self, batch):
+        self.stats["batches"] += 1
+        actions = [e["action"] for e in batch]
+        token = f"__PA_STEP_{uuid.uuid4().hex}__"
+        marker = token.encode()
+        acked = set()
+
+        def on_line(line):
+            idx = line.find(marker)
+            if idx < 0:
+                return
+            fields = line[idx + len(marker):].split()
+            if fields[0] != b"E":
+                return
+            i = int(fields[1])
+            status = int(fields[2])
+            acked.add(i)
+            ms = round((time.monotonic() - batch[i]["at"]) * 1000, 1)
+            self._ack(batch[i], status == 0, status=status, ms=ms)
+
+        timeout = load_config()["adb"].get("session_timeout", 10) + _batch_duration(actions)
+        _invalidate_ui_cache(self.device)
+        result = adb_shell(
+            _compile_batch(actions, token, stop_on_error=False),
+            timeout=timeout,
+            on_line=on_line,
+            device=self.device,
+            ordered=True,
+        )
+        for i, event in enumerate(batch):
+            if i not in acked:
+                self._ack(event, False, error=result.get("error") or "No result")
+
+    def info(self):
+        return {
+            "device": _resolve_device(self.device),
+            "connected_at": self.connected_at,
+            "queued": self.events.qsize(),
+            **self.stats,
+        }
+
+
+_control_sessions = set()
+_control_lock = threading.Lock()
+
+
+@app.route("/api/control", websocket=True)
+def api_control():
+    """
+    持久控制通道（WebSocket）：ws://<手机IP>:50001/api/control[?device=SERIAL]
+
+    连接后服务端先发 {"ready": true}；客户端发送事件（JSON 对象 / 数组，或紧凑文本行），
+    事件按顺序流水线下发到设备，每个事件完成后异步回
+    {"ack": 序号, "id": 客户端 id, "ok": true, "status": 0, "ms": 从收到到完成的毫秒数}。
+    序号为该连接内事件的递增编号（从 1 开始）。
+    """
+    # websocket=True：只有 Upgrade: websocket 的请求会匹配到这里
+    sock = request.environ.get("werkzeug.socket")
+    key = request.headers.get("Sec-WebSocket-Key")
+    if not key:
+        return jsonify({"success": False, "error": "Missing Sec-WebSocket-Key"}), 400
+    if sock is None:
+        return jsonify({"success": False, "error": "Server does not support WebSocket"}), 501
+
+    device = _request_device()
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+    sock.sendall(
+        (
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode()
+    )
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+    ws = WebSocket(sock)
+    session = ControlSession(ws, device)
+    with _control_lock:
+        _control_sessions.add(session)
+    try:
+        ws.send(json.dumps({"ready": True, "device": _resolve_device(device)}))
+        while True:
+            message = ws.recv()
+            if message is None:
+                break
+            try:
+                events = _parse_control_message(message)
+            except (ValueError, IndexError) as e:
+                ws.send(json.dumps({"error": f"Bad message: {e}"}))
+                continue
+            for action in events:
+                session.submit(action)
+    except (OSError, ConnectionError):
+        pass
+    finally:
+        session.close()
+        ws.close()
+        with _control_lock:
+            _control_sessions.discard(session)
+    return _WebSocketDone()
+
+
+@app.route("/api/control/status")
+def api_control_status():
+    """当前控制连接及其事件统计"""
+    with _control_lock:
+        sessions = [s.info() for s in _control_sessions]
+    return jsonify({"success": True, "sessions": sessions})
+
+
+# ==================== 手势（多点触控事件流） ====================
+
+GESTURE_DIR = "/data/local/tmp"
+GESTURE_CACHE_SIZE = 128
+GESTURE_PUSH_CHUNK = 48 * 1024  # 单个 sh -c 参数不能超过 128KB，分块写入设备
+EV_SYN, EV_KEY, EV_ABS = 0, 1, 3
+BTN_TOUCH = 330
+ABS_MT_SLOT = 47
+ABS_MT_TOUCH_MAJOR = 48
+ABS_MT_POSITION_X = 53
+ABS_MT_POSITION_Y = 54
+ABS_MT_TRACKING_ID = 57
+ABS_MT_PRESSURE = 58
+
+GESTURE_ROTATION_TTL = 2  # 屏幕方向缓存超过这个秒数后在后台刷新（方向随时可能变化，触摸设备参数则不会）
+GESTURE_MAX_SPAN_MS = 60000  # 手势总时长上限
+GESTURE_MAX_FRAMES = 10000  # 采样后的帧数上限
+GESTURE_MAX_POINTS = 10000  # 每根手指的路径点数上限
+
+_touch_calibrations = {}  # serial -> 触摸屏参数（None 表示不支持 sendevent）
+_display_rotations = {}  # serial -> (读取时间, 方向 0-3)
+_rotation_refreshing = set()  # 正在后台刷新方向的 serial
+_gesture_cache = collections.OrderedDict()  # 哈希 -> 编译结果
+_gesture_pushed = collections.defaultdict(set)  # serial -> 已写入设备的脚本哈希
+_gesture_lock = threading.Lock()
+
+
+def _parse_getevent(output):
+    """解析 `getevent -pl`，返回第一个多点触控设备 {"path", "abs": {名字: (min, max)}, "btn_touch"}"""
+    devices = []
+    current = None
+    for line in output.splitlines():
+        m = re.match(r"add device \d+: (\S+)", line)
+        if m:
+            current = {"path": m.group(1), "abs": {}, "btn_touch": False}
+            devices.append(current)
+            continue
+        if current is None:
+            continue
+        m = re.search(r"(ABS_\w+)\s*:\s*value -?\d+, min (-?\d+), max (-?\d+)", line)
+        if m:
+            current["abs"][m.group(1)] = (int(m.group(2)), int(m.group(3)))
+        if "BTN_TOUCH" in line:
+            current["btn_touch"] = True
+    for dev in devices:
+        axes = dev["abs"]
+        if "ABS_MT_POSITION_X" in axes and "ABS_MT_POSITION_Y" in axes and "ABS_MT_SLOT" in axes:
+            return dev
+    return None
+
+
+def _read_rotation(device, serial):
+    """读取 `dumpsys input` 中触摸屏的 SurfaceOrientation（0-3，即旋转 0/90/180/270 度）"""
+    try:
+        result = adb_shell("dumpsys input | grep -m 1 SurfaceOrientation", device=device)
+        m = re.search(r"SurfaceOrientation:\s*(\d)", result.get("stdout", ""))
+        rotation = int(m.group(1)) % 4 if m else 0
+        with _gesture_lock:
+            if result.get("success"):
+                _display_rotations[serial] = (time.monotonic(), rotation)
+        return rotation
+    finally:
+        with _gesture_lock:
+            _rotation_refreshing.discard(serial)
+
+
+def _display_rotation(device=None, refresh=False):
+    """
+    当前屏幕方向
+
+    只有第一次（或 refresh）同步读取；之后直接用缓存值，超过 GESTURE_ROTATION_TTL 时在后台刷新，
+    编译路径上不再有设备往返，重复的手势仍只需查哈希缓存。转屏后最多一个手势用的还是旧方向。
+    """
+    serial = _resolve_device(device)
+    with _gesture_lock:
+        cached = _display_rotations.get(serial)
+        stale = cached is None or time.monotonic() - cached[0] >= GESTURE_ROTATION_TTL
+        if cached is not None and not refresh:
+            if stale and serial not in _rotation_refreshing:
+                _rotation_refreshing.add(serial)
+                threading.Thread(target=_read_rotation, args=(device, serial), daemon=True).start()
+            return cached[1]
+        _rotation_refreshing.add(serial)
+    return _read_rotation(device, serial)
+
+
+def _touch_calibration(device=None, refresh=False):
+    """
+    读取触摸屏设备节点、坐标范围和屏幕自然方向尺寸（每台设备缓存一次），
+    再附上当前屏幕方向 rotation（短时缓存）
+    """
+    serial = _resolve_device(device)
+    with _gesture_lock:
+        cached = not refresh and serial in _touch_calibrations
+        calibration = _touch_calibrations.get(serial)
+    if not cached:
+        result = adb_shell("getevent -pl 2>/dev/null; echo __PA_WM__; wm size", device=device)
+        output = result.get("stdout", "")
+        touch, _, wm = output.partition("__PA_WM__")
+        calibration = _parse_getevent(touch)
+        sizes = dict(re.findall(r"(Physical|Override) size: (\d+x\d+)", wm))
+        size = sizes.get("Override") or sizes.get("Physical")
+        if calibration is not None and size:
+            w, h = size.split("x")
+            calibration["screen"] = (int(w), int(h))
+        elif calibration is not None:
+            calibration = None
+        if not result.get("success"):
+            return None  # 设备暂时不可用时不缓存
+        with _gesture_lock:
+            _touch_calibrations[serial] = calibration
+    if calibration is None:
+        return None
+    return {**calibration, "rotation": _display_rotation(device, refresh)}
+
+
+def _normalize_gesture(data):
+    """
+    把请求中的路径规范成 [[(t_ms, x, y), ...], ...]，每个元素一根手指
+
+    点可以是 [x, y] / [x, y, t] / {"x", "y", "t"}；没有 t 时按路径长度在 duration 内匀速分布，
+    只有一个点时视为在该处按住 duration 毫秒。start 为该手指相对手势开始的延迟。
+    总时长超过 GESTURE_MAX_SPAN_MS、点数超过 GESTURE_MAX_POINTS 时抛 ValueError。
+    """
+    pointers = data.get("pointers")
+    if pointers is None and data.get("path"):
+        pointers = [{"points": data["path"]}]
+    if not isinstance(pointers, list) or not pointers:
+        raise ValueError("No pointers specified")
+    if len(pointers) > 10:
+        raise ValueError("Too many pointers")
+    duration = _num(data.get("duration", 300))
+
+    result = []
+    for pointer in pointers:
+        if isinstance(pointer, dict):
+            raw, start = pointer.get("points") or [], _num(pointer.get("start", 0))
+            pointer_duration = _num(pointer.get("duration", duration))
+        else:
+            raw, start, pointer_duration = pointer, 0, duration
+        if start < 0 or pointer_duration < 0:
+            raise ValueError("start and duration must not be negative")
+        if len(raw) > GESTURE_MAX_POINTS:
+            raise ValueError(f"Too many points (max {GESTURE_MAX_POINTS})")
+        points = []
+        for pt in raw:
+            if isinstance(pt, dict):
+                x, y, t = pt["x"], pt["y"], pt.get("t")
+            else:
+                x, y, t = pt[0], pt[1], pt[2] if len(pt) > 2 else None
+            points.append((_num(x), _num(y), None if t is None else _num(t)))
+        if not points:
+            raise ValueError("Empty pointer path")
+        if len(points) == 1:
+            x, y, t = points[0]
+            t = start + (t or 0)
+            result.append([(t, x, y), (t + pointer_duration, x, y)])
+            continue
+        if all(t is not None for _, _, t in points):
+            timed = sorted((start + t, x, y) for x, y, t in points)
+        else:
+            lengths = [0.0]
+            for (x0, y0, _), (x1, y1, _) in zip(points, points[1:]):
+                lengths.append(lengths[-1] + ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5)
+            total = lengths[-1]
+            timed = [
+                (start + pointer_duration * (lengths[i] / total if total else i / (len(points) - 1)), x, y)
+                for i, (x, y, _) in enumerate(points)
+            ]
+        result.append([(round(t, 3), round(x, 2), round(y, 2)) for t, x, y in timed])
+    span = max(p[-1][0] for p in result) - min(p[0][0] for p in result)
+    if span > GESTURE_MAX_SPAN_MS:
+        raise ValueError(f"Gesture too long: {span:.0f} ms (max {GESTURE_MAX_SPAN_MS})")
+    return result
+
+
+def _interp(points, t):
+    if t <= points[0][0]:
+        return points[0][1], points[0][2]
+    for (t0, x0, y0), (t1, x1, y1) in zip(points, points[1:]):
+        if t <= t1:
+            k = (t - t0) / (t1 - t0) if t1 > t0 else 1.0
+            return x0 + (x1 - x0) * k, y0 + (y1 - y0) * k
+    return points[-1][1], points[-1][2]
+
+
+def _gesture_frames(pointers, sample_ms):
+    """按 sample_ms 采样，返回 [(t_ms, [(slot, "down"|"move"|"up", x, y), ...])]"""
+    starts = [p[0][0] for p in pointers]
+    ends = [max(p[-1][0], p[0][0] + sample_ms) for p in pointers]  # 至少保持一帧
+    t_min, t_max = min(starts), max(ends)
+    times = set(starts) | set(ends)
+    t = t_min
+    while t < t_max:
+        times.add(round(t, 3))
+        t += sample_ms
+    frames = []
+    state = {}
+    for t in sorted(times):
+        changes = []
+        for slot, points in enumerate(pointers):
+            if t < starts[slot] or state.get(slot) == "up":
+                continue
+            x, y = _interp(points, t)
+            if slot not in state:
+                changes.append((slot, "down", x, y))
+                state[slot] = "down"
+            elif t >= ends[slot]:
+                changes.append((slot, "up", x, y))
+                state[slot] = "up"
+            else:
+                changes.append((slot, "move", x, y))
+        if changes:
+            frames.append((t, changes))
+    return frames
+
+
+def _compile_sendevent(frames, calibration):
+    """
+    把帧编译成 sendevent 脚本，返回 (脚本, 事件数)
+
+    坐标按当前屏幕方向换算回触摸屏的自然方向（横屏时 x / y 互换、翻转）。
+    """
+    dev = calibration["path"]
+    axes = calibration["abs"]
+    sw, sh = calibration["screen"]
+    rotation = calibration.get("rotation", 0)
+    (x_min, x_max), (y_min, y_max) = axes["ABS_MT_POSITION_X"], axes["ABS_MT_POSITION_Y"]
+
+    def scale(x, y):
+        if rotation == 1:
+            x, y = sw - 1 - y, x
+        elif rotation == 2:
+            x, y = sw - 1 - x, sh - 1 - y
+        elif rotation == 3:
+            x, y = y, sh - 1 - x
+        return (
+            round(x_min + x * (x_max - x_min) / max(sw - 1, 1)),
+            round(y_min + y * (y_max - y_min) / max(sh - 1, 1)),
+        )
+
+    lines = [_BATCH_CLOCK]
+    events = 0
+    current_slot = None
+    positions = {}
+    touching = 0
+    t0 = frames[0][0]
+    for t, changes in frames:
+        frame = []
+        for slot, kind, x, y in changes:
+            ax, ay = scale(x, y)
+            ev = []
+            if kind == "down":
+                ev.append((EV_ABS, ABS_MT_TRACKING_ID, 1000 + slot))
+                if "ABS_MT_TOUCH_MAJOR" in axes:
+                    ev.append((EV_ABS, ABS_MT_TOUCH_MAJOR, max(1, axes["ABS_MT_TOUCH_MAJOR"][1] // 16)))
+                if "ABS_MT_PRESSURE" in axes:
+                    ev.append((EV_ABS, ABS_MT_PRESSURE, max(1, axes["ABS_MT_PRESSURE"][1] // 2)))
+            old = positions.get(slot, (None, None))
+            if ax != old[0]:
+                ev.append((EV_ABS, ABS_MT_POSITION_X, ax))
+            if ay != old[1]:
+                ev.append((EV_ABS, ABS_MT_POSITION_Y, ay))
+            positions[slot] = (ax, ay)
+            if kind == "up":
+                ev.append((EV_ABS, ABS_MT_TRACKING_ID, -1))
+                positions.pop(slot, None)
+            if not ev:
+                continue  # 位置没变化
+            if slot != current_slot:
+                frame.append((EV_ABS, ABS_MT_SLOT, slot))
+                current_slot = slot
+            frame.extend(ev)
+            if calibration.get("btn_touch"):
+                if kind == "down" and touching == 0:
+                    frame.append((EV_KEY, BTN_TOUCH, 1))
+                elif kind == "up" and touching == 1:
+                    frame.append((EV_KEY, BTN_TOUCH, 0))
+            touching += {"down": 1, "up": -1}.get(kind, 0)
+        if not frame:
+            continue
+        frame.append((EV_SYN, 0, 0))
+        # sendevent 每条都是一个进程，耗时因机器和负载而异：按设备时钟等到帧的计划时刻，
+        # 而不是固定的帧间隔，落后时不再累积
+        lines.append(f"__pa_at {round(t - t0)}")
+        lines.extend(f"sendevent {dev} {a} {b} {c}" for a, b, c in frame)
+        events += len(frame)
+    return "\n".join(lines) + "\n", events
+
+
+def _compile_motionevent(frames):
+    """单指回退方案：input motionevent（每个事件一个进程，较慢，时间精度有限）"""
+    lines = [_BATCH_CLOCK]
+    t0 = frames[0][0]
+    for t, changes in frames:
+        slot, kind, x, y = changes[0]
+        lines.append(f"__pa_at {round(t - t0)}")
+        lines.append(f"input motionevent {kind.upper()} {round(x)} {round(y)}")
+    return "\n".join(lines) + "\n", len(frames)
+
+
+def compile_gesture(data, device=None):
+    """编译手势，结果按内容哈希缓存；返回 (编译结果, 是否命中缓存)"""
+    pointers = _normalize_gesture(data)
+    conf = load_config().get("gesture", {})
+    sample_ms = max(4.0, _num(data.get("sample_ms", conf.get("sample_ms", 16))))
+    span = max(p[-1][0] for p in pointers) - min(p[0][0] for p in pointers)
+    if span / sample_ms + sum(len(p) for p in pointers) > GESTURE_MAX_FRAMES:
+        raise ValueError(f"Too many frames (max {GESTURE_MAX_FRAMES}); increase sample_ms")
+    mode = data.get("mode", "auto")
+    calibration = None
+    if mode in ("auto", "sendevent"):
+        calibration = _touch_calibration(device)
+        if calibration is None:
+            if mode == "sendevent":
+                raise RuntimeError("No multi-touch input device found (sendevent unavailable)")
+            mode = "motionevent"
+        else:
+            mode = "sendevent"
+    if mode == "motionevent" and len(pointers) > 1:
+        raise RuntimeError("Multi-touch requires sendevent access to the touch device")
+    if mode not in ("sendevent", "motionevent"):
+        raise ValueError(f"Unknown mode: {mode}")
+
+    key_src = json.dumps(
+        {"p": pointers, "m": mode, "s": sample_ms, "cal": calibration and {
+            "path": calibration["path"], "abs": calibration["abs"], "screen": calibration["screen"],
+            "btn": calibration["btn_touch"], "rot": calibration["rotation"]}},
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(key_src.encode()).hexdigest()
+    with _gesture_lock:
+        compiled = _gesture_cache.get(digest)
+        if compiled is not None:
+            _gesture_cache.move_to_end(digest)
+            return compiled, True
+
+    frames = _gesture_frames(pointers, sample_ms)
+    if mode == "sendevent":
+        script, events = _compile_sendevent(frames, calibration)
+    else:
+        script, events = _compile_motionevent(frames)
+    compiled = {
+        "hash": digest,
+        "mode": mode,
+        "script": script,
+        "frames": len(frames),
+        "events": events,
+        "duration_ms": round(frames[-1][0] - frames[0][0], 1),
+    }
+    with _gesture_lock:
+        _gesture_cache[digest] = compiled
+        while len(_gesture_cache) > GESTURE_CACHE_SIZE:
+            _gesture_cache.popitem(last=False)
+    return compiled, False
+
+
+def _push_gesture(compiled, path, device):
+    """分块把脚本写到设备文件"""
+    script = compiled["script"]
+    chunks, start = [], 0
+    while start < len(script):
+        end = script.rfind("\n", start, start + GESTURE_PUSH_CHUNK) + 1
+        if end <= start:
+            end = start + GESTURE_PUSH_CHUNK
+        chunks.append(script[start:end])
+        start = end
+    for i, chunk in enumerate(chunks):
+        redirect = ">" if i == 0 else ">>"
+        result = adb_shell(f"cat {redirect} {path} <<'__PA_EOF__'\n{chunk}__PA_EOF__", device=device)
+        if not result.get("success") or result.get("returncode", 0) != 0:
+            raise RuntimeError(result.get("error") or result.get("stderr") or "Push failed")
+
+
+def _gesture_path(compiled):
+    return f"{GESTURE_DIR}/pa_gesture_{compiled['hash'][:16]}.sh"
+
+
+def _ensure_gesture(compiled, device=None):
+    """脚本尚未写入该设备时写入，返回本次是否写入"""
+    serial = _resolve_device(device)
+    with _gesture_lock:
+        if compiled["hash"] in _gesture_pushed[serial]:
+            return False
+    _push_gesture(compiled, _gesture_path(compiled), device)
+    with _gesture_lock:
+        _gesture_pushed[serial].add(compiled["hash"])
+    return True
+
+
+def replay_gesture(compiled, device=None):
+    """在设备上回放编译好的手势：脚本按哈希写入设备一次，之后只需 `sh 文件`"""
+    serial = _resolve_device(device)
+    path = _gesture_path(compiled)
+    timeout = load_config()["adb"].get("session_timeout", 10) + compiled["duration_ms"] / 1000 * 2
+    pushed = False
+    for _ in range(2):
+        pushed = _ensure_gesture(compiled, device) or pushed
+        _invalidate_ui_cache(device)
+        result = adb_shell(
+            f"if [ -f {path} ]; then sh {path}; else echo __PA_GESTURE_MISSING__; fi",
+            timeout=timeout,
+            device=device,
+            ordered=True,
+        )
+        if "__PA_GESTURE_MISSING__" not in result.get("stdout", ""):
+            return result, pushed
+        # 设备上的文件被清理了：重新写入
+        with _gesture_lock:
+            _gesture_pushed[serial].discard(compiled["hash"])
+    return {"success": False, "error": "Gesture script missing on device"}, pushed
+
+
+@app.route("/api/adb/gesture", methods=["POST"])
+def api_adb_gesture():
+    """
+    任意路径 / 多点触控手势
+
+    请求格式：
+    {
+        "pointers": [
+            {"points": [[300, 1200, 0], [300, 800, 200], [600, 600, 400]]},
+            {"points": [[800, 1200], [800, 1600]], "start": 50, "duration": 350}
+        ],
+        "duration": 300,     // 点不带时间戳时的默认时长（毫秒）
+        "sample_ms": 16,     // 采样间隔
+        "mode": "auto"       // auto | sendevent | motionevent
+    }
+
+    单指可简写为 "path": [[x, y], ...]。手势一次编译为设备端 sendevent 脚本
+    （无权限访问触摸设备时回退到单指 input motionevent），按内容哈希缓存，
+    脚本写入设备后重复回放只需一条命令。
+    """
+    data = request.json or {}
+    device = _request_device()
+    started = time.perf_counter()
+    try:
+        compiled, cached = compile_gesture(data, device)
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 422
+    compile_ms = round((time.perf_counter() - started) * 1000, 1)
+    if data.get("dry_run"):
+        return jsonify({"success": True, "cached": cached, "compile_ms": compile_ms, **compiled})
+    try:
+        result, pushed = replay_gesture(compiled, device)
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e), "hash": compiled["hash"]}), 500
+    return jsonify(
+        {
+            "success": result.get("success", False) and result.get("returncode", 0) == 0,
+            "error": result.get("error") or (result.get("stderr") or None),
+            "hash": compiled["hash"],
+            "mode": compiled["mode"],
+            "cached": cached,
+            "pushed": pushed,
+            "frames": compiled["frames"],
+            "events": compiled["events"],
+            "duration_ms": compiled["duration_ms"],
+            "compile_ms": compile_ms,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+    )
+
+
+# ==================== UI 层级解析与选择器 ====================
+
+UI_DUMP_PATH = "/sdcard/window_dump.xml"
+UI_INDEX_FIELDS = ("text", "resource_id", "content_desc", "class")
+UI_BOOL_FIELDS = (
+    "checkable",
+    "checked",
+    "clickable",
+    "enabled",
+    "focusable",
+    "focused",
+    "scrollable",
+    "long_clickable",
+    "password",
+    "selected",
+)
+
+
+_ui_dump_locks = collections.defaultdict(threading.Lock)  # serial -> 锁，dump 共用同一个文件
+
+
+def _dump_ui_xml(device=None, timeout=None):
+    """dump 与读取合并成一条设备端命令，只走一次往返"""
+    with _ui_dump_locks[_resolve_device(device)]:
+        return adb_shell(
+            f"uiautomator dump {UI_DUMP_PATH} >/dev/null && cat {UI_DUMP_PATH}",
+            timeout=timeout,
+            device=device,
+        )
+
+
+def _parse_bounds(value):
+    try:
+        x1, y1, x2, y2 = (int(v) for v in value.replace("][", ",").strip("[]").split(","))
+    except ValueError:
+        return None
+    return [x1, y1, x2, y2]
+
+
+class UiTree:
+    """解析后的 UI 层级：节点列表 + 按 text / resource-id / content-desc / class 的索引"""
 
+    def __init__(self, xml_text):
+        self.xml = xml_text
+        self.nodes = []
+        self.index = {field: {} for field in UI_INDEX_FIELDS}
+        start = xml_text.find("<")
+        root = ET.fromstring(xml_text[start:] if start > 0 else xml_text)
+        self._walk_children(root, None, "", "", 0)
 
-def run_cmd(cmd, timeout=10):
-    try:
-        result = subprocess.run(
-            cmd, shell=True, capture_output=True, text=True, timeout=timeout
+    def _walk_children(self, elem, parent, path, key, depth):
+        # key 是节点的稳定标识：祖先链上的 类名#resource-id[同类兄弟序号]，
+        # 兄弟节点插入/删除其他类型的节点时不会变化，用于增量 diff
+        seen = {}
+        for i, child in enumerate(elem):
+            name = child.attrib.get("class", "").rsplit(".", 1)[-1]
+            if child.attrib.get("resource-id"):
+                name += "#" + child.attrib["resource-id"]
+            n = seen.get(name, 0)
+            seen[name] = n + 1
+            self._walk(
+                child,
+                f"{path}.{i}" if path else str(i),
+                f"{key}/{name}[{n}]",
+                parent,
+                depth,
+            )
+
+    def _walk(self, elem, path, key, parent, depth):
+        attrs = elem.attrib
+        bounds = _parse_bounds(attrs.get("bounds", ""))
+        node = {
+            "id": len(self.nodes),
+            "key": key,
+            "path": path,
+            "parent": parent,
+            "depth": depth,
+            "text": attrs.get("text", ""),
+            "resource_id": attrs.get("resource-id", ""),
+            "content_desc": attrs.get("content-desc", ""),
+            "class": attrs.get("class", ""),
+            "package": attrs.get("package", ""),
+            "bounds": bounds,
+            "center": [(bounds[0] + bounds[2]) // 2, (bounds[1] + bounds[3]) // 2]
+            if bounds
+            else None,
+        }
+        for field in UI_BOOL_FIELDS:
+            node[field] = attrs.get(field.replace("_", "-")) == "true"
+        self.nodes.append(node)
+        for field in UI_INDEX_FIELDS:
+            if node[field]:
+                self.index[field].setdefault(node[field], []).append(node["id"])
+        self._walk_children(elem, node["id"], path, key, depth + 1)
+
+    def find(self, selector):
+        """
+        按选择器查找节点，返回节点列表（文档顺序）
+
+        精确字段（text / resource_id / content_desc / class）先走索引缩小候选集，
+        其余条件（*_contains、布尔属性、package）逐个过滤。
+        """
+        candidates = None
+        for field in UI_INDEX_FIELDS:
+            if field in selector:
+                ids = self.index[field].get(str(selector[field]), [])
+                if candidates is None:
+                    candidates = ids
+                else:
+                    ids = set(ids)
+                    candidates = [i for i in candidates if i in ids]
+        nodes = self.nodes if candidates is None else [self.nodes[i] for i in candidates]
+
+        checks = []
+        for key, value in selector.items():
+            if key in UI_INDEX_FIELDS or key == "index":
+                continue
+            if key.endswith("_contains"):
+                field, needle = key[: -len("_contains")], str(value)
+                checks.append(lambda n, f=field, v=needle: v in (n.get(f) or ""))
+            elif key in UI_BOOL_FIELDS:
+                checks.append(lambda n, f=key, v=bool(value): n[f] == v)
+            elif key == "package":
+                checks.append(lambda n, v=value: n["package"] == v)
+            else:
+                raise ValueError(f"Unknown selector key: {key}")
+        return [n for n in nodes if all(check(n) for check in checks)]
+
+
+_ui_caches = {}  # serial -> {"tree", "at", "generation", "dumped_generation"}
+_ui_cache_lock = threading.Lock()
+
+
+def _ui_cache_entry(serial):
+    entry = _ui_caches.get(serial)
+    if entry is None:
+        entry = _ui_caches[serial] = {
+            "tree": None,
+            "at": 0.0,
+            "generation": 0,
+            "dumped_generation": -1,
+        }
+    return entry
+
+
+def _invalidate_ui_cache(device=None):
+    """有输入动作发往设备后，该设备缓存的 UI 树视为过期"""
+    serial = _resolve_device(device)
+    with _ui_cache_lock:
+        _ui_cache_entry(serial)["generation"] += 1
+
+
+def get_ui_tree(refresh=False, device=None, timeout=None):
+    """
+    获取解析后的 UI 树
+
+    在同一屏幕上重复查询直接命中缓存；本代理发出过输入动作、超过 ui.cache_ttl
+    或 refresh=True 时重新 dump（timeout 为 dump 的超时秒数，默认 adb.session_timeout）。
+    返回 (tree, 缓存年龄秒数, 是否命中)，失败抛 RuntimeError。
+    """
+    ttl = load_config().get("ui", {}).get("cache_ttl", 3)
+    serial = _resolve_device(device)
+    with _ui_cache_lock:
+        entry = _ui_cache_entry(serial)
+        tree = entry["tree"]
+        fresh = (
+            not refresh
+            and tree is not None
+            and entry["dumped_generation"] == entry["generation"]
+            and time.monotonic() - entry["at"] < ttl
         )
-        return {"success": True, "stdout": result.stdout, "stderr": result.stderr}
-    except subprocess.TimeoutExpired:
-        return {"success": False, "error": "Timeout"}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+        if fresh:
+            return tree, time.monotonic() - entry["at"], True
+        generation = entry["generation"]
 
+    result = _dump_ui_xml(serial, timeout)
+    xml_text = result.get("stdout", "")
+    if not result.get("success") or "<hierarchy" not in xml_text:
+        raise RuntimeError(result.get("error") or result.get("stderr") or "uiautomator dump failed")
+    try:
+        tree = UiTree(xml_text)
+    except ET.ParseError as e:
+        raise RuntimeError(f"Invalid UI dump: {e}")
 
-def adb_cmd(cmd):
-    config = load_config()
-    adb_prefix = "adb "
-    if config["adb"]["wireless_ip"]:
-        adb_prefix = f"adb -s {config['adb']['wireless_ip']} "
-    return run_cmd(f"{adb_prefix}{cmd}")
+    with _ui_cache_lock:
+        entry = _ui_cache_entry(serial)
+        entry["tree"] = tree
+        entry["at"] = time.monotonic()
+        entry["dumped_generation"] = generation
+    return tree, 0.0, False
 
 
-# ==================== 首页 ====================
+def _ui_query(data, device=None):
+    """解析请求里的 selector 并查询，返回 (匹配节点, tree, age, cached)"""
+    selector = data.get("selector") or {}
+    if not isinstance(selector, dict) or not selector:
+        raise ValueError("No selector specified")
+    tree, age, cached = get_ui_tree(
+        refresh=bool(data.get("refresh", False)), device=device
+    )
+    nodes = tree.find(selector)
+    if "index" in selector:
+        i = int(selector["index"])
+        nodes = nodes[i:i + 1] if -len(nodes) <= i < len(nodes) else []
+    return nodes, tree, age, cached
 
 
-@app.route("/")
-def index():
+@app.route("/api/ui/find", methods=["POST"])
+def api_ui_find():
+    """
+    按选择器查找 UI 节点
+
+    请求格式：
+    {
+        "selector": {"text": "登录", "clickable": true},
+        "limit": 10,
+        "refresh": false
+    }
+
+    选择器字段：text / resource_id / content_desc / class / package，
+    *_contains 子串匹配（如 text_contains），布尔属性（clickable / enabled / ...），
+    index 取第 N 个匹配。
+    """
+    data = request.json or {}
+    try:
+        limit = int(data.get("limit", 50))
+        nodes, tree, age, cached = _ui_query(data, _request_device())
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
     return jsonify(
         {
-            "name": "Phone Agent",
-            "version": CURRENT_VERSION,
-            "status": "running",
-            "endpoints": [
-                "/api/status",
-                "/api/termux",
-                "/api/exec",
-                "/api/adb/*",
-                "/api/update/*",
-            ],
+            "success": True,
+            "count": len(nodes),
+            "nodes": nodes[:limit],
+            "cached": cached,
+            "age_ms": round(age * 1000, 1),
+            "total_nodes": len(tree.nodes),
         }
     )
 
 
-# ==================== 状态 ====================
+@app.route("/api/ui/tap", methods=["POST"])
+def api_ui_tap():
+    """
+    按选择器点击：找到第一个（或 selector.index 指定的）匹配节点并点击其中心
 
+    请求格式：{"selector": {"resource_id": "com.app:id/ok"}}
+    """
+    data = request.json or {}
+    device = _request_device()
+    try:
+        nodes, _, _, cached = _ui_query(data, device)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    nodes = [n for n in nodes if n["center"]]
+    if not nodes:
+        return jsonify({"success": False, "error": "Not found", "cached": cached}), 404
 
-@app.route("/api/status")
-def api_status():
+    node = nodes[0]
+    x, y = node["center"]
+    result = adb_cmd(f"shell input tap {x} {y}", device)
     return jsonify(
         {
-            "status": "online",
-            "timestamp": datetime.now().isoformat(),
-            "version": CURRENT_VERSION,
+            "success": result.get("success", False),
+            "node": node,
+            "x": x,
+            "y": y,
+            "cached": cached,
+            "error": result.get("error"),
         }
     )
 
 
-# ==================== 通用 termux-api 接口 ====================
+# ==================== UI 增量 diff ====================
 
+UI_DIFF_FIELDS = ("text", "content_desc", "class", "package", "bounds") + UI_BOOL_FIELDS
+UI_DIFF_MAX_SESSIONS = 32
 
-@app.route("/api/termux", methods=["POST"])
-def api_termux():
-    """通用 termux-api 接口"""
-    data = request.json or {}
-    command = data.get("command", "")
-    args = data.get("args", [])
-    timeout = data.get("timeout", 30)
+_ui_diff_sessions = collections.OrderedDict()  # (serial, session) -> {"version", "nodes"}
+_ui_diff_lock = threading.Lock()
 
-    if not command:
-        return jsonify({"error": "No command specified"})
 
-    # 预处理 args：合并 `--xxx` 和下一个参数
-    processed_args = []
-    i = 0
-    while i < len(args):
-        arg = str(args[i])
-        if arg.startswith("--") and i + 1 < len(args):
-            next_arg = str(args[i + 1])
-            if not next_arg.startswith("--") and not next_arg.startswith("-"):
-                # 合并为 --xxx="value" 格式
-                processed_args.append(f'{arg}="{next_arg}"')
-                i += 2
-                continue
-        processed_args.append(arg)
-        i += 1
+def _diff_ui_nodes(old, new):
+    """比较两次快照（key -> node），返回 (新增节点, 删除的 key, 变化)"""
+    added = [node for key, node in new.items() if key not in old]
+    removed = [key for key in old if key not in new]
+    updated = []
+    for key, node in new.items():
+        prev = old.get(key)
+        if prev is None:
+            continue
+        changes = {f: node[f] for f in UI_DIFF_FIELDS if node[f] != prev[f]}
+        if changes:
+            updated.append({"key": key, "changes": changes})
+    return added, removed, updated
 
-    # 构建命令
-    full_command = command
-    for arg in processed_args:
-        full_command += f" {arg}"
 
-    result = run_cmd(full_command, timeout)
+def _ui_diff_response(session, device=None, since=None, reset=False):
+    try:
+        tree, _, _ = get_ui_tree(refresh=True, device=device)
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    nodes = {node["key"]: node for node in tree.nodes}
 
-    # 尝试解析 JSON
-    parsed = None
-    if result.get("success") and result.get("stdout"):
-        try:
-            parsed = json.loads(result["stdout"])
-        except:
-            pass
+    # 不同设备上同名的会话互不干扰
+    session_key = (_resolve_device(device), session)
+    with _ui_diff_lock:
+        state = _ui_diff_sessions.pop(session_key, None)
+        # 客户端版本与服务端记录不一致（丢状态 / 首次）时返回全量
+        if (
+            state is None
+            or reset
+            or (since is not None and str(since) != str(state["version"]))
+        ):
+            version = (state["version"] + 1) if state else 1
+            _ui_diff_sessions[session_key] = {"version": version, "nodes": nodes}
+            while len(_ui_diff_sessions) > UI_DIFF_MAX_SESSIONS:
+                _ui_diff_sessions.popitem(last=False)
+            return jsonify(
+                {
+                    "success": True,
+                    "session": session,
+                    "version": version,
+                    "full": True,
+                    "nodes": tree.nodes,
+                }
+            )
 
+        added, removed, updated = _diff_ui_nodes(state["nodes"], nodes)
+        changed = bool(added or removed or updated)
+        if changed:
+            state = {"version": state["version"] + 1, "nodes": nodes}
+        _ui_diff_sessions[session_key] = state
+
+    if not changed:
+        return jsonify({"success": True, "version": state["version"], "changed": False})
     return jsonify(
         {
-            "success": result.get("success", False),
-            "stdout": result.get("stdout", ""),
-            "stderr": result.get("stderr", ""),
-            "parsed": parsed,
-            "command": full_command,
+            "success": True,
+            "session": session,
+            "version": state["version"],
+            "base_version": state["version"] - 1,
+            "changed": True,
+            "added": added,
+            "removed": removed,
+            "updated": updated,
         }
     )
 
 
-# ==================== 通用 Shell 执行# ==================== 通用 Shell 执行 ====================
+# ==================== 等待 UI 条件 ====================
 
+WAIT_CONDITION_TYPES = ("present", "absent", "text", "stable", "activity")
+WAIT_MIN_INTERVAL = 0.05  # 轮询间隔下限（秒），避免对设备连续 dump
 
-@app.route("/api/exec", methods=["POST"])
-def api_exec():
+
+def _foreground_activity(device=None, timeout=None):
+    """当前前台 Activity（如 com.app/.MainActivity），获取失败返回 None"""
+    result = adb_shell(
+        "dumpsys activity activities | grep -E 'mResumedActivity|topResumedActivity'",
+        timeout=timeout,
+        device=device,
+    )
+    for line in result.get("stdout", "").splitlines():
+        for token in line.split():
+            if "/" in token and not token.startswith("{"):
+                return token.rstrip("}")
+    return None
+
+
+def _check_condition(condition, state, device=None, timeout=None):
     """
-    通用 Shell 命令执行（谨慎使用）
+    对当前屏幕评估一次条件
+
+    state 在多次轮询间保存上一次的层级签名等信息；timeout 为本次读取设备的超时秒数。
+    返回 (是否满足, 屏幕是否有变化, 附加信息)
+    """
+    kind = condition.get("type")
+    if kind == "activity":
+        activity = _foreground_activity(device, timeout)
+        changed = activity != state.get("activity")
+        state["activity"] = activity
+        target = condition.get("activity") or condition.get("package") or ""
+        if "/" in target:
+            met = activity is not None and activity == target
+        else:
+            met = activity is not None and activity.split("/")[0] == target
+        return met, changed, {"activity": activity}
+
+    tree, _, _ = get_ui_tree(refresh=True, device=device, timeout=timeout)
+    signature = hash(tree.xml)
+    now = time.monotonic()
+    changed = signature != state.get("signature")
+    if changed:
+        state["signature"] = signature
+        state["stable_since"] = now
+
+    if kind in ("present", "absent"):
+        selector = condition.get("selector") or {}
+        if not selector:
+            raise ValueError("selector required")
+        nodes = tree.find(selector)
+        if kind == "present":
+            return bool(nodes), changed, {"nodes": nodes[:10]}
+        return not nodes, changed, {}
+    if kind == "text":
+        text = str(condition.get("text", ""))
+        if not text:
+            raise ValueError("text required")
+        nodes = [n for n in tree.nodes if text in n["text"] or text in n["content_desc"]]
+        return bool(nodes), changed, {"nodes": nodes[:10]}
+    if kind == "stable":
+        stable_ms = (now - state["stable_since"]) * 1000
+        return stable_ms >= float(condition.get("ms", 1000)), changed, {
+            "stable_ms": round(stable_ms, 1)
+        }
+    raise ValueError(f"Unknown condition type: {kind}")
+
+
+def wait_for(condition, timeout=10, poll=None, device=None):
+    """
+    在本地轮询直到条件满足或超时，轮询间隔自适应
+
+    屏幕无变化时间隔按 factor 递增到 max，发现变化后回到 initial；间隔不低于 WAIT_MIN_INTERVAL，
+    每次读取设备的超时不超过剩余时间。
+    返回 {"met", "elapsed_ms", "polls", ...}；条件或参数不合法抛 ValueError。
+    """
+    if not isinstance(condition, dict):
+        raise ValueError("condition must be an object")
+    if condition.get("type") not in WAIT_CONDITION_TYPES:
+        raise ValueError(f"Unknown condition type: {condition.get('type')}")
+    poll = poll or {}
+    if not isinstance(poll, dict):
+        raise ValueError("poll must be an object")
+    timeout = _num(timeout)
+    if timeout < 0:
+        raise ValueError("timeout must not be negative")
+    initial = max(WAIT_MIN_INTERVAL, _num(poll.get("initial", 0.1)))
+    max_interval = max(initial, _num(poll.get("max", 1.0)))
+    factor = max(1.0, _num(poll.get("factor", 1.5)))
+    if condition.get("type") == "stable":
+        # 间隔不能超过稳定时长的一半，否则会错过判定时机
+        stable_half = _num(condition.get("ms", 1000)) / 2000
+        max_interval = max(WAIT_MIN_INTERVAL, min(max_interval, stable_half))
+        initial = min(initial, max_interval)
+
+    start = time.monotonic()
+    deadline = start + timeout
+    interval = initial
+    state = {}
+    polls = 0
+    info = {}
+    while True:
+        polls += 1
+        try:
+            remaining = max(WAIT_MIN_INTERVAL, deadline - time.monotonic())
+            met, changed, info = _check_condition(condition, state, device, remaining)
+        except RuntimeError as e:
+            met, changed, info = False, False, {"error": str(e)}
+        if met:
+            break
+        interval = initial if changed else min(interval * factor, max_interval)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+    return {
+        "met": met,
+        "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+        "polls": polls,
+        **info,
+    }
+
+
+@app.route("/api/ui/wait", methods=["POST"])
+def api_ui_wait():
+    """
+    在代理端等待 UI 条件成立，满足即返回
 
     请求格式：
     {
-        "command": "export",
-        "args": ["MY_VAR=hello"],
-        "shell": true  // 是否作为 shell 脚本执行
+        "condition": {"type": "present", "selector": {"text": "登录"}},
+        "timeout": 10,
+        "poll": {"initial": 0.1, "max": 1.0, "factor": 1.5}
     }
+
+    type：present / absent（selector）、text（text 可见）、
+    stable（屏幕 ms 毫秒内无变化）、activity（activity 或 package 在前台）
     """
     data = request.json or {}
-    command = data.get("command", "")
-    args = data.get("args", [])
-    shell_mode = data.get("shell", False)
-    timeout = data.get("timeout", 30)
-    workdir = data.get("workdir", "/data/data/com.termux/files/home")
+    condition = data.get("condition") or {}
+    try:
+        result = wait_for(
+            condition, data.get("timeout", 10), data.get("poll"), _request_device()
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if not result["met"]:
+        return jsonify({"success": False, "error": "Timeout", **result}), 408
+    return jsonify({"success": True, **result})
 
-    if not command:
-        return jsonify({"error": "No command specified"})
 
-    # 构建完整命令
-    full_command = command
-    for arg in args:
-        # 转义特殊字符
-        arg = str(arg).replace('"', '\\"').replace("$", "\\$").replace("`", "\\`")
-        full_command += f' "{arg}"'
+# ==================== 宏录制与回放 ====================
 
-    # 如果是 shell 模式，添加工作目录
-    if shell_mode:
-        full_command = f'cd "{workdir}" && {full_command}'
+MACRO_PARAM_RE = re.compile(r"\{\{(\w+)\}\}")
+MACRO_ESCAPED_RE = re.compile(r"\\*\{\{\w+\}\}")  # 占位符及其转义形式 \{{name}}
+# 录制时参与参数化的自由文本字段（按步骤类型，字段路径）；坐标、包名、按键等不替换
+MACRO_TEXT_FIELDS = {
+    "text": (("text",),),
+    "ui_tap": (("selector", "text"), ("selector", "text_contains")),
+    "wait_for": (("condition", "selector", "text"), ("condition", "selector", "text_contains")),
+}
+# 需要在代理端执行的步骤：执行完成后，后续步骤的 at 从该步结束时刻重新计时
+MACRO_SERVER_STEPS = ("wait_for", "ui_tap")
 
-    result = run_cmd(full_command, timeout)
+_macro_recorders = {}  # serial -> MacroRecorder
+_macro_lock = threading.Lock()
 
-    return jsonify(
-        {
-            "success": result.get("success", False),
-            "stdout": result.get("stdout", ""),
-            "stderr": result.get("stderr", ""),
-            "command": full_command,
-        }
-    )
 
+def _macro_dir():
+    return load_config().get("macros", {}).get("dir", "macros")
 
-# ==================== ADB 控制 ====================
 
+def _macro_path(name):
+    if not TEMPLATE_NAME_RE.fullmatch(name or ""):
+        raise ValueError("Invalid macro name")
+    return os.path.join(_macro_dir(), f"{name}.json")
 
-@app.route("/api/adb", methods=["POST"])
-def api_adb():
-    """通用 ADB 接口"""
-    data = request.json or {}
-    subcommand = data.get("subcommand", "")
-    args = data.get("args", [])
 
-    full_cmd = f"shell {subcommand}"
-    for arg in args:
-        full_cmd += f" {arg}"
+def _macro_steps(rule, data, payload):
+    """把一次 ADB / UI 接口调用转成宏步骤，返回 [(步骤, 相对请求到达的毫秒数)]"""
+    if rule == "/api/adb/tap":
+        return [({"type": "tap", "x": data.get("x", 0), "y": data.get("y", 0)}, 0)]
+    if rule == "/api/adb/swipe":
+        step = {"type": "swipe", "duration": data.get("duration", 300)}
+        step.update({k: data.get(k, 0) for k in ("x1", "y1", "x2", "y2")})
+        return [(step, 0)]
+    if rule == "/api/adb/input":
+        return [({"type": "text", "text": data.get("text", "")}, 0)]
+    if rule == "/api/adb/key":
+        return [({"type": "key", "key": data.get("key", "ENTER")}, 0)]
+    if rule == "/api/adb/start":
+        return [({"type": "start", "package": data.get("package", ""),
+                  "activity": data.get("activity", "")}, 0)]
+    if rule == "/api/adb/gesture":
+        if data.get("dry_run"):
+            return []
+        step = {k: v for k, v in data.items() if k not in ("device", "dry_run")}
+        return [({"type": "gesture", **step}, 0)]
+    if rule == "/api/adb/batch":
+        # 按各步实际开始时刻展开，未执行的步骤不录
+        steps = []
+        for action, result in zip(data.get("actions") or [], payload.get("steps") or []):
+            if result.get("status") is None:
+                continue
+            step = {k: v for k, v in action.items() if k not in ("capture", "delay", "at")}
+            steps.append((step, result.get("started_ms", 0)))
+        return steps
+    if rule == "/api/ui/tap":
+        step = {k: v for k, v in data.items() if k != "device"}
+        return [({"type": "ui_tap", **step}, 0)]
+    if rule == "/api/ui/wait":
+        step = {"type": "wait_for", "condition": data.get("condition") or {},
+                "timeout": data.get("timeout", 10)}
+        if data.get("poll"):
+            step["poll"] = data["poll"]
+        return [(step, 0)]
+    return []
 
-    result = adb_cmd(full_cmd)
-    return jsonify(
-        {
-            "success": result.get("success", False),
-            "stdout": result.get("stdout", ""),
-            "stderr": result.get("stderr", ""),
-            "command": f"adb {full_cmd}",
+
+MACRO_ROUTES = (
+    "/api/adb/tap",
+    "/api/adb/swipe",
+    "/api/adb/input",
+    "/api/adb/key",
+    "/api/adb/start",
+    "/api/adb/gesture",
+    "/api/adb/batch",
+    "/api/ui/tap",
+    "/api/ui/wait",
+)
+
+
+def _macro_escape(value):
+    """录到的字符串本身形如 {{name}} 时加一个反斜杠，回放时原样输入而不是当作占位符"""
+    if isinstance(value, dict):
+        return {k: _macro_escape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_macro_escape(v) for v in value]
+    if isinstance(value, str) and MACRO_ESCAPED_RE.fullmatch(value):
+        return "\\" + value
+    return value
+
+
+def _macro_parametrize(step, params):
+    """录制时把自由文本字段中与参数值完全相同的值替换为 {{name}} 占位符"""
+    step = _macro_escape(step)
+    for path in MACRO_TEXT_FIELDS.get(step.get("type"), ()):
+        parent = step
+        for key in path[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if not isinstance(parent, dict):
+            continue
+        for name, param in params.items():
+            if isinstance(param, str) and param and parent.get(path[-1]) == param:
+                parent[path[-1]] = "{{" + name + "}}"
+                break
+    return step
+
+
+def _macro_substitute(value, params):
+    """
+    回放时替换占位符：只有整个字符串就是一个占位符时才替换，并保留参数原类型（可用于坐标）；
+    \\{{name}} 表示字面的 {{name}}
+    """
+    if isinstance(value, dict):
+        return {k: _macro_substitute(v, params) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_macro_substitute(v, params) for v in value]
+    if not isinstance(value, str):
+        return value
+    if MACRO_ESCAPED_RE.fullmatch(value) and value.startswith("\\"):
+        return value[1:]
+    whole = MACRO_PARAM_RE.fullmatch(value)
+    if whole:
+        if whole.group(1) not in params:
+            raise ValueError(f"Missing macro parameter: {whole.group(1)}")
+        return params[whole.group(1)]
+    return value
+
+
+class MacroRecorder:
+    """
+    录制一台设备上的动作
+
+    每步记下 at：相对当前段开始的毫秒数。宏从录制开始为第一段；
+    wait_for / ui_tap 这类代理端步骤结束后开始新的一段，回放时等待多久都不影响后续步骤的相对节奏。
+    """
+
+    def __init__(self, name, serial, params):
+        self.name = name
+        self.serial = serial
+        self.params = params
+        self.started = time.monotonic()
+        self.anchor = self.started
+        self.steps = []
+        self.lock = threading.Lock()
+
+    def add(self, steps, arrived, finished):
+        with self.lock:
+            for step, offset in steps:
+                step = _macro_parametrize(step, self.params)
+                if step["type"] in MACRO_SERVER_STEPS:
+                    self.steps.append(step)
+                    self.anchor = finished
+                else:
+                    at = (arrived - self.anchor) * 1000 + offset
+                    self.steps.append({**step, "at": max(0, round(at))})
+
+    def macro(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "device": self.serial,
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "duration_ms": round((time.monotonic() - self.started) * 1000),
+                "params": self.params,
+                "steps": list(self.steps),
+            }
+
+
+@app.before_request
+def _macro_before_request():
+    if _macro_recorders:
+        g.macro_arrived = time.monotonic()
+
+
+@app.after_request
+def _macro_after_request(response):
+    arrived = g.pop("macro_arrived", None)
+    if arrived is None or request.url_rule is None or request.url_rule.rule not in MACRO_ROUTES:
+        return response
+    with _macro_lock:
+        recorder = _macro_recorders.get(_resolve_device(_request_device()))
+    if recorder is None or response.status_code != 200:
+        return response
+    payload = response.get_json(silent=True) or {}
+    if not payload.get("success", True):
+        return response
+    steps = _macro_steps(request.url_rule.rule, request.get_json(silent=True) or {}, payload)
+    recorder.add(steps, arrived, time.monotonic())
+    return response
+
+
+def load_macro(name):
+    with open(_macro_path(name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_macro(macro):
+    path = _macro_path(macro.get("name"))
+    if not isinstance(macro.get("steps"), list):
+        raise ValueError("steps must be a list")
+    os.makedirs(_macro_dir(), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(macro, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _play_segment(items, device, speed, stop_on_error, results):
+    """一段设备端步骤编译成一个定时脚本，一次下发，由设备时钟控制节奏"""
+    actions = []
+    extra = 0.0
+    for _, step in items:
+        if step["type"] == "gesture":
+            compiled, _ = compile_gesture(step, device)
+            _ensure_gesture(compiled, device)
+            action = {"type": "shell", "command": f"sh {_gesture_path(compiled)}"}
+            extra += compiled["duration_ms"]
+        else:
+            action = {k: v for k, v in step.items() if k != "at"}
+        action["at"] = _num(step.get("at", 0)) / speed
+        actions.append(action)
+
+    token = f"__PA_STEP_{uuid.uuid4().hex}__"
+    script = _compile_batch(actions, token, stop_on_error)
+    marker = token.encode()
+    begun = {}
+
+    def on_line(line):
+        idx = line.find(marker)
+        if idx < 0:
+            return
+        fields = line[idx + len(marker):].split()
+        i = int(fields[1])
+        if fields[0] == b"B":
+            begun[i] = int(fields[2])
+            return
+        index, step = items[i]
+        status = int(fields[2])
+        results[index] = {
+            "index": index,
+            "type": step["type"],
+            "ok": status == 0,
+            "status": status,
+            "at_ms": round(actions[i]["at"], 1),
         }
+        if i in begun:
+            results[index]["device_ms"] = begun[i]
+            results[index]["late_ms"] = round(begun[i] - actions[i]["at"], 1)
+
+    _invalidate_ui_cache(device)
+    timeout = (
+        load_config()["adb"].get("session_timeout", 10) + _batch_duration(actions) + extra / 1000
     )
+    result = adb_shell(script, timeout=timeout, on_line=on_line, device=device, ordered=True)
+    if not result.get("success"):
+        for index, step in items:
+            results.setdefault(
+                index, {"index": index, "type": step["type"], "ok": False,
+                        "error": result.get("error")}
+            )
+    return all(results.get(index, {}).get("ok") for index, _ in items)
 
 
-@app.route("/api/adb/tap", methods=["POST"])
-def api_adb_tap():
-    """ADB 点击"""
-    data = request.json
-    x, y = data.get("x", 0), data.get("y", 0)
-    return jsonify(adb_cmd(f"shell input tap {x} {y}"))
+def _play_server_step(index, step, device):
+    started = time.monotonic()
+    if step["type"] == "wait_for":
+        result = wait_for(
+            step.get("condition") or {}, step.get("timeout", 10), step.get("poll"), device
+        )
+        ok = result["met"]
+        info = {"error": None if ok else "Timeout", "polls": result["polls"]}
+    else:
+        nodes = [n for n in _ui_query(step, device)[0] if n["center"]]
+        if nodes:
+            x, y = nodes[0]["center"]
+            result = adb_cmd(f"shell input tap {x} {y}", device)
+            ok = result.get("success", False)
+            info = {"x": x, "y": y, "error": result.get("error")}
+        else:
+            ok, info = False, {"error": "Not found"}
+    return {
+        "index": index,
+        "type": step["type"],
+        "ok": ok,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        **info,
+    }
 
 
-@app.route("/api/adb/swipe", methods=["POST"])
-def api_adb_swipe():
-    """ADB 滑动"""
-    data = request.json
-    x1, y1 = data.get("x1", 0), data.get("y1", 0)
-    x2, y2 = data.get("x2", 0), data.get("y2", 0)
-    duration = data.get("duration", 300)
-    return jsonify(adb_cmd(f"shell input swipe {x1} {y1} {x2} {y2} {duration}"))
+def play_macro(macro, params=None, device=None, speed=1.0, stop_on_error=True):
+    """
+    回放宏：相邻的设备端步骤合成一个定时脚本在设备上执行，
+    wait_for / ui_tap 在代理端执行并作为段与段之间的检查点
+    """
+    steps = _macro_substitute(macro.get("steps") or [], {**macro.get("params", {}), **(params or {})})
+    if not steps:
+        raise ValueError("Macro has no steps")
+    start = time.monotonic()
+    results = {}
+    segment = []
+    ok = True
+    for index, step in enumerate(steps + [None]):
+        if step is not None and step.get("type") not in MACRO_SERVER_STEPS:
+            segment.append((index, step))
+            continue
+        if segment:
+            ok = _play_segment(segment, device, speed, stop_on_error, results) and ok
+            segment = []
+            if not ok and stop_on_error:
+                break
+        if step is not None:
+            results[index] = _play_server_step(index, step, device)
+            ok = results[index]["ok"] and ok
+            if not ok and stop_on_error:
+                break
+    late = [abs(r["late_ms"]) for r in results.values() if "late_ms" in r]
+    return {
+        "success": ok and len(results) == len(steps),
+        "steps": [results[i] for i in sorted(results)],
+        "completed": len(results),
+        "total": len(steps),
+        "max_late_ms": max(late, default=0),
+        "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+    }
 
 
-@app.route("/api/adb/input", methods=["POST"])
-def api_adb_input():
-    """ADB 输入"""
-    data = request.json
-    text = data.get("text", "").replace(" ", "%s").replace('"', '\\"')
-    return jsonify(adb_cmd(f'shell input text "{text}"'))
+@app.route("/api/macro/record/start", methods=["POST"])
+def api_macro_record_start():
+    """
+    开始录制：之后发往该设备的 ADB / UI 动作接口调用按相对时间记入宏
 
+    {"name": "login", "params": {"username": "alice"}}
+    输入的文本（text 步骤）或 ui_tap / wait_for 选择器的 text / text_contains 恰好等于 params 中的值时，
+    录成 {{username}} 占位符，回放时可换成别的值。
+    """
+    data = request.json or {}
+    name = data.get("name")
+    params = data.get("params") or {}
+    try:
+        _macro_path(name)
+        if not isinstance(params, dict):
+            raise ValueError("params must be an object")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    serial = _resolve_device(_request_device())
+    with _macro_lock:
+        if serial in _macro_recorders:
+            return jsonify({"success": False, "error": "Already recording on this device"}), 409
+        _macro_recorders[serial] = MacroRecorder(name, serial, params)
+    return jsonify({"success": True, "name": name, "device": serial})
 
-@app.route("/api/adb/key", methods=["POST"])
-def api_adb_key():
-    """ADB 按键"""
-    data = request.json
-    key = data.get("key", "ENTER")
-    keys = {"ENTER": "66", "BACK": "4", "HOME": "3", "MENU": "82", "POWER": "26"}
-    return jsonify(adb_cmd(f"shell input keyevent {keys.get(key, key)}"))
 
+@app.route("/api/macro/record/stop", methods=["POST"])
+def api_macro_record_stop():
+    """结束录制并保存（"save": false 时只返回录到的宏）"""
+    data = request.json or {}
+    serial = _resolve_device(_request_device())
+    with _macro_lock:
+        recorder = _macro_recorders.pop(serial, None)
+    if recorder is None:
+        return jsonify({"success": False, "error": "Not recording"}), 404
+    macro = recorder.macro()
+    if data.get("save", True):
+        try:
+            save_macro(macro)
+        except OSError as e:
+            return jsonify({"success": False, "error": str(e), "macro": macro}), 500
+    return jsonify({"success": True, "macro": macro})
 
-@app.route("/api/adb/screenshot")
-def api_adb_screenshot():
-    """ADB 截图"""
-    output = f"/sdcard/screen_{int(time.time())}.png"
-    result = adb_cmd(f"shell screencap -p {output}")
-    return jsonify({"success": result.get("success", False), "path": output})
 
+@app.route("/api/macros")
+def api_macros():
+    """列出已保存的宏"""
+    directory = _macro_dir()
+    names = []
+    if os.path.isdir(directory):
+        names = sorted(
+            entry[:-5] for entry in os.listdir(directory)
+            if entry.endswith(".json") and TEMPLATE_NAME_RE.fullmatch(entry[:-5])
+        )
+    with _macro_lock:
+        recording = {serial or "default": r.name for serial, r in _macro_recorders.items()}
+    return jsonify({"success": True, "macros": names, "recording": recording})
 
-@app.route("/api/adb/dump")
-def api_adb_dump():
-    """ADB UI 层级"""
-    adb_cmd("shell uiautomator dump")
-    result = adb_cmd("shell cat /sdcard/window_dump.xml")
-    return jsonify(
-        {"success": result.get("success", False), "xml": result.get("stdout", "")}
-    )
+
+@app.route("/api/macros/<name>", methods=["GET", "PUT", "DELETE"])
+def api_macro(name):
+    """
+    查看 / 保存 / 删除宏
+
+    PUT 的请求体为完整宏：{"params": {...}, "steps": [...]}，可用于手工加入 wait_for 检查点或占位符。
+    """
+    try:
+        path = _macro_path(name)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if request.method == "PUT":
+        macro = {**(request.json or {}), "name": name}
+        try:
+            save_macro(macro)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        return jsonify({"success": True, "name": name, "steps": len(macro["steps"])})
+    if not os.path.exists(path):
+        return jsonify({"success": False, "error": f"Macro not found: {name}"}), 404
+    if request.method == "DELETE":
+        os.remove(path)
+        return jsonify({"success": True})
+    return jsonify({"success": True, "macro": load_macro(name)})
 
 
-@app.route("/api/adb/start", methods=["POST"])
-def api_adb_start():
-    """ADB 启动 App"""
-    data = request.json
-    package = data.get("package", "")
-    activity = data.get("activity", "")
-    result = adb_cmd(f"shell am start -n {package}/{activity}")
+@app.route("/api/macros/<name>/play", methods=["POST"])
+def api_macro_play(name):
+    """
+    回放宏
+
+    {"params": {"username": "bob"}, "speed": 1.0, "stop_on_error": true}
+    """
+    data = request.json or {}
+    try:
+        macro = load_macro(name)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except FileNotFoundError:
+        return jsonify({"success": False, "error": f"Macro not found: {name}"}), 404
+    try:
+        speed = float(data.get("speed", 1.0))
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        result = play_macro(
+            macro,
+            data.get("params"),
+            _request_device(),
+            speed,
+            bool(data.get("stop_on_error", True)),
+        )
+    except (ValueError, TypeError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
     return jsonify(result)
 
 
@@ -331,7 +5351,11 @@ def api_file_stat():
 
 @app.route("/api/file/read", methods=["POST"])
 def api_file_read():
-    """读取文件并以 base64 返回（通用拉取方式）"""
+    """
+    读取文件并以 base64 返回（通用拉取方式）
+
+    Accept 为 application/msgpack 或 application/cbor 时以原始字节放在 content 字段，不做 base64。
+    """
     data = request.json or {}
     path = data.get("path")
     max_bytes = int(data.get("maxBytes", 10 * 1024 * 1024))  # 默认 10MB
@@ -353,7 +5377,13 @@ def api_file_read():
 
         with open(path, "rb") as f:
             raw = f.read()
+        if _response_encoding() != "json":
+            return _respond({"success": True, "path": path, "size": len(raw), "content": raw})
+        started = time.perf_counter()
         b64 = base64.b64encode(raw).decode("ascii")
+        metrics.observe(
+            "phone_agent_encode_seconds", {"kind": "base64"}, time.perf_counter() - started
+        )
         return jsonify({"success": True, "path": path, "size": len(raw), "base64": b64})
     except FileNotFoundError:
         return jsonify({"success": False, "error": "Not found", "path": path}), 404
@@ -361,22 +5391,65 @@ def api_file_read():
         return jsonify({"success": False, "error": str(e), "path": path}), 500
 
 
+@app.route("/api/file/download", methods=["GET", "HEAD"])
+def api_file_download():
+    """
+    以二进制流下载文件（不做 base64，不受 maxBytes 限制）
+
+    GET /api/file/download?path=/sdcard/DCIM/xxx.mp4[&attachment=1]
+
+    支持 Range 断点续传和 If-None-Match（ETag 由 size+mtime 生成）；
+    文件按块从磁盘流式发送，服务器支持时走 sendfile。
+    """
+    path = request.args.get("path")
+    if not _is_allowed_path(path):
+        return jsonify({"success": False, "error": "Path not allowed"}), 400
+
+    try:
+        st = os.stat(path)
+        if not os.path.isfile(path):
+            return jsonify({"success": False, "error": "Not a file", "path": path}), 400
+        etag = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+        return send_file(
+            path,
+            as_attachment=request.args.get("attachment") in ("1", "true"),
+            conditional=True,
+            etag=etag,
+            last_modified=st.st_mtime,
+        )
+    except FileNotFoundError:
+        return jsonify({"success": False, "error": "Not found", "path": path}), 404
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e), "path": path}), 500
+
+
 @app.route("/api/file/write", methods=["POST"])
 def api_file_write():
-    """写入文件（base64 输入）。mode=overwrite|append"""
-    data = request.json or {}
+    """
+    写入文件（base64 输入）。mode=overwrite|append
+
+    请求体也可以是 msgpack / cbor（对应 Content-Type），此时文件内容以原始字节放在 content 字段。
+    """
+    try:
+        data = _request_payload()
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Bad request body: {e}"}), 400
     path = data.get("path")
     b64 = data.get("base64")
+    content = data.get("content")
     mode = data.get("mode", "overwrite")
     mkdirs = bool(data.get("mkdirs", True))
 
     if not _is_allowed_path(path):
         return jsonify({"success": False, "error": "Path not allowed"}), 400
-    if not b64:
+    if not b64 and not isinstance(content, (bytes, bytearray)):
         return jsonify({"success": False, "error": "Missing base64"}), 400
 
     try:
-        raw = base64.b64decode(b64.encode("ascii"), validate=False)
+        if isinstance(content, (bytes, bytearray)):
+            raw = bytes(content)
+        else:
+            raw = base64.b64decode(b64.encode("ascii"), validate=False)
         if mkdirs:
             os.makedirs(os.path.dirname(path), exist_ok=True)
         write_mode = "ab" if mode == "append" else "wb"
@@ -387,6 +5460,769 @@ def api_file_write():
         return jsonify({"success": False, "error": str(e), "path": path}), 500
 
 
+# ==================== 分块断点上传 ====================
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_TTL = 24 * 3600  # 闲置超过该秒数的上传会话被清理
+
+_uploads = {}  # upload_id -> dict
+_uploads_lock = threading.Lock()
+
+
+def _upload_part_path(path, upload_id):
+    # 临时文件放在目标目录下，保证 finalize 时 os.replace 是同一文件系统上的原子重命名
+    return os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.{upload_id}.part"
+    )
+
+
+def _expire_uploads():
+    now = time.time()
+    with _uploads_lock:
+        expired = [u for u in _uploads.values() if now - u["updated_at"] > UPLOAD_TTL]
+        for upload in expired:
+            _uploads.pop(upload["id"], None)
+    for upload in expired:
+        try:
+            os.remove(upload["part"])
+        except OSError:
+            pass
+
+
+def _get_upload(upload_id):
+    with _uploads_lock:
+        return _uploads.get(upload_id)
+
+
+def _upload_info(upload):
+    return {
+        "success": True,
+        "upload_id": upload["id"],
+        "path": upload["path"],
+        "offset": upload["offset"],
+        "size": upload["size"],
+    }
+
+
+@app.route("/api/file/upload", methods=["POST"])
+def api_file_upload_create():
+    """
+    创建上传会话
+
+    请求格式：{"path": "/sdcard/xxx.apk", "size": 52428800, "mkdirs": true}
+    之后 PUT /api/file/upload/<id>?offset=N 发送原始字节块，
+    POST /api/file/upload/<id>/finalize 校验并原子落盘。
+    """
+    data = request.json or {}
+    path = data.get("path")
+    size = data.get("size")
+    mkdirs = bool(data.get("mkdirs", True))
+
+    if not _is_allowed_path(path):
+        return jsonify({"success": False, "error": "Path not allowed"}), 400
+    if size is not None:
+        try:
+            size = int(size)
+            if size < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "Invalid size"}), 400
+
+    _expire_uploads()
+    upload_id = uuid.uuid4().hex
+    try:
+        if mkdirs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = _upload_part_path(path, upload_id)
+        open(part, "wb").close()
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e), "path": path}), 500
+
+    upload = {
+        "id": upload_id,
+        "path": path,
+        "part": part,
+        "size": size,
+        "offset": 0,
+        "updated_at": time.time(),
+        "lock": threading.Lock(),
+    }
+    with _uploads_lock:
+        _uploads[upload_id] = upload
+    return jsonify(_upload_info(upload))
+
+
+@app.route("/api/file/upload/<upload_id>", methods=["GET"])
+def api_file_upload_status(upload_id):
+    """查询已提交的偏移量（断点续传从这里继续）"""
+    upload = _get_upload(upload_id)
+    if upload is None:
+        return jsonify({"success": False, "error": "Upload not found"}), 404
+    return jsonify(_upload_info(upload))
+
+
+@app.route("/api/file/upload/<upload_id>", methods=["PUT"])
+def api_file_upload_chunk(upload_id):
+    """
+    写入一个原始字节块：PUT /api/file/upload/<id>?offset=N，请求体即数据
+
+    offset 不能超过已提交偏移量；小于时从该处截断后重写（重传）。
+    """
+    upload = _get_upload(upload_id)
+    if upload is None:
+        return jsonify({"success": False, "error": "Upload not found"}), 404
+
+    with upload["lock"]:
+        try:
+            offset = int(request.args.get("offset", upload["offset"]))
+        except ValueError:
+            return jsonify({"success": False, "error": "Invalid offset"}), 400
+        if offset < 0 or offset > upload["offset"]:
+            return jsonify(
+                {
+                    "success": False,
+                    "error": "Offset mismatch",
+                    "offset": upload["offset"],
+                }
+            ), 409
+
+        size = upload["size"]
+        too_large = jsonify(
+            {
+                "success": False,
+                "error": "Exceeds declared size",
+                "offset": offset,
+                "size": size,
+            }
+        ), 413
+        # 先按 Content-Length 拒绝，不落一个字节
+        if size is not None and offset + (request.content_length or 0) > size:
+            return too_large
+
+        written = 0
+        overflow = False
+        try:
+            with open(upload["part"], "r+b") as f:
+                f.seek(offset)
+                f.truncate()
+                # 直接从请求流分块写盘，不在内存里拼完整请求体；
+                # 没有 Content-Length（chunked）时最多写到声明大小
+                while True:
+                    limit = UPLOAD_CHUNK_SIZE
+                    if size is not None:
+                        limit = min(limit, size - offset - written)
+                        if limit <= 0:
+                            overflow = bool(request.stream.read(1))
+                            break
+                    chunk = request.stream.read(limit)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    written += len(chunk)
+                if overflow:
+                    f.truncate(offset)
+                    written = 0
+        except Exception as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+        finally:
+            upload["offset"] = offset + written
+            upload["updated_at"] = time.time()
+
+        if overflow:
+            return too_large
+        return jsonify({**_upload_info(upload), "bytes": written})
+
+
+@app.route("/api/file/upload/<upload_id>/finalize", methods=["POST"])
+def api_file_upload_finalize(upload_id):
+    """校验大小 / sha256 后用原子重命名移动到目标路径"""
+    data = request.json or {}
+    expected = (data.get("sha256") or "").lower()
+
+    upload = _get_upload(upload_id)
+    if upload is None:
+        return jsonify({"success": False, "error": "Upload not found"}), 404
+
+    with upload["lock"]:
+        if upload["size"] is not None and upload["offset"] != upload["size"]:
+            return jsonify(
+                {
+                    "success": False,
+                    "error": "Incomplete upload",
+                    "offset": upload["offset"],
+                    "size": upload["size"],
+                }
+            ), 409
+        try:
+            digest = hashlib.sha256()
+            with open(upload["part"], "rb") as f:
+                for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                os.fsync(f.fileno())
+            sha256 = digest.hexdigest()
+            if expected and expected != sha256:
+                return jsonify(
+                    {
+                        "success": False,
+                        "error": "Checksum mismatch",
+                        "sha256": sha256,
+                        "offset": upload["offset"],
+                    }
+                ), 422
+            os.replace(upload["part"], upload["path"])
+        except Exception as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+
+    with _uploads_lock:
+        _uploads.pop(upload_id, None)
+    return jsonify(
+        {
+            "success": True,
+            "path": upload["path"],
+            "bytes": upload["offset"],
+            "sha256": sha256,
+        }
+    )
+
+
+@app.route("/api/file/upload/<upload_id>", methods=["DELETE"])
+def api_file_upload_abort(upload_id):
+    """放弃上传并删除临时文件"""
+    with _uploads_lock:
+        upload = _uploads.pop(upload_id, None)
+    if upload is None:
+        return jsonify({"success": False, "error": "Upload not found"}), 404
+    try:
+        os.remove(upload["part"])
+    except OSError:
+        pass
+    return jsonify({"success": True, "upload_id": upload_id})
+
+
+# ==================== 目录列表与打包导出 ====================
+
+LIST_CACHE_SIZE = 64  # 最多缓存的目录数
+EXPORT_CHUNK_SIZE = 256 * 1024
+EXPORT_ERRORS_NAME = "EXPORT_ERRORS.txt"
+
+_list_cache = collections.OrderedDict()  # 目录 -> (目录 mtime_ns, 扫描时间, entries, names)
+_list_cache_lock = threading.Lock()
+
+
+def _entry_info(entry):
+    """DirEntry -> dict；不跟随符号链接，stat 失败（如权限）返回 None"""
+    try:
+        st = entry.stat(follow_symlinks=False)
+    except OSError:
+        return None
+    if entry.is_symlink():
+        kind = "link"
+    elif entry.is_dir(follow_symlinks=False):
+        kind = "dir"
+    elif entry.is_file(follow_symlinks=False):
+        kind = "file"
+    else:
+        kind = "other"
+    return {
+        "name": entry.name,
+        "path": entry.path,
+        "type": kind,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+    }
+
+
+def _scan_dir(path):
+    with os.scandir(path) as it:
+        entries = [info for info in map(_entry_info, it) if info is not None]
+    entries.sort(key=lambda e: e["name"])
+    return entries
+
+
+def _list_dir(path):
+    """
+    返回 (按名字排序的目录项, 名字列表, 是否命中缓存)
+
+    目录 mtime 不变且未超过 files.list_cache_ttl 秒时复用上次扫描结果，
+    翻页不会反复 scandir / stat。
+    """
+    ttl = float(load_config().get("files", {}).get("list_cache_ttl", 5))
+    mtime_ns = os.stat(path).st_mtime_ns
+    now = time.monotonic()
+    with _list_cache_lock:
+        cached = _list_cache.get(path)
+        if cached and cached[0] == mtime_ns and now - cached[1] < ttl:
+            _list_cache.move_to_end(path)
+            return cached[2], cached[3], True
+
+    entries = _scan_dir(path)
+    names = [e["name"] for e in entries]
+    with _list_cache_lock:
+        _list_cache[path] = (mtime_ns, now, entries, names)
+        _list_cache.move_to_end(path)
+        while len(_list_cache) > LIST_CACHE_SIZE:
+            _list_cache.popitem(last=False)
+    return entries, names, False
+
+
+def _walk_entries(path, recursive):
+    """流式遍历目录（深度优先，不跟随符号链接），边扫描边产出"""
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = _scan_dir(current)
+        except OSError:
+            continue
+        for info in entries:
+            yield info
+        if recursive:
+            stack.extend(e["path"] for e in reversed(entries) if e["type"] == "dir")
+
+
+@app.route("/api/file/list", methods=["POST"])
+def api_file_list():
+    """
+    列出目录
+
+    请求格式：
+    {"path": "/sdcard/DCIM/Camera", "limit": 500, "cursor": null}
+
+    按文件名排序分页，下一页传上一页返回的 next_cursor（即最后一个文件名），
+    翻页期间目录有增删也不会重复或漏项；next_cursor 为 null 表示结束。
+    "stream": "ndjson" 时边扫描边逐行返回（不分页），可加 "recursive": true 遍历整个子树。
+    """
+    data = request.json or {}
+    path = data.get("path")
+    if not _is_allowed_path(path):
+        return jsonify({"success": False, "error": "Path not allowed"}), 400
+    path = path.rstrip("/") or "/"
+    if not os.path.isdir(path):
+        return jsonify({"success": False, "error": "Not a directory", "path": path}), 404
+
+    if data.get("stream"):
+        def generate():
+            for info in _walk_entries(path, bool(data.get("recursive"))):
+                yield json.dumps(info, ensure_ascii=False) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    try:
+        limit = max(1, min(int(data.get("limit", 500)), 10000))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "Invalid limit"}), 400
+    cursor = data.get("cursor")
+    try:
+        entries, names, cached = _list_dir(path)
+    except OSError as e:
+        return jsonify({"success": False, "error": str(e), "path": path}), 500
+    start = bisect.bisect_right(names, cursor) if cursor else 0
+    page = entries[start:start + limit]
+    more = start + limit < len(entries)
+    return jsonify(
+        {
+            "success": True,
+            "path": path,
+            "entries": page,
+            "count": len(page),
+            "total": len(entries),
+            "next_cursor": page[-1]["name"] if more else None,
+            "cached": cached,
+        }
+    )
+
+
+def _iter_export_members(paths):
+    """产出 (本地路径, 包内路径)；目录递归展开，包内路径以所选路径的最后一级为根"""
+    for path in paths:
+        base = os.path.dirname(path)
+        yield path, os.path.basename(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                files.sort()
+                for name in dirs + files:
+                    full = os.path.join(root, name)
+                    yield full, os.path.relpath(full, base)
+
+
+def _export_tar(paths, compress):
+    """
+    流式生成 tar（可选 gzip）
+
+    打包在后台线程里写入管道，响应从管道另一端按块读出，不落盘；
+    管道缓冲即背压。管道和写线程在开始迭代时才创建（HEAD 请求或客户端在首字节前断开
+    不会留下任何资源）；中途断开时读端关闭，写线程收到 BrokenPipe 后退出。
+    无法读取的文件跳过，并在包末尾附一个 EXPORT_ERRORS_NAME 条目列出原因。
+    """
+    level = int(load_config().get("files", {}).get("export_gzip_level", 1))
+
+    def produce(write_fd):
+        try:
+            with os.fdopen(write_fd, "wb", buffering=EXPORT_CHUNK_SIZE) as out:
+                target = out
+                if compress:
+                    target = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=level, mtime=0)
+                with tarfile.open(fileobj=target, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                    skipped = []
+                    for local, arcname in _iter_export_members(paths):
+                        try:
+                            tar.add(local, arcname=arcname, recursive=False)
+                        except BrokenPipeError:
+                            raise
+                        except OSError as e:
+                            # 打开失败时尚未写入头部，跳过不影响包结构
+                            skipped.append(f"{arcname}: {e.strerror or e}\n")
+                    if skipped:
+                        report = "".join(skipped).encode()
+                        info = tarfile.TarInfo(EXPORT_ERRORS_NAME)
+                        info.size = len(report)
+                        info.mtime = int(time.time())
+                        tar.addfile(info, io.BytesIO(report))
+                if compress:
+                    target.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def generate():
+        read_fd, write_fd = os.pipe()
+        try:
+            threading.Thread(target=produce, args=(write_fd,), daemon=True).start()
+        except Exception:
+            os.close(write_fd)
+            os.close(read_fd)
+            raise
+        try:
+            while True:
+                chunk = os.read(read_fd, EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            os.close(read_fd)
+
+    return generate()
+
+
+@app.route("/api/file/export", methods=["GET", "POST"])
+def api_file_export():
+    """
+    把多个文件 / 目录打包成 tar 流式下载
+
+    GET  /api/file/export?path=/sdcard/DCIM/Camera&path=/sdcard/Download/a.pdf[&compress=gz]
+    POST /api/file/export  {"paths": ["/sdcard/DCIM/Camera"], "compress": "gz"}
+
+    照片视频本身已压缩，默认不压缩；compress=gz 时用 files.export_gzip_level（默认 1）。
+    读取失败而跳过的文件列在包末尾的 EXPORT_ERRORS.txt 里。
+    """
+    if request.method == "POST":
+        data = request.json or {}
+        paths = data.get("paths") or ([data["path"]] if data.get("path") else [])
+        compress = data.get("compress")
+    else:
+        paths = request.args.getlist("path")
+        compress = request.args.get("compress")
+    if not paths:
+        return jsonify({"success": False, "error": "No paths specified"}), 400
+    if compress not in (None, "", "gz", "gzip"):
+        return jsonify({"success": False, "error": f"Unknown compress: {compress}"}), 400
+    for path in paths:
+        if not _is_allowed_path(path):
+            return jsonify({"success": False, "error": "Path not allowed", "path": path}), 400
+        if not os.path.lexists(path):
+            return jsonify({"success": False, "error": "Not found", "path": path}), 404
+
+    paths = [p.rstrip("/") for p in paths]
+    compress = bool(compress)
+    name = os.path.basename(paths[0]) if len(paths) == 1 else "export"
+    response = Response(
+        _export_tar(paths, compress),
+        mimetype="application/gzip" if compress else "application/x-tar",
+    )
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="{name}.tar{".gz" if compress else ""}"'
+    )
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+# ==================== 文件清单与增量同步 ====================
+
+HASH_ALGORITHMS = ("sha256", "sha1", "md5", "blake2b")
+HASH_READ_SIZE = 1024 * 1024
+
+
+class HashCache:
+    """
+    文件内容哈希的持久缓存（sqlite），键为 (设备号, inode, 大小, mtime_ns, 算法)
+
+    文件没改过就直接用缓存的哈希，不再读内容；改名 / 移动不改变 inode，同样命中。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._db = None
+        self._dirty = 0
+
+    def _conn(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, algo TEXT, hash TEXT, "
+                "PRIMARY KEY (dev, ino, size, mtime_ns, algo))"
+            )
+        return self._db
+
+    def hash_file(self, path, st, algo):
+        """返回 (哈希, 是否命中缓存)"""
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algo)
+        with self.lock:
+            row = self._conn().execute(
+                "SELECT hash FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND algo=?",
+                key,
+            ).fetchone()
+        if row:
+            return row[0], True
+
+        h = hashlib.new(algo)
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(HASH_READ_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self.lock:
+            self._conn().execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", (*key, digest))
+            self._dirty += 1
+            if self._dirty >= 200:
+                self._flush_locked()
+        return digest, False
+
+    def _flush_locked(self):
+        if self._db is not None and self._dirty:
+            self._db.commit()
+            self._dirty = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+
+hash_cache = HashCache(load_config().get("files", {}).get("hash_cache", "hash_cache.db"))
+atexit.register(hash_cache.flush)
+
+
+def _iter_tree_files(root):
+    """产出子树下的普通文件 (相对路径, 绝对路径, stat)，按路径排序，不跟随符号链接"""
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    yield os.path.relpath(entry.path, root), entry.path, st
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
+
+
+def _manifest_entry(rel, path, st, algo, counts):
+    entry = {"path": rel, "size": st.st_size, "mtime": st.st_mtime}
+    if algo:
+        try:
+            entry["hash"], cached = hash_cache.hash_file(path, st, algo)
+            counts["cached" if cached else "hashed"] += 1
+        except OSError as e:
+            entry["error"] = str(e)
+    return entry
+
+
+def _manifest_params(data):
+    """校验 path / algo，返回 (root, algo) 或错误响应"""
+    path = data.get("path")
+    if not _is_allowed_path(path):
+        return None, (jsonify({"success": False, "error": "Path not allowed"}), 400)
+    root = path.rstrip("/") or "/"
+    if not os.path.isdir(root):
+        return None, (jsonify({"success": False, "error": "Not a directory", "path": root}), 404)
+    algo = data.get("algo", "sha256")
+    if algo not in HASH_ALGORITHMS:
+        return None, (jsonify({"success": False, "error": f"Unknown algo: {algo}"}), 400)
+    return (root, algo), None
+
+
+@app.route("/api/file/manifest", methods=["POST"])
+def api_file_manifest():
+    """
+    子树文件清单：相对路径、大小、mtime、内容哈希
+
+    请求格式：
+    {"path": "/sdcard/DCIM", "algo": "sha256", "hash": true, "stream": false}
+
+    哈希持久缓存，未改动的文件不会重复读取；"hash": false 只返回 stat 信息。
+    "stream": "ndjson" 时逐行返回，最后一行为汇总 {"done": true, ...}。
+    """
+    data = request.json or {}
+    params, error = _manifest_params(data)
+    if error:
+        return error
+    root, algo = params
+    if data.get("hash", True) is False:
+        algo = None
+    counts = {"hashed": 0, "cached": 0}
+
+    if data.get("stream"):
+        def generate():
+            count = 0
+            try:
+                for rel, path, st in _iter_tree_files(root):
+                    count += 1
+                    yield json.dumps(_manifest_entry(rel, path, st, algo, counts), ensure_ascii=False) + "\n"
+            finally:
+                hash_cache.flush()
+            yield json.dumps({"done": True, "count": count, **counts}) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    started = time.perf_counter()
+    try:
+        files = [_manifest_entry(rel, path, st, algo, counts) for rel, path, st in _iter_tree_files(root)]
+    finally:
+        hash_cache.flush()
+    return _respond(
+        {
+            "success": True,
+            "root": root,
+            "algo": algo,
+            "files": files,
+            "count": len(files),
+            **counts,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+    )
+
+
+def _sync_client_manifest(manifest):
+    """
+    校验客户端清单，返回 {相对路径: {"size", "mtime", "hash"}}
+
+    清单可以是条目列表，也可以是 {相对路径: 条目}；size / mtime 必须是数字，不合法抛 ValueError。
+    """
+    if isinstance(manifest, dict):
+        if not all(isinstance(v, dict) for v in manifest.values()):
+            raise ValueError("manifest entries must be objects")
+        manifest = [{**v, "path": k} for k, v in manifest.items()]
+    if not isinstance(manifest, list):
+        raise ValueError("manifest must be a list or an object")
+    client = {}
+    for entry in manifest:
+        if not isinstance(entry, dict) or not isinstance(entry.get("path"), str) or not entry["path"]:
+            raise ValueError("manifest entries need a path")
+        size, digest = entry.get("size"), entry.get("hash")
+        if size is not None and (isinstance(size, bool) or not isinstance(size, int)):
+            raise ValueError(f"Invalid size for {entry['path']}")
+        if digest is not None and not isinstance(digest, str):
+            raise ValueError(f"Invalid hash for {entry['path']}")
+        try:
+            mtime = _num(entry.get("mtime") or 0)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid mtime for {entry['path']}")
+        client[entry["path"]] = {"size": size, "mtime": mtime, "hash": digest}
+    return client
+
+
+@app.route("/api/file/sync", methods=["POST"])
+def api_file_sync():
+    """
+    增量同步：对比客户端清单，只返回有变化的部分
+
+    请求格式：
+    {
+        "path": "/sdcard/DCIM",
+        "manifest": [{"path": "Camera/a.jpg", "size": 123, "mtime": 1700000000.0, "hash": "..."}],
+        "compare": "auto",   // auto | stat | hash
+        "algo": "sha256"
+    }
+
+    auto：大小不同即修改，大小和 mtime（允许 mtime_tolerance 秒误差，默认 1）都相同视为未变，
+    其余情况再比较哈希（服务端哈希走缓存）；stat 只看大小和 mtime；hash 总是比较哈希。
+    返回 added / modified（带哈希）、deleted（相对路径）和 unchanged 数量。
+    """
+    data = request.json or {}
+    params, error = _manifest_params(data)
+    if error:
+        return error
+    root, algo = params
+    compare = data.get("compare", "auto")
+    if compare not in ("auto", "stat", "hash"):
+        return jsonify({"success": False, "error": f"Unknown compare: {compare}"}), 400
+    try:
+        tolerance = _num(data.get("mtime_tolerance", 1.0))
+        if tolerance < 0:
+            raise ValueError("mtime_tolerance must not be negative")
+        client = _sync_client_manifest(data.get("manifest") or [])
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    with_hash = algo if data.get("hash", True) is not False else None
+
+    started = time.perf_counter()
+    counts = {"hashed": 0, "cached": 0}
+    added, modified = [], []
+    unchanged = 0
+    seen = set()
+    try:
+        for rel, path, st in _iter_tree_files(root):
+            seen.add(rel)
+            theirs = client.get(rel)
+            if theirs is None:
+                added.append(_manifest_entry(rel, path, st, with_hash, counts))
+                continue
+            if theirs.get("size") != st.st_size:
+                modified.append(_manifest_entry(rel, path, st, with_hash, counts))
+                continue
+            same_mtime = abs(theirs["mtime"] - st.st_mtime) <= tolerance
+            if compare == "stat" or (compare == "auto" and (same_mtime or not theirs.get("hash"))):
+                if same_mtime:
+                    unchanged += 1
+                else:
+                    modified.append(_manifest_entry(rel, path, st, with_hash, counts))
+                continue
+            entry = _manifest_entry(rel, path, st, algo, counts)
+            if entry.get("hash") and entry["hash"] == theirs.get("hash"):
+                unchanged += 1
+            else:
+                modified.append(entry)
+    finally:
+        hash_cache.flush()
+
+    deleted = sorted(rel for rel in client if rel not in seen)
+    return _respond(
+        {
+            "success": True,
+            "root": root,
+            "algo": algo,
+            "added": added,
+            "modified": modified,
+            "deleted": deleted,
+            "unchanged": unchanged,
+            **counts,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+    )
+
+
 # ==================== 更新 ====================
 
 # 需要备份的配置文件列表
@@ -0,0 +1,51 @@
+import json
+import os
+import shutil
+import sys
+import threading
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import phone_agent  # noqa: E402
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    """在临时目录里用仓库的 config.json 运行 Phone Agent，sdcard 指向临时目录"""
+    shutil.copy(os.path.join(REPO_DIR, "config.json"), tmp_path / "config.json")
+    sdcard = tmp_path / "sdcard"
+    sdcard.mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(phone_agent, "ALLOWED_PATH_PREFIXES", [str(sdcard) + "/"])
+    phone_agent.config_store.reload()
+    yield phone_agent, sdcard
+    phone_agent.config_store.reload()
+
+
+def write_config(agent_module, update):
+    """修改临时目录中的 config.json（浅合并到顶层各节）并立即生效"""
+    with open("config.json") as f:
+        config = json.load(f)
+    for key, value in update.items():
+        if isinstance(value, dict):
+            config.setdefault(key, {}).update(value)
+        else:
+            config[key] = value
+    with open("config.json", "w") as f:
+        json.dump(config, f)
+    agent_module.config_store.reload()
+
+
+@pytest.fixture
+def server(agent):
+    """多线程 werkzeug 服务器，返回端口"""
+    from werkzeug.serving import make_server
+
+    srv = make_server("127.0.0.1", 0, agent[0].app, threaded=True)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv.server_port
+    srv.shutdown()
@@ -0,0 +1,53 @@
+import http.client
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _get(port, path, method="GET"):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request(method, path)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+
+def _wait_idle(phone_agent, timeout=5):
+    """服务器在客户端读完响应后才关闭响应体，稍等名额归还"""
+    deadline = time.monotonic() + timeout
+    while phone_agent.admission.status()["active"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return phone_agent.admission.status()
+
+
+def test_download_releases_admission_slot(agent, server):
+    """send_file 响应（direct_passthrough）发送完后归还名额，下载次数超过类别并发上限也不会卡住"""
+    phone_agent, sdcard = agent
+    (sdcard / "a.bin").write_bytes(b"x" * 200_000)
+    path = f"/api/file/download?path={sdcard}/a.bin"
+    limit = phone_agent.admission.status()["classes"]["file"]["concurrency"]
+
+    def worker(_):
+        return [_get(server, path) for _ in range(limit + 1)]
+
+    with ThreadPoolExecutor(2) as pool:
+        results = [r for batch in pool.map(worker, range(2)) for r in batch]
+    assert all(status == 200 and len(body) == 200_000 for status, body in results)
+
+    assert _get(server, path, "HEAD")[0] == 200
+    assert _get(server, path.replace("a.bin", "missing"))[0] == 404
+    status = _wait_idle(phone_agent)
+    assert status["active"] == 0
+    assert status["classes"]["file"]["queued"] == 0
+
+
+def test_streamed_export_releases_admission_slot(agent, server):
+    phone_agent, sdcard = agent
+    (sdcard / "d").mkdir()
+    (sdcard / "d" / "f.txt").write_text("hello")
+    limit = phone_agent.admission.status()["classes"]["file"]["concurrency"]
+    for _ in range(limit + 1):
+        status, body = _get(server, f"/api/file/export?path={sdcard}/d")
+        assert status == 200 and body
+    assert _wait_idle(phone_agent)["active"] == 0
@@ -0,0 +1,27 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "actions",
+    [
+        ["tap"],
+        [{"type": "tap", "x": 1, "y": 2}, None],
+        [{"type": "tap", "x": "nan", "y": 2}],
+        [{"type": "nope"}],
+    ],
+)
+def test_batch_rejects_bad_actions(agent, actions):
+    phone_agent, _ = agent
+    resp = phone_agent.app.test_client().post("/api/adb/batch", json={"actions": actions})
+    assert resp.status_code == 400, resp.json
+    assert resp.json["success"] is False
+
+
+def test_compile_batch_timed_steps(agent):
+    phone_agent, _ = agent
+    script = phone_agent._compile_batch(
+        [{"type": "tap", "x": 1, "y": 2, "at": 100}, {"type": "key", "key": "BACK"}], "TOK", False
+    )
+    assert "__pa_at 100" in script
+    assert "input tap 1 2" in script
+    assert "TOK B 1" in script
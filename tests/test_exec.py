@@ -0,0 +1,34 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "cmd",
+    ["command -v ls", "hash ls", "readonly X=1", "times", "getopts a opt -a"],
+)
+def test_builtins_run_in_shell(agent, cmd):
+    phone_agent, _ = agent
+    assert phone_agent._command_argv(cmd) is None
+    result = phone_agent.run_cmd(cmd)
+    assert result["success"], result
+
+
+@pytest.mark.parametrize("cmd", ["echo hi # note", "! false"])
+def test_shell_syntax_runs_in_shell(agent, cmd):
+    phone_agent, _ = agent
+    assert phone_agent._command_argv(cmd) is None
+
+
+def test_simple_command_uses_argv(agent):
+    phone_agent, _ = agent
+    assert phone_agent._command_argv("ls -l /sdcard") == ["ls", "-l", "/sdcard"]
+    assert phone_agent.run_cmd("echo hello")["stdout"] == "hello\n"
+
+
+def test_unknown_program_falls_back_to_shell(agent, tmp_path):
+    """argv[0] 不是可执行文件时交给 sh：sh 能解析的照常执行，真不存在时与 shell=True 一样返回 127 输出"""
+    phone_agent, _ = agent
+    result = phone_agent.spawner.run(["nosuchprog_pa"], 5, shell="nosuchprog_pa() { echo ok; }; nosuchprog_pa")
+    assert result["stdout"] == "ok\n"
+    result = phone_agent.spawner.run(["nosuchprog_pa"], 5, shell="nosuchprog_pa")
+    assert result["returncode"] == 127
+    assert "not found" in result["stderr"]
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def tree(agent):
+    phone_agent, sdcard = agent
+    (sdcard / "a.txt").write_text("hello")
+    return phone_agent, sdcard
+
+
+def test_sync_reports_changes(tree):
+    phone_agent, sdcard = tree
+    st = os.stat(sdcard / "a.txt")
+    client = phone_agent.app.test_client()
+    resp = client.post(
+        "/api/file/sync",
+        json={
+            "path": f"{sdcard}/",
+            "manifest": {"a.txt": {"size": st.st_size, "mtime": st.st_mtime}, "gone.txt": {"size": 1}},
+        },
+    )
+    assert resp.status_code == 200, resp.json
+    assert resp.json["unchanged"] == 1
+    assert resp.json["deleted"] == ["gone.txt"]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"manifest": [{"path": "a.txt", "size": 5, "mtime": "yesterday"}]},
+        {"manifest": [{"path": "a.txt", "size": "5"}]},
+        {"manifest": {"a.txt": "x"}},
+        {"manifest": ["a.txt"]},
+        {"manifest": "a.txt"},
+        {"manifest": [], "mtime_tolerance": "abc"},
+        {"manifest": [], "mtime_tolerance": -1},
+    ],
+)
+def test_sync_rejects_bad_client_manifest(tree, body):
+    phone_agent, sdcard = tree
+    resp = phone_agent.app.test_client().post("/api/file/sync", json={"path": f"{sdcard}/", **body})
+    assert resp.status_code == 400, resp.json
+    assert resp.json["success"] is False
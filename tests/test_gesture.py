@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"path": [[0, 0], [100, 100]], "duration": 1e9},
+        {"pointers": [{"points": [[0, 0, 0], [1, 1, 1e8]]}]},
+        {"pointers": [{"points": [[0, 0]], "start": 1e9}, {"points": [[1, 1]]}]},
+        {"path": [[0, 0], [1, 1]], "duration": 59000, "sample_ms": 1},
+        {"path": [[0, 0], [1, 1]], "duration": -5},
+        {"path": [[0, 0], ["nan", 1]]},
+    ],
+)
+def test_unbounded_gesture_rejected(agent, body):
+    phone_agent, _ = agent
+    client = phone_agent.app.test_client()
+    started = time.monotonic()
+    resp = client.post("/api/adb/gesture", json={**body, "mode": "motionevent", "dry_run": True})
+    assert resp.status_code == 400, resp.json
+    assert time.monotonic() - started < 1
+
+
+def test_rotation_refreshed_off_the_compile_path(agent, monkeypatch):
+    phone_agent, _ = agent
+    calls = []
+
+    def fake_adb_shell(cmd, **kwargs):
+        calls.append(cmd)
+        return {"success": True, "stdout": "    SurfaceOrientation: 1\n"}
+
+    monkeypatch.setattr(phone_agent, "adb_shell", fake_adb_shell)
+    monkeypatch.setattr(phone_agent, "_display_rotations", {})
+    assert phone_agent._display_rotation("emu") == 1
+    assert len(calls) == 1
+    assert phone_agent._display_rotation("emu") == 1
+    assert len(calls) == 1  # 缓存未过期：不读设备
+
+    # 过期后仍直接返回缓存值，刷新在后台进行
+    read_at, rotation = phone_agent._display_rotations["emu"]
+    phone_agent._display_rotations["emu"] = (read_at - phone_agent.GESTURE_ROTATION_TTL - 1, rotation)
+    assert phone_agent._display_rotation("emu") == 1
+    deadline = time.monotonic() + 2
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(calls) == 2
@@ -0,0 +1,11 @@
+def test_cancel_after_worker_picked_up_job(agent):
+    """worker 已取走 future 但还没开始执行时取消：任务以 cancelled 结束，不会永远停在 queued"""
+    phone_agent, _ = agent
+    manager = phone_agent.JobManager()
+    job = phone_agent.Job("exec", {"command": "true"})
+    manager.jobs[job.id] = job
+    job.cancelled = True  # cancel() 已置位，但 future.cancel() 因任务已被取走而失败
+    manager._run(job)
+    assert job.status == "cancelled"
+    assert job.finished_at is not None
+    assert manager.queued() == 0
@@ -0,0 +1,47 @@
+import time
+
+
+def _record(phone_agent, params, calls):
+    recorder = phone_agent.MacroRecorder("m", None, params)
+    for rule, data in calls:
+        now = time.monotonic()
+        recorder.add(phone_agent._macro_steps(rule, data, {}), now, now)
+    return recorder.macro()
+
+
+def test_record_parametrize_substitute_round_trip(agent):
+    phone_agent, _ = agent
+    macro = _record(
+        phone_agent,
+        {"user": "alice", "key": "ENTER"},
+        [
+            ("/api/ui/tap", {"selector": {"text": "alice", "clickable": True}}),
+            ("/api/ui/tap", {"selector": {"text_contains": "alice"}}),
+            ("/api/adb/input", {"text": "alice"}),
+            ("/api/adb/input", {"text": "alice smith"}),
+            ("/api/adb/key", {"key": "ENTER"}),
+            ("/api/adb/start", {"package": "alice", "activity": ".Main"}),
+            ("/api/ui/wait", {"condition": {"type": "present", "selector": {"text": "alice"}}}),
+        ],
+    )
+    steps = macro["steps"]
+    assert steps[0]["selector"] == {"text": "{{user}}", "clickable": True}
+    assert steps[1]["selector"] == {"text_contains": "{{user}}"}
+    assert steps[2]["text"] == "{{user}}"
+    assert steps[3]["text"] == "alice smith"  # 只替换完整的值
+    assert steps[4]["key"] == "ENTER"  # 按键、包名不参数化
+    assert steps[5]["package"] == "alice"
+    assert steps[6]["condition"]["selector"] == {"text": "{{user}}"}
+
+    replay = phone_agent._macro_substitute(steps, {**macro["params"], "user": "bob"})
+    assert replay[0]["selector"]["text"] == "bob"
+    assert replay[1]["selector"]["text_contains"] == "bob"
+    assert replay[2]["text"] == "bob"
+    assert replay[5]["package"] == "alice"
+    assert replay[6]["condition"]["selector"]["text"] == "bob"
+
+
+def test_literal_placeholder_text_is_escaped(agent):
+    phone_agent, _ = agent
+    macro = _record(phone_agent, {}, [("/api/adb/input", {"text": "{{x}}"})])
+    assert phone_agent._macro_substitute(macro["steps"], {})[0]["text"] == "{{x}}"
@@ -0,0 +1,35 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def _frame(phone_agent, rgb):
+    h, w, _ = rgb.shape
+    rgba = np.concatenate([rgb, np.full((h, w, 1), 255, np.uint8)], axis=2)
+    return phone_agent.AnalysisFrame(np, w, h, rgba.tobytes(), 0)
+
+
+@pytest.fixture
+def screen(agent):
+    phone_agent, _ = agent
+    rng = np.random.default_rng(1)
+    rgb = rng.integers(0, 256, (120, 200, 3), dtype=np.uint8)
+    saved = dict(phone_agent._templates)
+    phone_agent.save_template("patch35", rgb[40:75, 60:95])
+    yield phone_agent, _frame(phone_agent, rgb)
+    phone_agent._templates.clear()
+    phone_agent._templates.update(saved)
+
+
+def test_template_found(screen):
+    phone_agent, frame = screen
+    result = phone_agent._check_template(np, frame, {"template": "patch35"})
+    assert result["found"] and (result["x"], result["y"]) == (60, 40)
+
+
+@pytest.mark.parametrize("region", [[0, 0, 200, 33], [0, 0, 33, 120]])
+def test_region_smaller_than_template_rejected(screen, region):
+    phone_agent, frame = screen
+    with pytest.raises(ValueError, match="Template larger than search region"):
+        phone_agent._check_template(np, frame, {"template": "patch35", "region": region})
+
@@ -0,0 +1,53 @@
+import pytest
+
+XML = '<?xml version="1.0"?><hierarchy><node text="hi" bounds="[0,0][10,10]" /></hierarchy>'
+
+
+@pytest.fixture
+def dumps(agent, monkeypatch):
+    phone_agent, _ = agent
+    calls = []
+
+    def fake_dump(device=None, timeout=None):
+        calls.append(timeout)
+        return {"success": True, "stdout": XML}
+
+    monkeypatch.setattr(phone_agent, "_dump_ui_xml", fake_dump)
+    return phone_agent, calls
+
+
+def test_poll_intervals_clamped(dumps):
+    """initial / max 为 0 或负数时不会变成忙等 dump"""
+    phone_agent, calls = dumps
+    result = phone_agent.wait_for(
+        {"type": "present", "selector": {"text": "missing"}}, 0.5, {"initial": 0, "max": -1}
+    )
+    assert not result["met"]
+    assert result["polls"] <= 0.5 / phone_agent.WAIT_MIN_INTERVAL + 1
+
+
+def test_dump_timeout_bounded_by_deadline(dumps):
+    phone_agent, calls = dumps
+    phone_agent.wait_for({"type": "present", "selector": {"text": "missing"}}, 0.3)
+    assert calls and all(t is not None and t <= 0.3 for t in calls)
+
+
+def test_condition_met(dumps):
+    phone_agent, _ = dumps
+    assert phone_agent.wait_for({"type": "text", "text": "hi"}, 1)["met"]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"condition": {"type": "stable"}, "timeout": "nan"},
+        {"condition": {"type": "stable"}, "timeout": None},
+        {"condition": {"type": "stable"}, "poll": {"initial": "x"}},
+        {"condition": {"type": "stable"}, "poll": 5},
+        {"condition": "present"},
+    ],
+)
+def test_bad_wait_parameters_rejected(dumps, body):
+    phone_agent, _ = dumps
+    resp = phone_agent.app.test_client().post("/api/ui/wait", json=body)
+    assert resp.status_code == 400, resp.json